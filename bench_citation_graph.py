@@ -0,0 +1,455 @@
+import argparse
+import configparser
+import contextlib
+import datetime
+import gc
+import http.server
+import json
+import multiprocessing as mp
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+from collections import namedtuple
+
+import citation_graph as cg
+from citation_graph import CitationGraph, ObsidianVaultIndex
+
+# stand-ins for the objects of pybliometrics, with the attributes used by citation_graph
+FakeAuthor = namedtuple('FakeAuthor', 'auid indexed_name surname given_name affiliation')
+FakeAffiliation = namedtuple('FakeAffiliation', 'id name city country')
+FakeReference = namedtuple('FakeReference', 'position id doi title authors authors_auid authors_affiliationid '
+                                            'sourcetitle publicationyear coverDate volume issue first last '
+                                            'citedbycount type text fulltext')
+
+BENCH_DOI_PREFIX = "10.5555/BENCH."
+VENUES = ["IEEE Transactions on Robotics", "International Journal of Robotics Research",
+          "Proceedings - IEEE International Conference on Robotics and Automation",
+          "IEEE International Conference on Intelligent Robots and Systems", "IEEE Robotics and Automation Letters",
+          "Robotics: Science and Systems", "Lecture Notes in Computer Science", "Autonomous Robots"]
+
+
+class FakeAbstractRetrieval:
+    """
+    Deterministic synthetic FULL/REF views. The reference lists have a log-normal length (median ~33, as in robotics
+    papers) and draw from a pool of references with a skewed popularity, so that the graph has common references.
+    """
+    pool_size = 100000
+    fail_rate = 0.0
+    latency = 0.0  # seconds per simulated request
+
+    def __init__(self, iid, view='FULL', refresh=0):
+        rnd = random.Random(zlib.crc32(str(iid).encode()))
+        if rnd.random() < self.fail_rate:
+            raise cg.Scopus404Error("Synthetic 404: %s" % iid)
+        if self.latency:
+            time.sleep(self.latency)
+
+        num = zlib.crc32(str(iid).encode()) % 10 ** 9
+        self.title = "Synthetic paper %d on graph based localization" % num
+        self.doi = str(iid)
+        self.eid = "2-s2.0-%d" % (84000000000 + num)
+        self.citedby_count = int(rnd.paretovariate(1.2))
+        self.coverDate = "%d-01-01" % rnd.randint(2000, 2024)
+        self.sourcetitle_abbreviation = "IEEE Trans. Robot."
+        self.refcount = max(5, min(250, int(rnd.lognormvariate(3.5, 0.5))))
+        self.authors = [FakeAuthor(57000000000 + rnd.randint(0, 10 ** 6), "Doe J.", "Doe", "John", None)
+                        for _ in range(rnd.randint(1, 6))]
+        self.affiliation = [FakeAffiliation(60000000 + rnd.randint(0, 1000), "Synthetic University", "", "")]
+
+        self.references = None
+        if view == 'REF':
+            self.references = []
+            for pos in range(self.refcount):
+                ref_num = int(self.pool_size * rnd.random() ** 3)  # a few references are cited by many papers
+                ref_rnd = random.Random(ref_num)
+                year = ref_rnd.randint(1980, 2023)
+                self.references.append(FakeReference(
+                    str(pos + 1), str(85000000000 + ref_num), None, "Synthetic reference %d" % ref_num,
+                    "Doe J.; Roe R.; Poe P.", "%d; %d; %d" % (ref_num, ref_num + 1, ref_num + 2), None,
+                    VENUES[ref_num % len(VENUES)], str(year), "%d-01-01" % year, None, None, None, None,
+                    str(int(ref_rnd.paretovariate(1.1))), None, None, None))
+
+    def get_key_remaining_quota(self):
+        return None  # as for a cache hit
+
+    def get_key_reset_time(self):
+        return None
+
+
+def install_fake_scopus(work_dir):
+    """
+    Route the Scopus access of citation_graph to FakeAbstractRetrieval. Nothing is sent to Scopus.
+    Only this process is patched, and the worker processes forked from it. Spawned workers (the default on macOS
+    and Windows) import citation_graph afresh and would query the real Scopus, see use_forked_workers.
+    :param work_dir: holds the pybliometrics style cache markers and the caches of citation_graph
+    :return:
+    """
+    config = configparser.ConfigParser()
+    config['Directories'] = {'AbstractRetrieval': os.path.join(work_dir, "scopus")}
+    cg.AbstractRetrieval = FakeAbstractRetrieval
+    cg.scopus_init = lambda *args, **kwargs: None
+    cg.get_config = lambda: config
+    cg.get_keys = lambda: ["BENCH"]
+    cg.BASE_PATH = work_dir
+
+
+def use_forked_workers():
+    """
+    Make the process pools fork their workers where possible, so that they inherit the fake of install_fake_scopus.
+    :return: whether they do
+    """
+    if "fork" in mp.get_all_start_methods():
+        mp.set_start_method("fork", force=True)
+    return workers_are_forked()
+
+
+def workers_are_forked():
+    return mp.get_start_method() == "fork"
+
+
+def warm_scopus_cache(dois):
+    """
+    Create the cache files pybliometrics would have, so that the rate limiter and the quota budget see cache hits.
+    """
+    for view in ("FULL", "REF"):
+        for doi in dois:
+            path = CitationGraph.scopus_cache_path(doi, view)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "a").close()
+
+
+def bench_dois(n, start=0):
+    return [BENCH_DOI_PREFIX + str(i) for i in range(start, start + n)]
+
+
+def make_vault(md_dir, num_notes, body_bytes=2000, seed=0):
+    """
+    Synthetic Obsidian vault in the note format of create_obsidian_note_from_full, in nested folders.
+    :param md_dir:
+    :param num_notes:
+    :param body_bytes: approximate size of the note body
+    :param seed:
+    :return: list of the DOIs of the notes
+    """
+    rnd = random.Random(seed)
+    body = ("## Overview\nkeynovelty::\n\n" + "lorem ipsum " * (body_bytes // 12)) + "\n"
+    dois = bench_dois(num_notes)
+    for i, doi in enumerate(dois):
+        sub_dir = os.path.join(md_dir, "topic%02d" % (i % 20))
+        os.makedirs(sub_dir, exist_ok=True)
+        with open(os.path.join(sub_dir, "Synthetic note %d.md" % i), "w", encoding="utf-8") as f:
+            f.write("---\n"
+                    "title: \"Synthetic note %d\"\n"
+                    "date: \"2024-01-01 00:00:00\"\n"
+                    "updated: \"2024-01-01 00:00:00\"\n"
+                    "tags: ['paper']\n"
+                    "aliases: []\n"
+                    "full_title: \"Synthetic note %d on graph based localization\"\n"
+                    "status: unread\n"
+                    "doi: \"%s\"\n"
+                    "link: %s\n"
+                    "scopus_id: \n"
+                    "citedby: %d\n"
+                    "authors: ['Doe, John']\n"
+                    "venue: \"IEEE Trans. Robot.\"\n"
+                    "year: 2020\n"
+                    "---\n\n" % (i, i, doi, "http://arxiv.org/abs/2001.%05d" % i if i % 3 == 0 else "",
+                                 rnd.randint(0, 500)))
+            f.write(body)
+    return dois
+
+
+class FakeMetadataHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Canned doi.org BibTeX (/doi/<doi>) and arXiv API Atom feeds (/api/query?id_list=...).
+    """
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.startswith("/doi/"):
+            doi = urllib.parse.unquote(url.path[len("/doi/"):])
+            body = ("@article{Bench_%d, title={Synthetic DOI paper %s}, volume={1}, DOI={%s}, "
+                    "journal={IEEE Transactions on Robotics}, publisher={IEEE}, "
+                    "author={Doe, John and Roe, Richard}, year={2021}, pages={1-10} }"
+                    % (zlib.crc32(doi.encode()), doi, doi))
+            ctype = "application/x-bibtex"
+        elif url.path == "/api/query":
+            aids = urllib.parse.parse_qs(url.query).get("id_list", [""])[0].split(",")
+            entries = "".join(
+                "<entry><id>http://arxiv.org/abs/%sv1</id><updated>2021-01-02T00:00:00Z</updated>"
+                "<published>2021-01-01T00:00:00Z</published><title>Synthetic arXiv paper %s</title>"
+                "<author><name>John Doe</name></author><author><name>Richard Roe</name></author></entry>"
+                % (aid, aid) for aid in aids if aid)
+            body = "<?xml version=\"1.0\"?><feed xmlns=\"http://www.w3.org/2005/Atom\">%s</feed>" % entries
+            ctype = "application/atom+xml"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class UnthrottledTokenBucket(cg.TokenBucket):
+    """
+    The arXiv creators pace themselves to the arXiv terms of use, which is pointless against the local server.
+    """
+
+    def __init__(self, rate, capacity=1, shared=False):
+        super().__init__(1e9, capacity, shared)
+
+
+class Bench:
+    def __init__(self, work_dir, repeat=1, num_proc=4):
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.num_proc = num_proc
+        self.results = []
+
+    def run(self, name, size, fn, setup=None, **extra):
+        """
+        Time fn() with its output discarded, best of `repeat` runs.
+        :param name:
+        :param size:
+        :param fn: called with the return value of setup(), if any
+        :param setup: untimed preparation before each run
+        :param extra: recorded with the result
+        :return: the return value of the last fn()
+        """
+        times = []
+        ret = None
+        for _ in range(self.repeat):
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                arg = setup() if setup else None
+                gc.collect()
+                t0 = time.perf_counter()
+                ret = fn(arg) if setup else fn()
+                times.append(time.perf_counter() - t0)
+        res = dict(bench=name, size=size, seconds=min(times), runs=times, **extra)
+        self.results.append(res)
+        print("%32s | %8d | %10.4f s" % (name, size, res["seconds"]))
+        return ret
+
+    def sub_dir(self, *names):
+        path = os.path.join(self.work_dir, *names)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return path
+
+    def bench_retrieval(self, num_papers):
+        dois = bench_dois(num_papers)
+        warm_scopus_cache(dois)
+
+        graph = self.run("get_bibliography_info", num_papers,
+                         lambda g: (g.get_bibliography_info(), g)[1],
+                         setup=lambda: CitationGraph(dois))
+        if workers_are_forked():
+            self.run("get_bibliography_info_parallel", num_papers,
+                     lambda g: g.get_bibliography_info_parallel(),
+                     setup=lambda: CitationGraph(dois, num_proc=self.num_proc), num_proc=self.num_proc)
+        else:
+            print("%32s | %8d | skipped, the worker processes cannot be forked and would query the real Scopus"
+                  % ("get_bibliography_info_parallel", num_papers))
+        self.run("print_refs", num_papers, lambda: graph.print_refs(show_ref_pos=True),
+                 references=graph.refs.num_nodes, citations=len(graph.refs.indices))
+        self.run("print_refs_top100", num_papers, lambda: graph.print_refs(show_ref_pos=True, limit=100))
+
+    def bench_vault(self, num_notes):
+        md_dir = self.sub_dir("vault_%d" % num_notes)
+        dois = make_vault(md_dir, num_notes)
+        warm_scopus_cache(dois)
+
+        def open_index(drop_file):
+            ObsidianVaultIndex._opened.clear()
+            if drop_file and os.path.isfile(os.path.join(md_dir, ObsidianVaultIndex.INDEX_NAME)):
+                os.remove(os.path.join(md_dir, ObsidianVaultIndex.INDEX_NAME))
+            return ObsidianVaultIndex.open(md_dir)
+
+        self.run("vault_index_cold", num_notes, lambda: open_index(True))
+        self.run("vault_index_warm", num_notes, lambda: open_index(False))
+
+        num_new = 100
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            full_graph = CitationGraph(bench_dois(num_new, start=num_notes))
+            warm_scopus_cache(full_graph.input_doi)
+            full_graph.get_bibliography_info()
+
+        def create_notes(topic_dir):
+            vault_index = ObsidianVaultIndex.open(md_dir)
+            for full in filter(None, full_graph.v_full):
+                uom = CitationGraph.UnifiedObsMetadata()
+                uom.title = full.title
+                uom.doi = full.doi
+                uom.citedby_count = full.citedby_count
+                uom.sourcetitle_abbr = full.sourcetitle_abbreviation
+                uom.year = full.coverDate[:4]
+                uom.authors = [au.indexed_name for au in full.authors]
+                uom.scopus_id = full.eid[7:]
+                CitationGraph.create_obsidian_note_from_full(uom, topic_dir, "bench", vault_index)
+            vault_index.save()
+
+        def new_topic_dir():
+            ObsidianVaultIndex._opened.clear()
+            return self.sub_dir("vault_%d" % num_notes, "new_notes")
+
+        self.run("create_obsidian_note_from_full", num_notes, create_notes, setup=new_topic_dir, notes=num_new)
+        shutil.rmtree(os.path.join(md_dir, "new_notes"), ignore_errors=True)
+
+        def reset_citedby():
+            ObsidianVaultIndex._opened.clear()
+            shutil.rmtree(md_dir)
+            make_vault(md_dir, num_notes)
+
+        self.run("update_md_metadata", num_notes, lambda _: cg.update_md_metadata(md_dir), setup=reset_citedby)
+        self.run("update_md_metadata_unchanged", num_notes, lambda: cg.update_md_metadata(md_dir))
+
+    def bench_note_creators(self, num_ids, server_url):
+        dois = bench_dois(num_ids, start=10 ** 6)
+        aids = ["arXiv:2101.%05d" % i for i in range(num_ids)]
+
+        def fresh_dir():
+            ObsidianVaultIndex._opened.clear()
+            return self.sub_dir("creators")
+
+        def from_dois(md_dir):
+            CitationGraph.create_obsidian_notes_from_dois(dois, md_dir, "bench", doi_site=server_url + "/doi/")
+
+        def from_arxiv(md_dir):
+            CitationGraph.create_obsidian_notes_from_arxiv(aids, md_dir, "bench", api_site=server_url + "/api/query")
+
+        self.run("create_obsidian_notes_from_dois", num_ids, from_dois, setup=fresh_dir)
+
+        token_bucket = cg.TokenBucket
+        cg.TokenBucket = UnthrottledTokenBucket
+        try:
+            self.run("create_obsidian_notes_from_arxiv", num_ids, from_arxiv, setup=fresh_dir)
+        finally:
+            cg.TokenBucket = token_bucket
+
+    def bench_venues(self, num_calls):
+        """
+        simplify_source_title over a few hundred distinct venue names, as when printing large reference tables, with
+        the memo and (on at most 100k calls) without it.
+        """
+        rnd = random.Random(num_calls)
+        words = " ".join(VENUES).replace(":", "").split()
+        names = VENUES + [" ".join(rnd.choice(words) for _ in range(rnd.randint(3, 10))) for _ in range(300)]
+        calls = [names[min(int(rnd.paretovariate(1.2)) - 1, len(names) - 1)] for _ in range(num_calls)]
+
+        def run(abbreviate):
+            for name in calls:
+                abbreviate(name)
+
+        self.run("venue_abbreviation", num_calls, lambda _: run(cg.CitationGraph.simplify_source_title),
+                 setup=lambda: cg.venue_abbreviator.configure([]), distinct=len(set(calls)))
+        calls = calls[:100000]
+        self.run("venue_abbreviation_no_memo", len(calls), run, setup=lambda: cg.VenueAbbreviator(memo_size=0))
+
+    def bench_startup(self):
+        """
+        Cumulative import time of citation_graph as reported by python -X importtime, in a fresh interpreter.
+        """
+        times = []
+        for _ in range(max(self.repeat, 3)):
+            proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import citation_graph"],
+                                  capture_output=True, text=True,
+                                  cwd=os.path.split(os.path.realpath(__file__))[0])
+            for line in proc.stderr.splitlines():
+                fields = line.split("|")
+                if len(fields) == 3 and fields[2].strip() == "citation_graph":
+                    times.append(int(fields[1]) * 1e-6)
+        res = dict(bench="import_citation_graph", size=1, seconds=min(times), runs=times)
+        self.results.append(res)
+        print("%32s | %8d | %10.4f s" % (res["bench"], res["size"], res["seconds"]))
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.split(os.path.realpath(__file__))[0]).stdout.strip()
+    except OSError:
+        return ""
+
+
+def parse_sizes(txt):
+    return [int(x) for x in txt.split(",") if x.strip()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark citation_graph against a synthetic Scopus and vault.")
+    parser.add_argument("--papers", default="100,1000", help="input paper counts of the retrieval benchmarks")
+    parser.add_argument("--notes", default="1000,10000", help="note counts of the synthetic vaults, up to 100000")
+    parser.add_argument("--ids", default="200", help="id counts of the DOI/arXiv note creators")
+    parser.add_argument("--venue-calls", default="1000000", help="call counts of the venue abbreviation benchmark")
+    parser.add_argument("--num-proc", type=int, default=4, help="processes of get_bibliography_info_parallel")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per benchmark, the best one is reported")
+    parser.add_argument("--latency", type=float, default=0., help="simulated seconds per Scopus request")
+    parser.add_argument("--fail-rate", type=float, default=0.02, help="fraction of synthetic 404 papers")
+    parser.add_argument("--only", default="startup,retrieval,vault,creators,venues", help="benchmark groups to run")
+    parser.add_argument("--work-dir", default="", help="scratch directory, a temporary one by default")
+    parser.add_argument("--out", default="bench_output.json", help="JSON results, '-' for stdout")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_citation_graph_")
+    os.makedirs(work_dir, exist_ok=True)
+    install_fake_scopus(work_dir)
+    use_forked_workers()
+    FakeAbstractRetrieval.latency = args.latency
+    FakeAbstractRetrieval.fail_rate = args.fail_rate
+
+    groups = set(args.only.split(","))
+    bench = Bench(work_dir, args.repeat, args.num_proc)
+    print("%32s | %8s | %12s" % ("benchmark", "size", "time"))
+    try:
+        if "startup" in groups:
+            bench.bench_startup()
+        if "retrieval" in groups:
+            for n in parse_sizes(args.papers):
+                bench.bench_retrieval(n)
+        if "vault" in groups:
+            for n in parse_sizes(args.notes):
+                bench.bench_vault(n)
+        if "creators" in groups:
+            server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeMetadataHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                for n in parse_sizes(args.ids):
+                    bench.bench_note_creators(n, "http://127.0.0.1:%d" % server.server_port)
+            finally:
+                server.shutdown()
+        if "venues" in groups:
+            for n in parse_sizes(args.venue_calls):
+                bench.bench_venues(n)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+        "results": bench.results,
+    }
+    if args.out == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print("[+] Results written to %s" % args.out)
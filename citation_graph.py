@@ -1,23 +1,2197 @@
-from pybliometrics.scopus.exception import Scopus404Error
-from pybliometrics.scopus import AbstractRetrieval
-from pybliometrics.scopus import init as scopus_init
-from pybliometrics.scopus.utils.constants import BASE_PATH
 from collections import namedtuple
 import time
 import re
+import bisect
+import atexit
+import contextlib
 import os
 import csv
+import sqlite3
+import array
+import json
+import pickle
+import hashlib
 import datetime
 import random
+import heapq
+import functools
+import threading
+import urllib.parse
+import concurrent.futures
+import xml.etree.ElementTree as ET
+import math
 
-import requests
-import pyperclip
-from bs4 import BeautifulSoup
-import queue
 import multiprocessing as mp
 
 
+# pybliometrics, requests, bs4 and pyperclip are imported on first use, so that the offline tools start fast and work
+# without a pybliometrics config. The pybliometrics names are bound by load_scopus(), unless already set (e.g. to a
+# test double).
+AbstractRetrieval = None
+Scopus404Error = None
+scopus_init = None
+get_config = None
+get_keys = None
+_scopus_loaded = False
+
+# serve everything from local caches and never query Scopus, unless overridden per CitationGraph
+OFFLINE = bool(os.environ.get("CITATION_GRAPH_OFFLINE"))
+
+
+def _pybliometrics_base_path():
+    """
+    Cache folder of pybliometrics, found as pybliometrics.scopus.utils.constants does, without importing it.
+    """
+    home = os.path.expanduser("~")
+    for path in (os.path.join(home, ".scopus"), os.path.join(home, ".pybliometrics", "Scopus")):
+        if os.path.exists(path):
+            return path
+    return os.path.join(home, ".cache", "pybliometrics", "Scopus")
+
+
+BASE_PATH = _pybliometrics_base_path()
+
+
+class ScopusOfflineError(RuntimeError):
+    pass
+
+
+def load_scopus(offline=False):
+    """
+    Import pybliometrics and initialize it from its config, once, before the first real retrieval.
+    :param offline: only read an existing config, raise ScopusOfflineError instead of creating one interactively
+    :return:
+    """
+    global AbstractRetrieval, Scopus404Error, scopus_init, get_config, get_keys, _scopus_loaded
+    if _scopus_loaded:
+        return
+    from pybliometrics.scopus.exception import Scopus404Error as _scopus_404_error
+    from pybliometrics.scopus import AbstractRetrieval as _abstract_retrieval
+    from pybliometrics.scopus import init as _scopus_init
+    from pybliometrics.scopus.utils import get_config as _get_config, get_keys as _get_keys
+    from pybliometrics.scopus.utils.constants import CONFIG_FILE
+
+    AbstractRetrieval = AbstractRetrieval or _abstract_retrieval
+    Scopus404Error = Scopus404Error or _scopus_404_error
+    scopus_init = scopus_init or _scopus_init
+    get_config = get_config or _get_config
+    get_keys = get_keys or _get_keys
+    if offline and scopus_init is _scopus_init and not os.path.exists(CONFIG_FILE):
+        raise ScopusOfflineError("no pybliometrics config at %s" % CONFIG_FILE)
+    scopus_init()
+    _scopus_loaded = True
+
+
 # Abstract Retrieval, 10,000 per week, 9 per sec.
+SCOPUS_REQ_PER_SEC = 9
+SCOPUS_REFS_PER_PAGE = 40  # the REF view is fetched in pages of 40 references
+SCOPUS_REF_PAGES_UNKNOWN = 4  # REF pages budgeted for a paper whose reference count is unknown (up to 160 references)
+
+# the frontmatter is only looked for in the head of a note
+FRONTMATTER_MAX_BYTES = 64 * 1024
+FRONTMATTER_MAX_LINES = 400
+
+_worker_bucket = None  # TokenBucket shared by the retrieval worker processes
+
+# compact, picklable records of the retrievals, with the attribute names of the pybliometrics objects used here
+FullRecord = namedtuple('FullRecord', 'title doi eid citedby_count coverDate sourcetitle_abbreviation refcount '
+                                      'authors affiliation')
+AuthorRecord = namedtuple('AuthorRecord', 'auid indexed_name surname given_name')
+AffiliationRecord = namedtuple('AffiliationRecord', 'id name')
+RefRow = namedtuple('RefRow', 'position id doi title authors authors_auid sourcetitle coverDate citedbycount')
+# failure: None if retrieved, else the outcome of the view that failed (not_found, empty, offline_miss, error) or
+# deferred (quota budget); only not_found and empty are permanent, see CitationGraph.add_retrieval
+RetrievalResult = namedtuple('RetrievalResult', 'iid full refs n_requests quota_rem reset_time metrics failure',
+                             defaults=(None, None))
+# one row of the ranked references: citing is a list of (input paper index, reference position)
+RankedRef = namedtuple('RankedRef', 'rank node count pinned ref citing score', defaults=(None,))
+
+
+class Metrics:
+    """
+    Counters and latency histograms of a run, exported as JSON or Prometheus text. Disabled by default, then every
+    call returns at the first check. Set CITATION_GRAPH_METRICS to an output path (.prom for Prometheus text, "-" for
+    stdout) to enable it and dump it at exit, or call enable() and dump() on demand.
+    Worker processes drain their metrics into the results they return, and the main process merges them.
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)  # seconds
+    PREFIX = "citation_graph_"
+
+    class _Timer:
+        def __init__(self, metrics, name, labels):
+            self.metrics, self.name, self.labels = metrics, name, labels
+
+        def __enter__(self):
+            self.t0 = time.perf_counter()
+            return self
+
+        def __exit__(self, *exc):
+            self.metrics.observe(self.name, time.perf_counter() - self.t0, **self.labels)
+            return False
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = dict()  # (name, sorted label items): value
+        self.histograms = dict()  # (name, sorted label items): [count per bucket..., count above, sum]
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict()
+            self.histograms = dict()
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.]
+            hist[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            hist[-1] += seconds
+
+    def timer(self, name, **labels):
+        """
+        with metrics.timer("note_write_seconds"): ...
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._Timer(self, name, labels)
+
+    def snapshot(self):
+        """
+        :return: JSON-able dict, which merge() accepts
+        """
+        with self.lock:
+            return {
+                "buckets": list(self.BUCKETS),
+                "counters": [{"name": k[0], "labels": dict(k[1]), "value": v} for k, v in self.counters.items()],
+                "histograms": [{"name": k[0], "labels": dict(k[1]), "counts": v[:-1], "sum": v[-1]}
+                               for k, v in self.histograms.items()],
+            }
+
+    def drain(self):
+        """
+        Snapshot and reset, for the worker processes.
+        """
+        snap = self.snapshot()
+        self.reset()
+        return snap
+
+    def merge(self, snap):
+        if not self.enabled or not snap:
+            return
+        assert tuple(snap["buckets"]) == self.BUCKETS
+        with self.lock:
+            for c in snap["counters"]:
+                key = (c["name"], tuple(sorted(c["labels"].items())))
+                self.counters[key] = self.counters.get(key, 0) + c["value"]
+            for h in snap["histograms"]:
+                key = (h["name"], tuple(sorted(h["labels"].items())))
+                hist = self.histograms.setdefault(key, [0] * (len(self.BUCKETS) + 1) + [0.])
+                for i, cnt in enumerate(h["counts"]):
+                    hist[i] += cnt
+                hist[-1] += h["sum"]
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        def fmt_labels(labels, **extra):
+            items = list(labels) + sorted(extra.items())
+            if not items:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                                     for k, v in items)
+
+        lines = []
+        with self.lock:
+            for name in sorted({k[0] for k in self.counters}):
+                lines.append("# TYPE %s%s counter" % (self.PREFIX, name))
+                for key in sorted(k for k in self.counters if k[0] == name):
+                    lines.append("%s%s%s %s" % (self.PREFIX, name, fmt_labels(key[1]), self.counters[key]))
+            for name in sorted({k[0] for k in self.histograms}):
+                lines.append("# TYPE %s%s histogram" % (self.PREFIX, name))
+                for key in sorted(k for k in self.histograms if k[0] == name):
+                    hist = self.histograms[key]
+                    cum = 0
+                    for le, cnt in zip(self.BUCKETS + ("+Inf",), hist[:-1]):
+                        cum += cnt
+                        lines.append("%s%s_bucket%s %d" % (self.PREFIX, name, fmt_labels(key[1], le=le), cum))
+                    lines.append("%s%s_sum%s %.6f" % (self.PREFIX, name, fmt_labels(key[1]), hist[-1]))
+                    lines.append("%s%s_count%s %d" % (self.PREFIX, name, fmt_labels(key[1]), cum))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """
+        :param path: .prom or .txt for Prometheus text, otherwise JSON. "-" prints JSON.
+        :return:
+        """
+        if path == "-":
+            print(self.to_json())
+            return
+        txt = self.to_prometheus() if path.endswith((".prom", ".txt")) else self.to_json()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(txt)
+        print("[+] Metrics written to %s" % path)
+
+
+metrics = Metrics(enabled=bool(os.environ.get("CITATION_GRAPH_METRICS")))
+if metrics.enabled:
+    atexit.register(metrics.dump, os.environ["CITATION_GRAPH_METRICS"])
+
+
+class ObsidianVaultIndex:
+    """
+    On-disk index of the paper notes in an Obsidian vault, keyed by scopus_id, DOI, arXiv id and normalized title.
+    The frontmatter of a note is only re-parsed when its mtime or size changes, so opening the index of a large vault
+    costs a directory walk instead of reading every note. Existence checks are dict lookups.
+    """
+
+    INDEX_NAME = ".citation_graph_index.json"
+    INDEX_VERSION = 2
+    # (mtime_ns, size, scopus_id, doi, arxiv_id, title), all ids normalized
+    Record = namedtuple('VaultRecord', 'mtime_ns size scopus_id doi arxiv_id title')
+
+    _opened = dict()  # realpath of md_dir: index, so that all the note creators in one process share the same index
+
+    def __init__(self, md_dir):
+        self.md_dir = md_dir
+        self.index_path = os.path.join(md_dir, self.INDEX_NAME)
+        self.records = dict()  # path relative to md_dir: Record
+        self.by_scopus_id = dict()
+        self.by_doi = dict()
+        self.by_arxiv_id = dict()
+        self.by_title = dict()
+        self.dirty = False
+
+    @classmethod
+    def open(cls, md_dir, refresh=True):
+        """
+        Get the shared index of `md_dir`, loading it from disk the first time.
+        :param md_dir:
+        :param refresh: bring the index up to date with the files on disk
+        :return:
+        """
+        key = os.path.realpath(md_dir)
+        idx = cls._opened.get(key)
+        if idx is None:
+            idx = cls(md_dir)
+            idx.load()
+            cls._opened[key] = idx
+        if refresh:
+            idx.refresh()
+        return idx
+
+    @staticmethod
+    def normalize_title(title):
+        if not title:
+            return ""
+        title = re.sub(r"<[^>]+>", " ", title)  # html tags in scopus titles
+        return " ".join(re.sub(r"[^\w]+", " ", title.lower()).split())
+
+    @staticmethod
+    def normalize_doi(doi):
+        doi = (doi or "").strip().strip("\"'").strip().upper()
+        return "" if doi == "N/A" else doi
+
+    @staticmethod
+    def normalize_scopus_id(scopus_id):
+        return str(scopus_id or "").strip().strip("\"'").strip().lower()
+
+    @staticmethod
+    def arxiv_id_from_link(link):
+        match_aid = re.search(r"arxiv.org/abs/(\d{4}\.\d{4,5})", link or "")
+        return match_aid.groups()[0] if match_aid else ""
+
+    def load(self):
+        if not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                dat = json.load(f)
+        except (OSError, ValueError) as e:
+            print(" !  Vault index unreadable, rebuilding:", e)
+            return
+        if dat.get("version") != self.INDEX_VERSION:
+            print("[!] Vault index version changed, rebuilding.")
+            return
+        for rel_path, rec in dat.get("files", {}).items():
+            self._put(rel_path, self.Record(*rec))
+
+    def save(self):
+        if not self.dirty or not os.path.isdir(self.md_dir):
+            return
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": self.INDEX_VERSION,
+                       "files": {k: list(v) for k, v in self.records.items()}}, f)
+        os.replace(tmp_path, self.index_path)
+        self.dirty = False
+
+    def refresh(self):
+        """
+        Re-parse the notes whose mtime or size changed since the last refresh, and forget the deleted ones.
+        :return:
+        """
+        seen = set()
+        num_parsed = 0
+        t0 = time.perf_counter()
+        for root, dirs, files in os.walk(self.md_dir):
+            for fname in files:
+                if not fname.endswith(".md"):
+                    continue
+                fpath = os.path.join(root, fname)
+                rel_path = os.path.relpath(fpath, self.md_dir)
+                seen.add(rel_path)
+                st = os.stat(fpath)
+                rec = self.records.get(rel_path)
+                if rec is None or rec.mtime_ns != st.st_mtime_ns or rec.size != st.st_size:
+                    self._put(rel_path, self._parse(fpath, st))
+                    num_parsed += 1
+
+        for rel_path in [k for k in self.records if k not in seen]:
+            self._drop(rel_path)
+        metrics.observe("vault_scan_seconds", time.perf_counter() - t0)
+        metrics.inc("vault_notes_scanned_total", len(seen))
+        metrics.inc("vault_notes_parsed_total", num_parsed)
+        if num_parsed:
+            print("[+] Vault index of %s: %d notes, %d (re)parsed." % (self.md_dir, len(self.records), num_parsed))
+        self.save()
+
+    def add(self, fpath):
+        """
+        Register a note that was just written, without walking the vault again.
+        :param fpath:
+        :return:
+        """
+        rel_path = os.path.relpath(fpath, self.md_dir)
+        self._put(rel_path, self._parse(fpath, os.stat(fpath)))
+
+    def get(self, fpath):
+        return self.records.get(os.path.relpath(fpath, self.md_dir))
+
+    def find(self, scopus_id="", doi="", arxiv_id="", title=""):
+        """
+        Path (relative to md_dir) of an existing note of the same paper, or None.
+        """
+        for lookup, key in ((self.by_scopus_id, self.normalize_scopus_id(scopus_id)),
+                            (self.by_doi, self.normalize_doi(doi)),
+                            (self.by_arxiv_id, arxiv_id),
+                            (self.by_title, self.normalize_title(title))):
+            paths = lookup.get(key) if key else None
+            if paths:
+                return min(paths)
+        return None
+
+    def _parse(self, fpath, st):
+        kv = {k: CitationGraph.frontmatter_scalar(v) for k, v in CitationGraph.parse_frontmatter(fpath).items()}
+        return self.Record(st.st_mtime_ns, st.st_size,
+                           self.normalize_scopus_id(kv.get("scopus_id")),
+                           self.normalize_doi(kv.get("doi")),
+                           self.arxiv_id_from_link(kv.get("link")),
+                           self.normalize_title((kv.get("full_title") or kv.get("title") or "").strip("\"'")))
+
+    def _lookups(self, rec):
+        return ((self.by_scopus_id, rec.scopus_id), (self.by_doi, rec.doi),
+                (self.by_arxiv_id, rec.arxiv_id), (self.by_title, rec.title))
+
+    def _put(self, rel_path, rec):
+        self._drop(rel_path)
+        self.records[rel_path] = rec
+        for lookup, key in self._lookups(rec):
+            if key:
+                lookup.setdefault(key, set()).add(rel_path)  # a set, since duplicate notes do exist in the wild
+        self.dirty = True
+
+    def _drop(self, rel_path):
+        rec = self.records.pop(rel_path, None)
+        if rec is None:
+            return
+        for lookup, key in self._lookups(rec):
+            paths = lookup.get(key)
+            if paths:
+                paths.discard(rel_path)
+                if not paths:
+                    del lookup[key]
+        self.dirty = True
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: `rate` tokens per second, bursts of up to `capacity` requests.
+    With shared=True the state lives in shared memory, so that one bucket passed to worker processes at their creation
+    limits all of them together.
+    """
+
+    def __init__(self, rate, capacity=1, shared=False):
+        assert rate > 0 and capacity >= 1
+        self.rate = rate
+        self.capacity = capacity
+        if shared:
+            self._state = mp.Array('d', [float(capacity), time.monotonic()])  # tokens, time stamp
+            self._lock = self._state.get_lock()
+        else:
+            self._state = [float(capacity), time.monotonic()]
+            self._lock = threading.Lock()
+
+    def acquire(self, n=1):
+        """
+        Block until `n` tokens are available and take them.
+        :param n: more than `capacity` is allowed, the bucket then goes into debt
+        :return: seconds waited
+        """
+        waited = 0.
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens = min(self.capacity, self._state[0] + (now - self._state[1]) * self.rate)
+                self._state[1] = now
+                if tokens >= min(n, self.capacity):
+                    self._state[0] = tokens - n
+                    return waited
+                self._state[0] = tokens
+                wait = (min(n, self.capacity) - tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class PooledHttpFetcher:
+    """
+    Fetch many urls over one keep-alive session with a thread pool. Requests to the same host, redirect targets
+    included, are capped at `max_per_host` at a time, and 429/5xx answers are retried with exponential backoff (or
+    the server's Retry-After). Every attempt takes a token from `bucket`, if given.
+    """
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, num_workers=8, max_per_host=4, max_retries=4, backoff=1.0, timeout=30, bucket=None):
+        assert num_workers >= 1 and max_per_host >= 1
+        self.num_workers = num_workers
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.bucket = bucket
+
+        import requests
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=num_workers, pool_maxsize=num_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._host_sems = dict()
+        self._host_lock = threading.Lock()
+
+    def _host_sem(self, url):
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        with self._host_lock:
+            if host not in self._host_sems:
+                self._host_sems[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_sems[host]
+
+    def _get_following(self, url, headers):
+        """
+        GET that follows the redirects itself, so that every hop counts against the cap of its own host, e.g. the
+        publisher a doi.org link redirects to, not only against the cap of the host first asked.
+        """
+        import requests
+
+        for _ in range(self.session.max_redirects + 1):
+            with self._host_sem(url):
+                req = self.session.get(url, headers=headers, timeout=self.timeout, allow_redirects=False)
+                if not req.is_redirect:
+                    req.content  # read the body while still holding the host's slot
+                    return req
+            url = urllib.parse.urljoin(req.url, req.headers["Location"])
+            req.close()
+        raise requests.TooManyRedirects("Exceeded %d redirects: %s" % (self.session.max_redirects, url))
+
+    def get(self, url, headers=None):
+        """
+        GET with retries.
+        :param url:
+        :param headers:
+        :return: (status code, text). Status is -1 if the connection kept failing.
+        """
+        import requests
+
+        status, text = -1, ""
+        for attempt in range(self.max_retries + 1):
+            wait = self.backoff * 2 ** attempt * (0.5 + random.random())
+            if self.bucket is not None:
+                self.bucket.acquire()
+            try:
+                req = self._get_following(url, headers)
+                status, text = req.status_code, req.text
+                if status not in self.RETRY_STATUS:
+                    break
+                retry_after = req.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    wait = max(wait, float(retry_after))
+            except requests.RequestException as e:
+                print(" !  Request failed: %s (%s)" % (url, e))
+                status, text = -1, ""
+
+            if attempt < self.max_retries:
+                print(" !  Retry %d/%d in %.1fs: %s" % (attempt + 1, self.max_retries, wait, url))
+                time.sleep(wait)
+        return status, text
+
+    def get_all(self, urls, headers=None):
+        """
+        Yield (url, status, text) in the order of `urls`, while later urls are already being fetched.
+        :param urls:
+        :param headers:
+        :return:
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = [executor.submit(self.get, url, headers) for url in urls]
+            for url, fut in zip(urls, futures):
+                status, text = fut.result()
+                yield url, status, text
+
+    def close(self):
+        self.session.close()
+
+
+class ScopusQuotaBudget:
+    """
+    Keeps the remaining weekly quota of each API key across runs (in a json file next to the pybliometrics cache),
+    and decides which ids a run may fetch within a maximum spend. Ids that do not fit go to a backlog on disk, one per
+    group of papers, which a later run can resume with `load_backlog(group)`.
+    """
+
+    FILE_NAME = "my_quota_budget.json"
+
+    def __init__(self, max_spend=None, path=None):
+        """
+        :param max_spend: max number of Scopus requests this run may use, None for no limit other than the quota
+        :param path:
+        """
+        assert max_spend is None or max_spend >= 0
+        self.max_spend = max_spend
+        self.path = path or os.path.join(BASE_PATH, self.FILE_NAME)
+        self.spent = 0
+        self.dirty = False
+        self.dat = {"keys": dict(), "backlogs": dict()}  # backlogs: group name ("" for none): list of ids
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.dat.update(json.load(f))
+            except (OSError, ValueError) as e:
+                print(" !  Ignoring unreadable quota budget file %s: %s" % (self.path, e))
+        if "backlog" in self.dat:  # single backlog of earlier versions
+            self.dat["backlogs"].setdefault("", self.dat.pop("backlog"))
+
+    @staticmethod
+    def key_id():
+        """
+        Short hash of the API key in use, so that the key itself is not written to disk.
+        """
+        load_scopus()
+        return hashlib.sha1(get_keys()[0].encode()).hexdigest()[:12]
+
+    def remaining(self):
+        """
+        Last known remaining quota of the current key, or None if unknown or already reset.
+        """
+        rec = self.dat["keys"].get(self.key_id())
+        if not rec or rec.get("remaining") is None:
+            return None
+        if rec.get("reset") and rec["reset"] <= datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'):
+            return None
+        return rec["remaining"]
+
+    def allowance(self):
+        """
+        Number of requests left for this run.
+        """
+        left = [x for x in (self.remaining(), None if self.max_spend is None else self.max_spend - self.spent)
+                if x is not None]
+        return min(left) if left else None
+
+    def charge(self, n_requests, quota_rem=None, reset_time=None):
+        """
+        Record the requests actually sent.
+        :param n_requests:
+        :param quota_rem: X-RateLimit-Remaining reported by the last request, if any
+        :param reset_time: X-RateLimit-Reset reported by the last request, if any
+        :return:
+        """
+        self.spent += n_requests
+        if not n_requests and quota_rem is None and not reset_time:  # cache hits
+            return
+        self.dirty = True
+        rec = self.dat["keys"].setdefault(self.key_id(), dict())
+        if quota_rem is not None and str(quota_rem).isdigit():
+            rec["remaining"] = int(quota_rem)
+        elif rec.get("remaining") is not None:
+            rec["remaining"] = max(0, rec["remaining"] - n_requests)
+        if reset_time:
+            rec["reset"] = reset_time
+        rec["updated"] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    @staticmethod
+    def estimate_cost(iid, refresh_days):
+        """
+        Number of requests needed to retrieve both views of an id, 0 if both are in the cache and fresh enough.
+        The REF view costs one request per page of SCOPUS_REFS_PER_PAGE references.
+        """
+        cost = 0 if CitationGraph.is_scopus_cached(iid, 'FULL', refresh_days) else 1
+        if not CitationGraph.is_scopus_cached(iid, 'REF', refresh_days):
+            cost += ScopusQuotaBudget.estimate_ref_pages(iid)
+        return cost
+
+    @staticmethod
+    def estimate_ref_pages(iid):
+        """
+        Pages of the REF view of an id, from the reference count of its cached FULL view (whatever its age), else
+        SCOPUS_REF_PAGES_UNKNOWN.
+        """
+        if os.path.isfile(CitationGraph.scopus_cache_path(iid, 'FULL')):
+            try:
+                refcount = AbstractRetrieval(iid, view='FULL', refresh=False).refcount
+            except Exception:
+                refcount = None
+            if refcount is not None and str(refcount).isdigit():
+                return max(1, math.ceil(int(refcount) / SCOPUS_REFS_PER_PAGE))
+        return SCOPUS_REF_PAGES_UNKNOWN
+
+    @staticmethod
+    def staleness(iid):
+        """
+        Sort key of an id by value: uncached first, then the stalest cache.
+        """
+        stamps = []
+        for view in ('FULL', 'REF'):
+            try:
+                stamps.append(os.stat(CitationGraph.scopus_cache_path(iid, view)).st_mtime)
+            except FileNotFoundError:
+                return 0, 0.
+        return 1, min(stamps)
+
+    def plan(self, refresh_days):
+        """
+        Split the ids into the ones to retrieve in this run, in order of value, and the backlog.
+        :param refresh_days: dict of id: refresh days of its retrieval
+        :return: (list of ids to retrieve, list of deferred ids)
+        """
+        allowance = self.allowance()
+        ordered = sorted(refresh_days, key=self.staleness)
+        to_run, backlog = [], []
+        reserved = 0
+        for iid in ordered:
+            cost = self.estimate_cost(iid, refresh_days[iid])
+            if cost and allowance is not None and reserved + cost > allowance:
+                backlog.append(iid)
+                continue
+            reserved += cost
+            to_run.append(iid)
+        if backlog:
+            print("[!] Quota budget: %d requests planned, %d ids deferred to the backlog." % (reserved, len(backlog)))
+        return to_run, backlog
+
+    def save(self, backlog=(), done=(), group=None):
+        """
+        Merge this run into the backlog of its group, and write the file if anything changed. Runs of other groups,
+        or that defer nothing, leave the backlog of a group alone.
+        :param backlog: ids deferred by this run, added to the backlog
+        :param done: ids this run is done with, taken out of the backlog
+        :param group: name of the backlog, e.g. the group of the CitationGraph, None for the default one
+        :return:
+        """
+        key = group or ""
+        old = self.dat["backlogs"].get(key, [])
+        done = set(done) - set(backlog)
+        new = [iid for iid in old if iid not in done]
+        kept = set(new)
+        new += [iid for iid in backlog if iid not in kept]
+        if new != old:
+            if new:
+                self.dat["backlogs"][key] = new
+            else:
+                del self.dat["backlogs"][key]
+            self.dirty = True
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.dat, f, indent=1)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def load_backlog(self, group=None):
+        return list(self.dat["backlogs"].get(group or "", []))
+
+
+class CitedBySearch:
+    """
+    Forward citations (the papers citing a paper) from the Scopus Search API, with REFEID queries.
+    Every result page is cached on disk for `max_age` days, and the pages of all the queries are fetched in parallel
+    under the API rate limit. The merged list of each paper is kept as well, so that a later run can ask only for
+    the papers loaded into Scopus since (ORIG-LOAD-DATE), see cited_by.
+    """
+
+    API_URL = "https://api.elsevier.com/content/search/scopus"
+    DIR_NAME = "my_cited_by_cache"
+    PAGE_SIZES = {True: 200, False: 25}  # per page of the STANDARD view, with or without a subscription, as in
+    # pybliometrics' ScopusSearch
+    MAX_RESULTS = 5000  # deeper results need a cursor, use since_last_run instead
+    FIELDS = "dc:identifier,dc:title,dc:creator,prism:publicationName,prism:coverDate,prism:doi,citedby-count"
+
+    def __init__(self, cache_dir, max_age=30, offline=False, num_workers=4, max_requests=None, api_url=None,
+                 subscriber=True):
+        """
+        :param cache_dir:
+        :param max_age: days a cached page is used for
+        :param offline: only use the cache, whatever its age
+        :param num_workers: pages fetched at a time
+        :param max_requests: maximum number of requests sent, None for no limit
+        :param api_url: API_URL by default
+        :param subscriber: whether the API key comes with a Scopus subscription, which allows larger pages
+        """
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.offline = offline
+        self.num_workers = num_workers
+        self.max_requests = max_requests
+        self.api_url = api_url or self.API_URL
+        self.page_size = self.PAGE_SIZES[bool(subscriber)]
+        self.n_requests = 0
+        self._lock = threading.Lock()
+        self._fetcher = None
+
+    @property
+    def fetcher(self):
+        if self._fetcher is None:
+            bucket = TokenBucket(rate=SCOPUS_REQ_PER_SEC, capacity=SCOPUS_REQ_PER_SEC)
+            self._fetcher = PooledHttpFetcher(self.num_workers, max_per_host=self.num_workers, bucket=bucket)
+        return self._fetcher
+
+    def page_path(self, query, start):
+        digest = hashlib.sha1(("%s|%d" % (query, self.page_size)).encode()).hexdigest()
+        return os.path.join(self.cache_dir, "pages", "%s_%d.json" % (digest, start))
+
+    def record_path(self, eid):
+        return os.path.join(self.cache_dir, "%s.json" % eid)
+
+    def read_page(self, query, start):
+        path = self.page_path(query, start)
+        try:
+            if not self.offline and time.time() - os.path.getmtime(path) > self.max_age * 86400:
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def fetch_page(self, query, start):
+        """
+        :return: cached page {"fetched": yyyymmdd, "data": search-results}, None if not available
+        """
+        page = self.read_page(query, start)
+        if page is not None:
+            metrics.inc("scopus_search_pages_total", outcome="cache_hit")
+            return page
+        with self._lock:
+            if self.offline or (self.max_requests is not None and self.n_requests >= self.max_requests):
+                metrics.inc("scopus_search_pages_total", outcome="offline_miss" if self.offline else "over_budget")
+                return None
+            self.n_requests += 1
+
+        load_scopus()
+        url = "%s?%s" % (self.api_url, urllib.parse.urlencode(
+            {"query": query, "start": start, "count": self.page_size, "view": "STANDARD", "field": self.FIELDS}))
+        t0 = time.perf_counter()
+        status, text = self.fetcher.get(url, headers={"X-ELS-APIKey": get_keys()[0], "Accept": "application/json"})
+        metrics.observe("scopus_search_seconds", time.perf_counter() - t0)
+        if status != 200:
+            print(" !  Search failed (%d): %s" % (status, query))
+            metrics.inc("scopus_search_pages_total", outcome="error")
+            return None
+        metrics.inc("scopus_search_pages_total", outcome="fetched")
+
+        page = {"fetched": datetime.date.today().strftime("%Y%m%d"), "data": json.loads(text)["search-results"]}
+        path = self.page_path(query, start)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(page, f)
+        os.replace(path + ".tmp", path)
+        return page
+
+    @staticmethod
+    def parse_entries(page):
+        """
+        :return: list of RefRow, positions not set
+        """
+        ret = []
+        for e in page["data"].get("entry", []):
+            if "error" in e:  # "Result set was empty"
+                continue
+            sid = e.get("dc:identifier", "").replace("SCOPUS_ID:", "")
+            ret.append(RefRow(None, sid or None, e.get("prism:doi"), e.get("dc:title"), e.get("dc:creator"), None,
+                              e.get("prism:publicationName"), e.get("prism:coverDate"), e.get("citedby-count")))
+        return ret
+
+    @staticmethod
+    def entry_key(row):
+        return row.id or row.doi or row.title
+
+    def fetch_all(self, queries):
+        """
+        All the result pages of many queries: the first pages in parallel, then the rest in parallel.
+        :param queries:
+        :return: dict of query: (list of RefRow, oldest fetch date yyyymmdd), for the queries with all pages available
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            first = dict(zip(queries, executor.map(lambda q: self.fetch_page(q, 0), queries)))
+            starts = dict()  # of the pages after the first one
+            for query, page in first.items():
+                if page is None:
+                    continue
+                total = int(page["data"].get("opensearch:totalResults", 0))
+                if total > self.MAX_RESULTS:
+                    print(" !  %d results, only the first %d are retrieved: %s" % (total, self.MAX_RESULTS, query))
+                starts[query] = range(self.page_size, min(total, self.MAX_RESULTS), self.page_size)
+            rest = [(query, start) for query, lst in starts.items() for start in lst]
+            pages = dict(zip(rest, executor.map(lambda qs: self.fetch_page(*qs), rest)))
+
+        ret = dict()
+        for query, lst in starts.items():
+            parts = [first[query]] + [pages[(query, start)] for start in lst]
+            if None not in parts:
+                ret[query] = ([row for part in parts for row in self.parse_entries(part)],
+                              min(part["fetched"] for part in parts))
+        return ret
+
+    def load_record(self, eid):
+        try:
+            with open(self.record_path(eid), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_record(self, eid, rec):
+        path = self.record_path(eid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(rec, f)
+        os.replace(path + ".tmp", path)
+
+    def cited_by(self, eids, since_last_run=False):
+        """
+        :param eids: eids of the cited papers, e.g. "2-s2.0-85123456789"
+        :param since_last_run: for the papers searched before, only ask for the citing papers loaded since then and
+            add them to the known ones
+        :return: dict of eid: list of RefRow of the citing papers, numbered from 1. The last known list, if any, when
+            the search failed or is not cached in offline mode.
+        """
+        records = {eid: self.load_record(eid) for eid in eids}
+        queries = dict()
+        for eid, rec in records.items():
+            query = "REFEID(%s)" % eid
+            if since_last_run and rec:
+                since = datetime.datetime.strptime(rec["updated"], "%Y%m%d") - datetime.timedelta(days=1)
+                query += " AND ORIG-LOAD-DATE AFT %s" % since.strftime("%Y%m%d")
+            queries[eid] = query
+        results = self.fetch_all(sorted(set(queries.values())))
+
+        ret = dict()
+        for eid, query in queries.items():
+            rec = records[eid]
+            if query in results:
+                rows, fetched = results[query]
+                if since_last_run and rec:
+                    known = {self.entry_key(row) for row in map(RefRow._make, rec["entries"])}
+                    rows = [RefRow(*row) for row in rec["entries"]] + \
+                        [row for row in rows if self.entry_key(row) not in known]
+                rows = [row._replace(position=str(k + 1)) for k, row in enumerate(rows)]
+                rec = {"updated": fetched, "entries": [list(row) for row in rows]}
+                self.save_record(eid, rec)
+            if rec:
+                ret[eid] = [RefRow(*row) for row in rec["entries"]]
+        return ret
+
+    def close(self):
+        if self._fetcher is not None:
+            self._fetcher.close()
+            self._fetcher = None
+
+
+class VenueAbbreviator:
+    """
+    Abbreviation of venue names, e.g. "IEEE Transactions on Robotics" -> "IEEE Trans. on Robot.".
+    The rules are (regex, replacement) pairs, compiled into one alternation that is applied in a single pass, earlier
+    rules winning at the same position. Replacements are literal. Since the same few hundred venues come up again and
+    again, results are memoized in a bounded LRU cache keyed by the raw venue name.
+    Unlike a chain of re.sub calls, a rule does not see the output of the other ones. The default rules give the same
+    result as the chain did, except for words run together such as "ComputerScience".
+    """
+    DEFAULT_RULES = [
+        ("Transactions", "Trans."),
+        ("International", "Int."),
+        ("Journal", "J."),
+        (r"Robot[ics]*?\s(?:\- )?", "Robot. "),
+        ("Research", "Res."),
+        ("Proceedings?", "Proc."),
+        ("Conferences?", "Conf."),
+        ("Intelligen(t|ce)", "Intell."),
+        (r"Systems?", "Syst."),
+        ("Science", "Sci."),
+        ("Automation", "Autom."),
+        ("Letters?", "Lett."),
+        (r" \- ", " "),
+        (r"Comput\w+?(?: \- |\s)", "Comput. "),
+        (r"Europ\w+?(?: \- |\s)", "Eur. ")
+    ]
+
+    def __init__(self, rules=None, memo_size=4096):
+        self.configure(self.DEFAULT_RULES if rules is None else rules, replace=True, memo_size=memo_size)
+
+    def configure(self, rules, replace=False, memo_size=None):
+        """
+        :param rules: list of (regex, replacement), e.g. ISO 4 word abbreviations from the config file
+        :param replace: drop the current rules, otherwise the new ones take precedence over them
+        :param memo_size: entries of the LRU memo, unchanged if None
+        :return:
+        """
+        rules = [(str(p), str(r)) for p, r in rules]
+        self.rules = rules if replace else rules + [r for r in self.rules if r not in rules]
+        self._repl = {"r%d" % k: r for k, (_, r) in enumerate(self.rules)}
+        self._pattern = re.compile("|".join("(?P<r%d>%s)" % (k, p) for k, (p, _) in enumerate(self.rules))) \
+            if self.rules else None
+        if memo_size is not None:
+            self.memo_size = memo_size
+        self.abbreviate = functools.lru_cache(maxsize=self.memo_size)(self._abbreviate)
+
+    def _abbreviate(self, src):
+        src += " "
+        if self._pattern is not None:
+            src = self._pattern.sub(lambda m: self._repl[m.lastgroup], src)
+        return src.strip()
+
+    def __call__(self, src):
+        return self.abbreviate(src)
+
+
+venue_abbreviator = VenueAbbreviator()
+
+
+class StringTable:
+    """
+    Interned strings, referred to by integer ids. -1 stands for None or the empty string.
+    """
+
+    def __init__(self):
+        self.strings = []
+        self._ids = dict()
+
+    def add(self, s):
+        if s is None or s == "":
+            return -1
+        s = str(s)
+        sid = self._ids.get(s)
+        if sid is None:
+            sid = len(self.strings)
+            self._ids[s] = sid
+            self.strings.append(s)
+        return sid
+
+    def get(self, sid):
+        return None if sid < 0 else self.strings[sid]
+
+    def find(self, s):
+        return self._ids.get(s, -1)
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class ReferenceStore:
+    """
+    Array-backed store of the references of the input papers.
+
+    Each distinct reference is a node with integer id, whose metadata are columns of integers pointing into interned
+    string tables. References without scopus id cannot be matched, so each occurrence of them is a node of its own.
+    The citing->cited adjacency is in CSR form, one row per input paper (in input order, empty for failed ones):
+    the references of paper i are nodes indices[indptr[i]: indptr[i + 1]], at positions positions[...].
+    """
+
+    Row = RefRow
+
+    def __init__(self):
+        self.ids = StringTable()  # scopus ids
+        self.dois = StringTable()
+        self.titles = StringTable()
+        self.authors = StringTable()  # "A.; B.; C." strings, as in the REF view
+        self.auids = StringTable()
+        self.venues = StringTable()
+
+        # node columns
+        self.node_id = array.array('l')
+        self.node_doi = array.array('l')
+        self.node_title = array.array('l')
+        self.node_authors = array.array('l')
+        self.node_auids = array.array('l')
+        self.node_venue = array.array('l')
+        self.node_year = array.array('h')  # 0 if unknown
+        self.node_citedby = array.array('l')  # -1 if unknown
+        self.node_of_id = dict()  # index into self.ids: node
+
+        # CSR citing -> cited
+        self.indptr = array.array('l', [0])
+        self.indices = array.array('l')
+        self.positions = array.array('l')
+
+        self._cited = None  # cached transpose, see cited_by()
+
+    @property
+    def num_nodes(self):
+        return len(self.node_id)
+
+    @property
+    def num_rows(self):
+        return len(self.indptr) - 1
+
+    def add_node(self, ref):
+        """
+        Node of a reference, created if not seen before.
+        :param ref: pybliometrics Reference, or anything with the same fields
+        :return:
+        """
+        sid = self.ids.add(ref.id)
+        if sid >= 0 and sid in self.node_of_id:
+            return self.node_of_id[sid]
+
+        node = len(self.node_id)
+        if sid >= 0:
+            self.node_of_id[sid] = node
+        self.node_id.append(sid)
+        self.node_doi.append(self.dois.add(ref.doi))
+        self.node_title.append(self.titles.add(ref.title))
+        self.node_authors.append(self.authors.add(ref.authors))
+        self.node_auids.append(self.auids.add(ref.authors_auid))
+        self.node_venue.append(self.venues.add(ref.sourcetitle))
+        year = str(ref.coverDate or "")[:4]
+        self.node_year.append(int(year) if year.isdigit() else 0)
+        citedby = str(ref.citedbycount)
+        self.node_citedby.append(int(citedby) if citedby.isdigit() else -1)
+        return node
+
+    def add_paper(self, refs):
+        """
+        Append the reference list of the next input paper as a new row.
+        :param refs: list of pybliometrics Reference, empty for a failed paper
+        :return: PaperRefs view of the new row
+        """
+        for ref in refs:
+            self.indices.append(self.add_node(ref))
+            pos = str(ref.position)
+            self.positions.append(int(pos) if pos.isdigit() else -1)
+        self.indptr.append(len(self.indices))
+        self._cited = None
+        return PaperRefs(self, self.num_rows - 1)
+
+    def node_sid(self, node):
+        """
+        Scopus id of a node, or None.
+        """
+        return self.ids.get(self.node_id[node])
+
+    def node_row(self, node, position=None):
+        """
+        Materialize a node into a namedtuple with the field names of pybliometrics Reference.
+        """
+        year = self.node_year[node]
+        citedby = self.node_citedby[node]
+        return self.Row(position, self.ids.get(self.node_id[node]), self.dois.get(self.node_doi[node]),
+                        self.titles.get(self.node_title[node]), self.authors.get(self.node_authors[node]),
+                        self.auids.get(self.node_auids[node]), self.venues.get(self.node_venue[node]),
+                        str(year) if year else None, citedby if citedby >= 0 else None)
+
+    def cited_by(self):
+        """
+        Transpose of the adjacency (cited -> citing), computed once per change of the graph.
+        :return: (indptr, rows, positions) in CSR form, one row per node
+        """
+        if self._cited is None:
+            n = self.num_nodes
+            counts = array.array('l', bytes(array.array('l').itemsize * (n + 1)))
+            for node in self.indices:
+                counts[node + 1] += 1
+            for node in range(n):
+                counts[node + 1] += counts[node]
+            indptr = array.array('l', counts)
+            rows = array.array('l', bytes(array.array('l').itemsize * len(self.indices)))
+            positions = array.array('l', rows)
+            fill = counts  # insertion cursor of each node
+            for row in range(self.num_rows):
+                for e in range(self.indptr[row], self.indptr[row + 1]):
+                    node = self.indices[e]
+                    rows[fill[node]] = row
+                    positions[fill[node]] = self.positions[e]
+                    fill[node] += 1
+            self._cited = (indptr, rows, positions)
+        return self._cited
+
+    def in_degree(self, node):
+        indptr = self.cited_by()[0]
+        return indptr[node + 1] - indptr[node]
+
+    def remove_rows(self, rows):
+        """
+        Drop the reference lists of some input papers, the later rows move up. Nodes stay, possibly uncited.
+        :param rows: iterable of row indices
+        :return:
+        """
+        rows = set(rows)
+        indptr = array.array('l', [0])
+        indices = array.array('l')
+        positions = array.array('l')
+        for row in range(self.num_rows):
+            if row in rows:
+                continue
+            lo, hi = self.indptr[row], self.indptr[row + 1]
+            indices.extend(self.indices[lo: hi])
+            positions.extend(self.positions[lo: hi])
+            indptr.append(len(indices))
+        self.indptr, self.indices, self.positions = indptr, indices, positions
+        self._cited = None
+
+    def merge_nodes(self, canon):
+        """
+        Redirect the citations of duplicate nodes to their canonical node. The duplicates stay, uncited.
+        A paper citing several variants of the same work keeps one citation of it, at the first position.
+        :param canon: sequence, canonical node of each node (itself if not a duplicate)
+        :return: (number of redirected citations, number of them dropped as repeated within a paper)
+        """
+        assert len(canon) == self.num_nodes
+        num = dropped = 0
+        indptr = array.array('l', [0])
+        indices = array.array('l')
+        positions = array.array('l')
+        for row in range(self.num_rows):
+            seen, merged = set(), set()  # targets of the row, the ones reached through a merge
+            for e in range(self.indptr[row], self.indptr[row + 1]):
+                node = self.indices[e]
+                target = canon[node]
+                if target != node:
+                    num += 1
+                if target in seen and (target != node or target in merged):
+                    dropped += 1
+                    continue
+                if target != node:
+                    merged.add(target)
+                seen.add(target)
+                indices.append(target)
+                positions.append(self.positions[e])
+            indptr.append(len(indices))
+        if num:
+            self.indptr, self.indices, self.positions = indptr, indices, positions
+            self._cited = None
+        return num, dropped
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_cited"] = None  # cheap to rebuild
+        return state
+
+    def adjacency_matrix(self):
+        """
+        Binary citing->cited matrix (input papers x nodes), a paper citing the same node twice counts once.
+        Needs scipy.
+        :return: scipy.sparse.csr_matrix
+        """
+        import numpy as np
+        import scipy.sparse as sp
+
+        indptr = np.frombuffer(self.indptr, dtype=self.indptr.typecode) if self.indptr else np.zeros(1, np.int64)
+        indices = np.frombuffer(self.indices, dtype=self.indices.typecode) if self.indices else np.zeros(0, np.int64)
+        mat = sp.csr_matrix((np.ones(len(indices), dtype=np.float64), indices, indptr),
+                            shape=(self.num_rows, self.num_nodes))
+        mat.sum_duplicates()
+        mat.data[:] = 1.
+        return mat
+
+    @staticmethod
+    def top_k_per_row(mat, k, min_val=1):
+        """
+        The k largest off-diagonal entries of each row of a square sparse matrix.
+        :param mat: scipy.sparse matrix
+        :param k:
+        :param min_val: entries below are dropped
+        :return: dict of row: list of (col, value), by decreasing value
+        """
+        import numpy as np
+
+        mat = mat.tocsr()
+        mat.setdiag(0)
+        mat.eliminate_zeros()
+        ret = dict()
+        for r in range(mat.shape[0]):
+            lo, hi = mat.indptr[r], mat.indptr[r + 1]
+            if lo == hi:
+                continue
+            vals = mat.data[lo: hi]
+            cols = mat.indices[lo: hi]
+            keep = vals >= min_val
+            vals, cols = vals[keep], cols[keep]
+            if not len(vals):
+                continue
+            if len(vals) > k:
+                sel = np.argpartition(-vals, k - 1)[:k]
+                vals, cols = vals[sel], cols[sel]
+            order = np.lexsort((cols, -vals))
+            ret[r] = [(int(cols[j]), int(vals[j])) for j in order]
+        return ret
+
+
+class ReferenceDeduplicator:
+    """
+    Find references that are the same work cited with slightly different titles, mostly the ones Scopus could not
+    resolve to an id. Candidates are blocked by MinHash/LSH over character 3-grams of the normalized titles, so the
+    cost grows with the number of references instead of the number of pairs, then verified with the exact Jaccard
+    similarity of the 3-grams, a compatible year (+-1) and the same first author surname when both are known.
+    Two nodes with different scopus ids are never merged, unless merge_ids.
+    """
+
+    def __init__(self, threshold=0.7, num_perm=32, bands=8, max_bucket=50, merge_ids=False):
+        """
+        :param threshold: min Jaccard similarity of the title 3-grams
+        :param num_perm: MinHash signature length
+        :param bands: LSH bands, of num_perm // bands rows each. More bands find more candidates at lower similarity.
+        :param max_bucket: LSH buckets larger than this are skipped, they come from boilerplate titles
+        :param merge_ids: also merge references with different scopus ids (duplicate Scopus records)
+        """
+        assert num_perm % bands == 0
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.max_bucket = max_bucket
+        self.merge_ids = merge_ids
+
+    @staticmethod
+    def first_author(authors):
+        """
+        "Doe J.; Roe R." -> "doe"
+        """
+        if not authors:
+            return ""
+        words = re.sub(r"[^\w]+", " ", authors.split(";")[0].lower()).split()
+        return words[0] if words else ""
+
+    @staticmethod
+    def shingles(title):
+        return {title[i: i + 3] for i in range(len(title) - 2)}
+
+    def signatures(self, titles, chunk=20000):
+        """
+        MinHash signatures of the 3-grams of each title, vectorized over chunks of titles.
+        :param titles: normalized titles, at least 3 characters long
+        :param chunk:
+        :return: numpy uint64 array of shape (len(titles), num_perm)
+        """
+        import numpy as np
+
+        rng = np.random.RandomState(7)
+        seeds = rng.randint(1, 2 ** 62, size=self.num_perm, dtype=np.int64).astype(np.uint64)
+        mult = np.uint64(0x9E3779B97F4A7C15)
+        sigs = np.empty((len(titles), self.num_perm), dtype=np.uint64)
+        for lo in range(0, len(titles), chunk):
+            codes, offsets = [], []
+            num = 0
+            for title in titles[lo: lo + chunk]:
+                c = np.frombuffer(title.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+                codes.append((c[:-2] << np.uint64(42)) ^ (c[1:-1] << np.uint64(21)) ^ c[2:])
+                offsets.append(num)
+                num += len(c) - 2
+            sh = np.concatenate(codes)
+            offsets = np.asarray(offsets)
+            with np.errstate(over="ignore"):
+                for p in range(self.num_perm):
+                    h = (sh ^ seeds[p]) * mult
+                    h ^= h >> np.uint64(29)
+                    sigs[lo: lo + len(offsets), p] = np.minimum.reduceat(h, offsets)
+        return sigs
+
+    def find_duplicates(self, store, nodes=None):
+        """
+        :param store: ReferenceStore
+        :param nodes: the nodes to consider, by default the cited ones
+        :return: list, canonical node of each node of the store (itself if not a duplicate)
+        """
+        if nodes is None:
+            cited_indptr = store.cited_by()[0]
+            nodes = [n for n in range(store.num_nodes) if cited_indptr[n + 1] > cited_indptr[n]]
+
+        parent = list(range(store.num_nodes))
+        root_sid = {n: store.node_id[n] for n in nodes}  # the scopus id of each group, -1 if none
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        def union(a, b):
+            ra, rb = find(a), find(b)
+            if ra == rb:
+                return False
+            sa, sb = root_sid[ra], root_sid[rb]
+            if sa >= 0 and sb >= 0 and sa != sb and not self.merge_ids:
+                return False
+            if sb >= 0 and sa < 0 or (sa < 0) == (sb < 0) and rb < ra:
+                ra, rb = rb, ra  # the root is the node with an id, else the first one
+            parent[rb] = ra
+            root_sid[ra] = sa if sa >= 0 else sb
+            return True
+
+        def compatible(a, b):
+            ya, yb = store.node_year[a], store.node_year[b]
+            if ya and yb and abs(ya - yb) > 1:
+                return False
+            fa, fb = first_au[a], first_au[b]
+            return not fa or not fb or fa == fb
+
+        titles = dict()
+        first_au = dict()
+        for n in nodes:
+            titles[n] = ObsidianVaultIndex.normalize_title(store.titles.get(store.node_title[n]))
+            first_au[n] = self.first_author(store.authors.get(store.node_authors[n]))
+
+        # exact normalized titles need no hashing
+        by_title = dict()
+        for n in nodes:
+            if titles[n]:
+                by_title.setdefault(titles[n], []).append(n)
+        for group in by_title.values():
+            for n in group[1:]:
+                if compatible(group[0], n):
+                    union(group[0], n)
+
+        # fuzzy: one representative per exact title
+        reps = [group[0] for title, group in by_title.items() if len(title) >= 3]
+        if len(reps) > 1:
+            sigs = self.signatures([titles[n] for n in reps])
+            rows = self.num_perm // self.bands
+            candidates = set()
+            for b in range(self.bands):
+                buckets = dict()
+                band = sigs[:, b * rows: (b + 1) * rows]
+                for i in range(len(reps)):
+                    buckets.setdefault(band[i].tobytes(), []).append(i)
+                for bucket in buckets.values():
+                    if 1 < len(bucket) <= self.max_bucket:
+                        for x in range(len(bucket)):
+                            for y in range(x + 1, len(bucket)):
+                                candidates.add((bucket[x], bucket[y]))
+
+            shingles = dict()
+            for i, j in sorted(candidates):
+                a, b = reps[i], reps[j]
+                if not compatible(a, b):
+                    continue
+                sa = shingles.get(a) or shingles.setdefault(a, self.shingles(titles[a]))
+                sb = shingles.get(b) or shingles.setdefault(b, self.shingles(titles[b]))
+                if len(sa & sb) >= self.threshold * len(sa | sb):
+                    union(a, b)
+
+        return [find(n) for n in range(store.num_nodes)]
+
+
+class PaperRefs:
+    """
+    Reference list of one input paper, a read-only sequence view into a ReferenceStore.
+    """
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def __len__(self):
+        return self.store.indptr[self.row + 1] - self.store.indptr[self.row]
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[j] for j in range(*k.indices(len(self)))]
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError(k)
+        e = self.store.indptr[self.row] + k
+        return self.store.node_row(self.store.indices[e], self.store.positions[e])
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def nodes(self):
+        return self.store.indices[self.store.indptr[self.row]: self.store.indptr[self.row + 1]]
+
+
+class BibliographyCache:
+    """
+    Parsed reference lists of many papers in one SQLite file, for offline reuse without the pybliometrics cache.
+    Columns are matched by name, so a change of the pybliometrics Reference fields adds columns instead of
+    invalidating the cache. Reads go through a memory map of the database file.
+    """
+
+    SCHEMA_VERSION = 1
+    FILE_NAME = "my_parsed_bib_cache.sqlite"
+    MMAP_SIZE = 1 << 30
+
+    def __init__(self, path, ref_tup):
+        """
+        :param path:
+        :param ref_tup: namedtuple class of the references, its fields are the columns
+        """
+        self.path = path
+        self.ref_tup = ref_tup
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("PRAGMA mmap_size = %d" % self.MMAP_SIZE)
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version == 0:
+                self._create()
+            elif version != self.SCHEMA_VERSION:
+                raise RuntimeError("Unknown bibliography cache schema version %d: %s" % (version, self.path))
+        return self._conn
+
+    def _create(self):
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS papers (q_id TEXT PRIMARY KEY, saved TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS refs (q_id TEXT NOT NULL, ord INTEGER NOT NULL, "
+                               "PRIMARY KEY (q_id, ord)) WITHOUT ROWID")
+            self._conn.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+
+    def columns(self):
+        return [row[1] for row in self.conn.execute("PRAGMA table_info(refs)")][2:]
+
+    def _ensure_columns(self, fields):
+        existing = set(self.columns())
+        for field in fields:
+            if field not in existing:
+                self.conn.execute('ALTER TABLE refs ADD COLUMN "%s"' % field)
+
+    def save_many(self, bibs):
+        """
+        :param bibs: dict of q_id: list of references, replacing what is cached for the q_id
+        :return:
+        """
+        bibs = {k: v for k, v in bibs.items() if v}
+        if not bibs:
+            return
+        fields = list(next(iter(bibs.values()))[0]._fields)
+        stamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.conn:
+            self._ensure_columns(fields)
+            sql = 'INSERT INTO refs (q_id, ord, %s) VALUES (?, ?, %s)' % (
+                ", ".join('"%s"' % f for f in fields), ", ".join("?" * len(fields)))
+            for q_id, ref_lst in bibs.items():
+                self.conn.execute("DELETE FROM refs WHERE q_id = ?", (q_id,))
+                self.conn.executemany(sql, ((q_id, k) + tuple(ref) for k, ref in enumerate(ref_lst)))
+                self.conn.execute("INSERT OR REPLACE INTO papers VALUES (?, ?)", (q_id, stamp))
+
+    def load_many(self, q_ids, chunk=500):
+        """
+        Bulk load the reference lists of many papers.
+        :param q_ids:
+        :param chunk: number of q_ids per SQL query
+        :return: dict of q_id: list of ref_tup, for the q_ids in the cache
+        """
+        fields = self.ref_tup._fields
+        cols = set(self.columns())
+        select = ", ".join('"%s"' % f if f in cols else "NULL" for f in fields)  # fields not cached yet are None
+
+        ret = dict()
+        q_ids = list(q_ids)
+        for c in range(0, len(q_ids), chunk):
+            part = q_ids[c: c + chunk]
+            sql = ("SELECT q_id, %s FROM refs WHERE q_id IN (%s) ORDER BY q_id, ord"
+                   % (select, ",".join("?" * len(part))))
+            for row in self.conn.execute(sql, part):
+                ret.setdefault(row[0], []).append(self.ref_tup(*row[1:]))
+        return ret
+
+    def cached_ids(self):
+        return [row[0] for row in self.conn.execute("SELECT q_id FROM papers ORDER BY q_id")]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+SearchHit = namedtuple('SearchHit', 'q_id paper_title position scopus_id doi title authors venue year score')
+
+
+class ReferenceSearchIndex:
+    """
+    On-disk full-text index (SQLite FTS5) of the titles, authors, venues and years of every reference list seen, so
+    that the papers citing something can be found without a new run. A paper is reindexed only when its reference
+    list changed, which is detected with a digest. Queries use the FTS5 syntax: keywords, "quoted phrases",
+    prefix*, column filters such as authors:Smith, AND/OR/NOT; results are ranked by bm25.
+    """
+
+    SCHEMA_VERSION = 1
+    FILE_NAME = "my_reference_index.sqlite"
+    COLUMNS = ("title", "authors", "venue", "year")
+    WEIGHTS = (10., 5., 2., 1.)  # bm25 weights of COLUMNS
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version == 0:
+                self._create()
+            elif version != self.SCHEMA_VERSION:
+                raise RuntimeError("Unknown reference index schema version %d: %s" % (version, self.path))
+        return self._conn
+
+    def _create(self):
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS papers (q_id TEXT PRIMARY KEY, title TEXT, digest TEXT, "
+                               "indexed TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS refs (id INTEGER PRIMARY KEY, q_id TEXT NOT NULL, "
+                               "position INTEGER, scopus_id TEXT, doi TEXT, title TEXT, authors TEXT, venue TEXT, "
+                               "year TEXT)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS refs_q_id ON refs (q_id)")
+            # external content table, kept in sync by add_many (row triggers would make bulk inserts ~5x slower)
+            self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS refs_fts USING fts5(title, authors, venue, year, "
+                               "content='refs', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+            self._conn.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+
+    @staticmethod
+    def ref_values(ref):
+        """
+        Indexed values of a pybliometrics Reference, or anything with the same fields.
+        """
+        pos = str(ref.position)
+        year = str(ref.coverDate or getattr(ref, "publicationyear", None) or "")[:4]
+        return (int(pos) if pos.isdigit() else None, ref.id or None, ref.doi or None, ref.title or None,
+                ref.authors or None, ref.sourcetitle or None, year or None)
+
+    def add_many(self, papers):
+        """
+        Index the reference lists of many papers in one transaction, replacing their previous reference lists.
+        :param papers: iterable of (q_id, title of the citing paper or None to keep the known one, list of references)
+        :return: number of papers (re)indexed
+        """
+        stamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with metrics.timer("search_index_update_seconds"), self.conn:
+            known = {q_id: (digest, title) for q_id, digest, title in
+                     self.conn.execute("SELECT q_id, digest, title FROM papers")}
+            changed, retitled = [], []
+            for q_id, title, refs in papers:
+                rows = [self.ref_values(ref) for ref in refs]
+                digest = hashlib.sha1(json.dumps(rows).encode("utf-8")).hexdigest()  # the title is not indexed
+                old_digest, old_title = known.get(q_id, (None, None))
+                if old_digest != digest:
+                    changed.append((q_id, title, rows, digest))
+                elif title and title != old_title:
+                    retitled.append((title, q_id))
+                known[q_id] = (digest, title or old_title)
+
+            cols = ", ".join(self.COLUMNS)
+            for q_id, _, _, _ in changed:
+                self.conn.execute("INSERT INTO refs_fts (refs_fts, rowid, %s) SELECT 'delete', id, %s FROM refs "
+                                  "WHERE q_id = ?" % (cols, cols), (q_id,))
+                self.conn.execute("DELETE FROM refs WHERE q_id = ?", (q_id,))
+            first = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM refs").fetchone()[0]
+            for q_id, title, rows, digest in changed:
+                self.conn.executemany("INSERT INTO refs (q_id, position, scopus_id, doi, title, authors, venue, year) "
+                                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", ((q_id,) + row for row in rows))
+                # a title-less caller (e.g. index_bibliography_cache) keeps the title already known
+                self.conn.execute("INSERT INTO papers VALUES (?, ?, ?, ?) ON CONFLICT (q_id) DO UPDATE SET "
+                                  "title = COALESCE(excluded.title, title), digest = excluded.digest, "
+                                  "indexed = excluded.indexed", (q_id, title, digest, stamp))
+            self.conn.execute("INSERT INTO refs_fts (rowid, %s) SELECT id, %s FROM refs WHERE id > ?" % (cols, cols),
+                              (first,))
+            self.conn.executemany("UPDATE papers SET title = ? WHERE q_id = ?", retitled)
+        num = len(changed)
+        metrics.inc("search_index_papers_total", num)
+        return num
+
+    @staticmethod
+    def quote_terms(query):
+        """
+        Query with every term quoted, for input that is not valid FTS5 syntax, e.g. "LiDAR-based".
+        """
+        return " ".join('"%s"' % t.replace('"', '""') for t in query.split())
+
+    def search(self, query, limit=20, offset=0):
+        """
+        :param query: FTS5 query, e.g. '"loop closure" lidar', 'authors:Cadena year:2016', 'scan context*'
+        :param limit:
+        :param offset:
+        :return: list of SearchHit, best first; lower (more negative) bm25 scores are better
+        """
+        sql = ("SELECT r.q_id, p.title, r.position, r.scopus_id, r.doi, r.title, r.authors, r.venue, r.year, "
+               "bm25(refs_fts, %s) AS score FROM refs_fts JOIN refs r ON r.id = refs_fts.rowid "
+               "LEFT JOIN papers p ON p.q_id = r.q_id WHERE refs_fts MATCH ? ORDER BY score LIMIT ? OFFSET ?"
+               % ", ".join(map(str, self.WEIGHTS)))
+        try:
+            rows = self.conn.execute(sql, (query, limit, offset)).fetchall()
+        except sqlite3.OperationalError:
+            rows = self.conn.execute(sql, (self.quote_terms(query), limit, offset)).fetchall()
+        return [SearchHit(*row) for row in rows]
+
+    def indexed_ids(self):
+        return [row[0] for row in self.conn.execute("SELECT q_id FROM papers ORDER BY q_id")]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class PaperCorpus:
+    """
+    Persistent local corpus (SQLite) of every paper retrieved by any run: the FULL record, the REF list, and the
+    groups the paper was retrieved with. A paper is stored once, under the identifier it was first retrieved with,
+    even if later runs reach it by another one (e.g. its scopus id after a crawl), see resolve. Each reference row is
+    also a citing->cited edge (q_id -> scopus_id, or DOI for references Scopus could not resolve), indexed for reverse
+    lookups. Graphs can be rebuilt from it by query without any API call, see CitationGraph.from_corpus.
+    """
+
+    SCHEMA_VERSION = 1
+    FILE_NAME = "my_paper_corpus.sqlite"
+    REF_COLUMNS = RefRow._fields
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version == 0:
+                self._create()
+            elif version != self.SCHEMA_VERSION:
+                raise RuntimeError("Unknown corpus schema version %d: %s" % (version, self.path))
+        return self._conn
+
+    def _create(self):
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS papers (q_id TEXT PRIMARY KEY, scopus_id TEXT, "
+                               "doi TEXT COLLATE NOCASE, title TEXT, year INTEGER, record TEXT, digest TEXT, "
+                               "retrieved TEXT)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS papers_scopus_id ON papers (scopus_id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS papers_doi ON papers (doi)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS refs (q_id TEXT NOT NULL, ord INTEGER NOT NULL, %s, "
+                               "PRIMARY KEY (q_id, ord)) WITHOUT ROWID"
+                               % ", ".join("doi TEXT COLLATE NOCASE" if f == "doi" else f for f in self.REF_COLUMNS))
+            self._conn.execute("CREATE INDEX IF NOT EXISTS refs_id ON refs (id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS refs_doi ON refs (doi)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS groups (name TEXT NOT NULL, q_id TEXT NOT NULL, "
+                               "PRIMARY KEY (name, q_id)) WITHOUT ROWID")
+            self._conn.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+
+    @staticmethod
+    def encode_full(full):
+        return json.dumps([full.title, full.doi, full.eid, full.citedby_count, full.coverDate,
+                           full.sourcetitle_abbreviation, full.refcount, [list(au) for au in full.authors],
+                           [list(af) for af in full.affiliation]])
+
+    @staticmethod
+    def decode_full(record):
+        fields = json.loads(record)
+        return FullRecord(*fields[:7], [AuthorRecord(*au) for au in fields[7]],
+                          [AffiliationRecord(*af) for af in fields[8]])
+
+    def add_many(self, papers, group=None, chunk=500):
+        """
+        Record the retrieved papers in one transaction, replacing what was recorded for them before. Papers whose
+        record and reference list did not change are only added to the group. A paper already recorded under another
+        identifier with the same scopus id is recorded under that one.
+        :param papers: iterable of (q_id, FullRecord, list of RefRow), failed retrievals (full None) are skipped
+        :param group: name of the group the papers belong to, e.g. the topic of the run
+        :param chunk: q_ids per DELETE statement
+        :return: number of papers written
+        """
+        papers = [(q_id, full, refs) for q_id, full, refs in papers if full is not None and refs is not None]
+        if not papers:
+            return 0
+        stamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with metrics.timer("corpus_ingest_seconds"), self.conn:
+            q_id_of_sid = dict()
+            for sid, q_id in self.conn.execute("SELECT scopus_id, q_id FROM papers WHERE scopus_id IS NOT NULL "
+                                               "ORDER BY rowid"):
+                q_id_of_sid.setdefault(sid, q_id)
+            canon = dict()
+            for q_id, full, refs in papers:
+                sid = full.eid[7:] if full.eid else None
+                canon[q_id] = q_id_of_sid.setdefault(sid, q_id) if sid else q_id
+            papers = list({canon[q_id]: (canon[q_id], full, refs) for q_id, full, refs in papers}.values())
+
+            if group:
+                self.conn.executemany("INSERT OR IGNORE INTO groups VALUES (?, ?)",
+                                      ((group, q_id) for q_id, _, _ in papers))
+            known = dict(self.conn.execute("SELECT q_id, digest FROM papers"))
+            changed = []
+            for q_id, full, refs in papers:
+                record = self.encode_full(full)
+                digest = hashlib.sha1(json.dumps([record, refs]).encode("utf-8")).hexdigest()
+                if known.get(q_id) != digest:
+                    changed.append((q_id, full, refs, record, digest))
+
+            for c in range(0, len(changed), chunk):
+                part = [p[0] for p in changed[c: c + chunk]]
+                self.conn.execute("DELETE FROM refs WHERE q_id IN (%s)" % ",".join("?" * len(part)), part)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO papers VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((q_id, full.eid[7:] if full.eid else None, full.doi, full.title,
+                  int(full.coverDate[:4]) if full.coverDate and full.coverDate[:4].isdigit() else None,
+                  record, digest, stamp) for q_id, full, _, record, digest in changed))
+            self.conn.executemany(
+                "INSERT INTO refs VALUES (?, ?, %s)" % ", ".join("?" * len(self.REF_COLUMNS)),
+                ((q_id, k) + tuple(ref) for q_id, _, refs, _, _ in changed for k, ref in enumerate(refs)))
+        metrics.inc("corpus_papers_ingested_total", len(changed))
+        return len(changed)
+
+    def add_to_group(self, name, q_ids):
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO groups VALUES (?, ?)", ((name, q_id) for q_id in q_ids))
+
+    def resolve(self, identifiers):
+        """
+        Identifiers under which papers are recorded, each paper once.
+        :param identifiers: identifiers the papers were retrieved with, their scopus ids or DOIs
+        :return: list of q_ids in the order of identifiers, without repeats; unknown identifiers as they are
+        """
+        ret, seen = [], set()
+        for identifier in identifiers:
+            identifier = str(identifier).strip().upper()
+            row = self.conn.execute("SELECT scopus_id FROM papers WHERE q_id = ?", (identifier,)).fetchone()
+            if row is None:
+                row = self.conn.execute("SELECT scopus_id FROM papers WHERE %s = ? ORDER BY rowid LIMIT 1"
+                                        % ("scopus_id" if identifier.isdigit() else "doi"), (identifier,)).fetchone()
+            q_id = identifier
+            if row is not None and row[0]:
+                q_id = self.conn.execute("SELECT q_id FROM papers WHERE scopus_id = ? ORDER BY rowid LIMIT 1",
+                                         (row[0],)).fetchone()[0]
+            if q_id not in seen:
+                seen.add(q_id)
+                ret.append(q_id)
+        return ret
+
+    def groups(self):
+        """
+        :return: dict of group name: number of papers
+        """
+        return dict(self.conn.execute("SELECT name, COUNT(*) FROM groups GROUP BY name ORDER BY name"))
+
+    def group_ids(self, *names):
+        """
+        :return: q_ids of the papers in any of the groups, sorted
+        """
+        sql = "SELECT DISTINCT q_id FROM groups WHERE name IN (%s) ORDER BY q_id" % ",".join("?" * len(names))
+        return [row[0] for row in self.conn.execute(sql, names)]
+
+    def citing(self, identifier):
+        """
+        :param identifier: scopus id or DOI of the cited paper
+        :return: q_ids of the papers of the corpus citing it, sorted
+        """
+        identifier = str(identifier).strip()
+        sql = "SELECT DISTINCT q_id FROM refs WHERE %s = ? ORDER BY q_id" % ("id" if identifier.isdigit() else "doi")
+        ret = {row[0] for row in self.conn.execute(sql, (identifier,))}
+        if not identifier.isdigit():  # references are mostly matched by scopus id, the DOI of a paper gives its id
+            for (sid,) in self.conn.execute("SELECT scopus_id FROM papers WHERE doi = ?", (identifier,)):
+                ret.update(row[0] for row in self.conn.execute("SELECT q_id FROM refs WHERE id = ?", (sid,)))
+        return sorted(ret)
+
+    def load_many(self, q_ids, chunk=500):
+        """
+        :param q_ids:
+        :param chunk: q_ids per SQL query
+        :return: dict of q_id: (FullRecord, list of RefRow), for the q_ids in the corpus
+        """
+        ret = dict()
+        q_ids = list(q_ids)
+        for c in range(0, len(q_ids), chunk):
+            part = q_ids[c: c + chunk]
+            marks = ",".join("?" * len(part))
+            for q_id, record in self.conn.execute("SELECT q_id, record FROM papers WHERE q_id IN (%s)" % marks, part):
+                ret[q_id] = (self.decode_full(record), [])
+            for row in self.conn.execute("SELECT q_id, %s FROM refs WHERE q_id IN (%s) ORDER BY q_id, ord"
+                                         % (", ".join(self.REF_COLUMNS), marks), part):
+                ret[row[0]][1].append(RefRow(*row[1:]))
+        return ret
+
+    def paper_ids(self):
+        return [row[0] for row in self.conn.execute("SELECT q_id FROM papers ORDER BY q_id")]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class GraphExporter:
+    """
+    Node and edge tables of a CitationGraph, streamed in chunks straight from the reference store, so that large
+    graphs are written without building per-edge Python objects.
+    Nodes are numbered as in CitationGraph.citation_matrix(): the references of the store first, then the input papers
+    that are not cited by any other input paper. Uncited references (e.g. merged duplicates) are left out, unless
+    they are input papers.
+    Parquet and Arrow need pyarrow.
+    """
+    NODE_FIELDS = ("node", "kind", "input_index", "scopus_id", "doi", "title", "authors", "venue", "year", "citedby",
+                   "local_citations")
+    EDGE_FIELDS = ("citing", "cited", "position")
+
+    def __init__(self, cg, chunk_size=65536):
+        self.cg = cg
+        self.chunk_size = chunk_size
+
+    def iter_node_chunks(self):
+        """
+        :return: generator of dicts of column lists, at most chunk_size rows each
+        """
+        import numpy as np
+
+        cg, store = self.cg, self.cg.refs
+        row_node = cg.input_nodes()
+        input_of_node = {int(node): i for i, node in enumerate(row_node)}
+        in_deg = np.diff(np.frombuffer(store.cited_by()[0], dtype=store.indptr.typecode)) \
+            if store.num_nodes else np.zeros(0, np.int64)
+
+        def full_row(node, i):
+            full = cg.v_full[i]
+            if full is None:
+                return (node, "input", i, None, cg.input_doi[i], None, None, None, None, None, 0)
+            year = full.coverDate[:4] if full.coverDate else ""
+            return (node, "input", i, full.eid[7:] if full.eid else None, full.doi, full.title,
+                    "; ".join(au.indexed_name or "" for au in full.authors) or None, full.sourcetitle_abbreviation,
+                    int(year) if year.isdigit() else None,
+                    int(full.citedby_count) if str(full.citedby_count).isdigit() else None, 0)
+
+        keep = in_deg > 0
+        keep[row_node[row_node < store.num_nodes]] = True
+        chunk = []
+        for node in np.flatnonzero(keep).tolist():
+            year, citedby = store.node_year[node], store.node_citedby[node]
+            i = input_of_node.get(node, -1)
+            chunk.append((node, "reference" if i < 0 else "both", i, store.node_sid(node),
+                          store.dois.get(store.node_doi[node]), store.titles.get(store.node_title[node]),
+                          store.authors.get(store.node_authors[node]), store.venues.get(store.node_venue[node]),
+                          year or None, citedby if citedby >= 0 else None, int(in_deg[node])))
+            if len(chunk) == self.chunk_size:
+                yield dict(zip(self.NODE_FIELDS, map(list, zip(*chunk))))
+                chunk = []
+        for i, node in enumerate(row_node.tolist()):
+            if node >= store.num_nodes:
+                chunk.append(full_row(node, i))
+                if len(chunk) == self.chunk_size:
+                    yield dict(zip(self.NODE_FIELDS, map(list, zip(*chunk))))
+                    chunk = []
+        if chunk:
+            yield dict(zip(self.NODE_FIELDS, map(list, zip(*chunk))))
+
+    def iter_edge_chunks(self):
+        """
+        :return: generator of dicts of numpy int64 columns (citing node, cited node, position or -1)
+        """
+        import numpy as np
+
+        store = self.cg.refs
+        if not store.indices:
+            return
+        row_node = self.cg.input_nodes()
+        indptr = np.frombuffer(store.indptr, dtype=store.indptr.typecode)
+        indices = np.frombuffer(store.indices, dtype=store.indices.typecode)
+        positions = np.frombuffer(store.positions, dtype=store.positions.typecode)
+        for lo in range(0, len(indices), self.chunk_size):
+            hi = min(lo + self.chunk_size, len(indices))
+            rows = np.searchsorted(indptr, np.arange(lo, hi), side="right") - 1
+            yield {"citing": row_node[rows], "cited": indices[lo: hi].astype(np.int64),
+                   "position": positions[lo: hi].astype(np.int64)}
+
+    def export(self, path_prefix, fmt="parquet"):
+        if os.path.dirname(path_prefix):
+            os.makedirs(os.path.dirname(path_prefix), exist_ok=True)
+        if fmt in ("parquet", "arrow"):
+            paths = [self.write_arrow(path_prefix + "_nodes." + fmt, self.iter_node_chunks(), self.node_schema(), fmt),
+                     self.write_arrow(path_prefix + "_edges." + fmt, self.iter_edge_chunks(), self.edge_schema(), fmt)]
+        elif fmt == "csv":
+            paths = [self.write_csv(path_prefix + "_nodes.csv", self.NODE_FIELDS, self.iter_node_chunks()),
+                     self.write_csv(path_prefix + "_edges.csv", self.EDGE_FIELDS, self.iter_edge_chunks())]
+        elif fmt == "graphml":
+            paths = [self.write_graphml(path_prefix + ".graphml")]
+        else:
+            raise ValueError("Unknown export format: %s" % fmt)
+        print("[+] Graph exported: %s" % ", ".join(paths))
+        return paths
+
+    @staticmethod
+    def node_schema():
+        import pyarrow as pa
+
+        return pa.schema([("node", pa.int64()), ("kind", pa.string()), ("input_index", pa.int64()),
+                          ("scopus_id", pa.string()), ("doi", pa.string()), ("title", pa.string()),
+                          ("authors", pa.string()), ("venue", pa.string()), ("year", pa.int16()),
+                          ("citedby", pa.int64()), ("local_citations", pa.int64())])
+
+    @staticmethod
+    def edge_schema():
+        import pyarrow as pa
+
+        return pa.schema([("citing", pa.int64()), ("cited", pa.int64()), ("position", pa.int64())])
+
+    @staticmethod
+    def write_arrow(path, chunks, schema, fmt):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = pq.ParquetWriter(path, schema) if fmt == "parquet" else pa.ipc.new_file(path, schema)
+        try:
+            for chunk in chunks:
+                writer.write_batch(pa.record_batch([chunk[f.name] for f in schema], schema=schema))
+        finally:
+            writer.close()
+        return path
+
+    @staticmethod
+    def write_csv(path, fields, chunks):
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(fields)
+            for chunk in chunks:
+                cols = [chunk[k].tolist() if hasattr(chunk[k], "tolist") else chunk[k] for k in fields]
+                writer.writerows(zip(*cols))
+        return path
+
+    def write_graphml(self, path):
+        from xml.sax.saxutils import escape
+
+        types = {"node": None, "kind": "string", "input_index": "long", "scopus_id": "string", "doi": "string",
+                 "title": "string", "authors": "string", "venue": "string", "year": "int", "citedby": "long",
+                 "local_citations": "long"}
+        with open(path, "w", encoding="utf-8") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+            for k, t in types.items():
+                if t:
+                    f.write('  <key id="%s" for="node" attr.name="%s" attr.type="%s"/>\n' % (k, k, t))
+            f.write('  <key id="position" for="edge" attr.name="position" attr.type="long"/>\n'
+                    '  <graph id="citations" edgedefault="directed">\n')
+            for chunk in self.iter_node_chunks():
+                for row in zip(*(chunk[k] for k in self.NODE_FIELDS)):
+                    f.write('    <node id="n%d">' % row[0])
+                    f.write("".join('<data key="%s">%s</data>' % (k, escape(str(v)))
+                                    for k, v in zip(self.NODE_FIELDS[1:], row[1:]) if v is not None))
+                    f.write("</node>\n")
+            for chunk in self.iter_edge_chunks():
+                f.writelines('    <edge source="n%d" target="n%d"><data key="position">%d</data></edge>\n' % e
+                             for e in zip(chunk["citing"].tolist(), chunk["cited"].tolist(),
+                                          chunk["position"].tolist()))
+            f.write("  </graph>\n</graphml>\n")
+        return path
+
+
+class ReferenceLookupService:
+    """
+    In-memory lookups of the references of a CitationGraph, for live_bib_lookup and other interactive use.
+    The table row of every cited reference is rendered once when the service is built, and the references are
+    indexed by scopus id, DOI and normalized title, so that a lookup by (paper, position), id or title prefix is a
+    dictionary probe or a bisection. serve() answers the same lookups as JSON over HTTP on localhost, so that a graph
+    loaded once can be queried by other processes (see serve_session and live_bib_lookup).
+    """
+    DEFAULT_PORT = 8765
+
+    def __init__(self, cg):
+        self.cg = cg
+        store = self.store = cg.refs
+        in_indptr = store.cited_by()[0]
+        tail_fmt = "".join([" %%%d.%ds |" % (cw, cw) for cw in CitationGraph.BIB_COL_WIDTHS[1:]])
+
+        self.text = [None] * store.num_nodes  # rendered row without the position column, None if not cited
+        self.node_of_doi = dict()
+        titles = []
+        for node in range(store.num_nodes):
+            local = in_indptr[node + 1] - in_indptr[node]
+            if not local:
+                continue
+            ref = store.node_row(node)
+            self.text[node] = tail_fmt % CitationGraph.bib_entry_columns(ref)[1:]
+            if ref.doi:
+                self.node_of_doi.setdefault(ref.doi.lower(), node)
+            if ref.title:
+                titles.append((self.normalize_title(ref.title), node))
+        titles.sort()
+        self.title_keys = [t for t, _ in titles]
+        self.title_nodes = [n for _, n in titles]
+
+        self.row_of_input = dict()
+        for i, iid in enumerate(cg.input_doi):
+            full = cg.v_full[i] if i < len(cg.v_full) else None
+            for k in (iid, full.eid[7:] if full is not None and full.eid else None, full and full.doi):
+                if k:
+                    self.row_of_input.setdefault(str(k).lower(), i)
+        print("[+] Lookup service ready: %d references of %d papers" % (len(titles), len(cg.input_doi)))
+
+    @staticmethod
+    def normalize_title(title):
+        return " ".join(re.sub(r"[^0-9a-z]+", " ", title.lower()).split())
+
+    def paper_row(self, paper):
+        """
+        :param paper: index into the input list, or the DOI or scopus id of an input paper
+        :return: row of the reference store, None if unknown
+        """
+        if isinstance(paper, str):
+            row = self.row_of_input.get(paper.strip().lower())
+            if row is not None or not paper.strip().isdigit():
+                return row
+        row = int(paper)  # an index, e.g. from an HTTP query; scopus ids are far beyond the number of papers
+        return row if 0 <= row < len(self.cg.input_doi) and self.cg.v_ref[row] is not None else None
+
+    def entry(self, node, paper=None, position=None):
+        ref = self.store.node_row(node, position)
+        in_indptr = self.store.cited_by()[0]
+        return {
+            "node": node,
+            "paper": paper,
+            "position": position,
+            "scopus_id": ref.id,
+            "doi": ref.doi,
+            "title": ref.title,
+            "authors": ref.authors,
+            "venue": ref.sourcetitle,
+            "year": int(ref.coverDate) if ref.coverDate else None,
+            "citedby": ref.citedbycount,
+            "local_citations": in_indptr[node + 1] - in_indptr[node],
+            "text": " %6.6s |" % ("[%s]" % position if position is not None else "") + self.text[node],
+        }
+
+    def lookup(self, paper=None, pos=None, scopus_id=None, doi=None, title=None, limit=10):
+        """
+        Exactly one kind of query: paper and pos, scopus_id, doi or title (a prefix of the normalized title).
+        :return: list of entry dicts, at most limit for a title query, with the rendered table row under "text"
+        """
+        store = self.store
+        if paper is not None:
+            assert pos is not None, "a lookup by paper needs a position"
+            row = self.paper_row(paper)
+            if row is None:
+                return []
+            pos = int(pos)
+            for e in range(store.indptr[row], store.indptr[row + 1]):
+                if store.positions[e] == pos:
+                    return [self.entry(store.indices[e], row, pos)]
+            return []
+        if scopus_id is not None:
+            node = store.node_of_id.get(store.ids.find(str(scopus_id)))
+            return [self.entry(node)] if node is not None and self.text[node] is not None else []
+        if doi is not None:
+            node = self.node_of_doi.get(doi.lower())
+            return [self.entry(node)] if node is not None else []
+        if title is not None:
+            prefix = self.normalize_title(title)
+            if not prefix:
+                return []
+            ret = []
+            k = bisect.bisect_left(self.title_keys, prefix)
+            while k < len(self.title_keys) and len(ret) < limit and self.title_keys[k].startswith(prefix):
+                ret.append(self.entry(self.title_nodes[k]))
+                k += 1
+            return ret
+        raise ValueError("Empty lookup")
+
+    QUERY_KEYS = ("paper", "pos", "scopus_id", "doi", "title", "limit")
+
+    def serve(self, host="127.0.0.1", port=DEFAULT_PORT):
+        """
+        Answer GET /lookup?paper=3&pos=12 (or scopus_id=, doi=, title=&limit=) with a JSON list of entries, and
+        GET /health with the size of the graph. Blocks until interrupted.
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items() if k in service.QUERY_KEYS}
+                try:
+                    if url.path == "/lookup":
+                        if "limit" in query:
+                            query["limit"] = int(query["limit"])
+                        status, body = 200, service.lookup(**query)
+                    elif url.path == "/health":
+                        status, body = 200, {"papers": len(service.cg.input_doi),
+                                             "references": service.store.num_nodes}
+                    else:
+                        status, body = 404, {"error": "unknown path %s" % url.path}
+                except (ValueError, AssertionError) as e:
+                    status, body = 400, {"error": str(e) or "bad query"}
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        print("[+] Serving reference lookups on http://%s:%d/lookup" % server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    @staticmethod
+    def query(url, **params):
+        """
+        Client side of serve().
+        :param url: e.g. http://127.0.0.1:8765
+        :param params: as in lookup()
+        :return: list of entry dicts
+        """
+        import urllib.request
+
+        qs = urllib.parse.urlencode({k: v for k, v in params.items() if v is not None})
+        with urllib.request.urlopen("%s/lookup?%s" % (url.rstrip("/"), qs), timeout=5) as resp:
+            return json.loads(resp.read().decode("utf-8"))
+
 
 class CitationGraph:
     class UnifiedObsMetadata:
@@ -39,8 +2213,11 @@ class CitationGraph:
             self.link = ""
             self.updated = ""
 
-    def __init__(self, doi_lst, ignore_lst=None, max_age=30, min_refresh=7, num_proc=1):
-        scopus_init()
+    def __init__(self, doi_lst, ignore_lst=None, max_age=30, min_refresh=7, num_proc=1, max_spend=None, offline=None,
+                 group=None):
+        # Scopus is only initialized on the first retrieval, see load_scopus
+        self.offline = OFFLINE if offline is None else offline  # only read the pybliometrics cache
+        self.group = group  # name under which the retrieved papers are recorded in the corpus, e.g. the topic
 
         if ignore_lst is None:
             ignore_lst = []
@@ -48,7 +2225,8 @@ class CitationGraph:
         self.max_age = max_age  # manually increase age when the internet is not available and you want to read old data
         self.min_refresh = min_refresh  # if a record \in [min_ref, max_age], it has a chance to be updated in a query
         self.num_proc = num_proc  # number of parallel processes
-        self.curr_refs = dict()  # entry: ref.id: [Reference, (local_id_ref_pos)_set]
+        self.refs = ReferenceStore()  # distinct references and the citing->cited adjacency
+        self.citers = ReferenceStore()  # papers citing the input papers, one row per input paper, see get_cited_by
 
         self.input_doi = []  # identifiers, not necessarily DOI
         for doi in doi_lst:
@@ -58,6 +2236,7 @@ class CitationGraph:
                 continue
             self.input_doi.append(doi_san)  # a new profile, but the online query is case-insensitive.
         self.input_scopus_id = set()
+        self.input_hop = [0] * len(self.input_doi)  # crawl depth at which each input paper was added
 
         self.ignored_refs = set()  # a set of scopus_id strings that we wish to block
         for i in ignore_lst:
@@ -66,10 +2245,13 @@ class CitationGraph:
         print("A total %d input dois." % len(doi_lst))
 
         self.v_full = []
-        self.v_ref = []  # list of lists of references
+        self.v_ref = []  # list of references (PaperRefs views into self.refs) of each input paper, None if failed
 
         self.fail_set = set()  # failed id
 
+        self.budget = ScopusQuotaBudget(max_spend)
+        self.backlog = []  # ids deferred since they do not fit in the quota budget
+
         # change accordingly when the corresponding part in pybliometrics changes
         # as of v3.5.1
         fields = 'position id doi title authors authors_auid ' \
@@ -77,15 +2259,20 @@ class CitationGraph:
                  'volume issue first last citedbycount type text fulltext'
         self.OldRefTup = namedtuple('Reference', fields)
 
-        self.cache_ref_dir = os.path.join(BASE_PATH, "my_parsed_bib_cache")
+        self.cache_ref_dir = os.path.join(BASE_PATH, "my_parsed_bib_cache")  # legacy csv files
+        self.bib_cache = BibliographyCache(os.path.join(BASE_PATH, BibliographyCache.FILE_NAME), self.OldRefTup)
+        self.search_index = ReferenceSearchIndex(os.path.join(BASE_PATH, ReferenceSearchIndex.FILE_NAME))
+        self.corpus = PaperCorpus(os.path.join(BASE_PATH, PaperCorpus.FILE_NAME))
+        self._corpus_pending = []  # retrieved papers not recorded in the corpus yet
 
     @staticmethod
-    def create_obsidian_note_from_full(uom, md_dir, topic):
+    def create_obsidian_note_from_full(uom, md_dir, topic, vault_index=None):
         """
 
         :param md_dir:
         :param uom:
         :param topic:
+        :param vault_index: ObsidianVaultIndex of md_dir, shared when creating notes in batch. Opened if None.
         :return:
         """
         # current obsidian format: 2023-12-08
@@ -108,59 +2295,26 @@ class CitationGraph:
         ---
         """
 
-        # TODO: check existence by scopus id
-        # FIXME: it is still possible to generate duplicate files for the same paper, since doi lookup and scopus lookup
-        #  are not synchronized. More dangerously, they will generate 2 files that only differ in capitalization.
+        # Duplicates are checked by scopus id, doi, arxiv id and then normalized title, so that the doi lookup and the
+        #  scopus lookup of the same paper do not generate 2 files that only differ in capitalization.
         #  e.g. (Lazier than lazy greedy)
-        for root, dirs, files in os.walk(md_dir):
-            for fname in files:
-                heads = []
-                with open(os.path.join(md_dir, fname), "r", encoding="utf-8") as rec:
-                    in_frontmatter = False
-                    try:
-                        while True:
-                            line = next(rec)
-                            if line.rstrip() == "---":
-                                if not in_frontmatter:
-                                    in_frontmatter = True
-                                else:
-                                    raise StopIteration
-                            if in_frontmatter:
-                                heads.append(line)
-
-                    except StopIteration:
-                        pass
-
-                curr_full_title = None
-                curr_scopus_id = None
-                curr_doi = None
-
-                same_id = False
-                for line in heads:
-                    words = line.strip().split(":")
-                    if len(words) > 1:
-                        if words[0].strip() == "scopus_id":
-                            curr_scopus_id = words[1].strip().strip("\"'")
-                        elif words[0].strip() == "doi":
-                            curr_doi = words[1].strip().strip("\"'")
-                        elif words[0].strip() == "full_title":
-                            curr_full_title = " ".join(words[1:]).strip("\"'")
-
-                    same_id = curr_scopus_id and uom.scopus_id.lower() == curr_scopus_id.lower() \
-                              or curr_doi and uom.doi.upper() == curr_doi.upper()
-                    if curr_full_title is not None and same_id:
-                        break
-                if same_id:
-                    print("[-] Paper \"%s\" Obsidian record exists! Skipping: %s\"" % (
-                        uom.scopus_id, curr_full_title))
-                    return
-
-            break
+        own_index = vault_index is None
+        if own_index:
+            vault_index = ObsidianVaultIndex.open(md_dir)
+
+        q_res = vault_index.find(scopus_id=uom.scopus_id, doi=uom.doi,
+                                 arxiv_id=ObsidianVaultIndex.arxiv_id_from_link(uom.link), title=uom.title)
+        if q_res:
+            print("[-] Paper \"%s\" Obsidian record exists! Skipping: %s\"" % (
+                uom.scopus_id or uom.doi or uom.link, q_res))
+            return
 
         tags = ["paper", "need_review"]
         if isinstance(topic, str) and topic.strip():
             tags.append(topic.strip().replace(" ", "_"))
 
+        from bs4 import BeautifulSoup
+
         title_soup = BeautifulSoup(uom.title, "html.parser")
         title_wo_html = title_soup.get_text()
 
@@ -191,7 +2345,7 @@ class CitationGraph:
         if os.path.isfile(md_path):
             print("[!] Overwriting markdown file of different ID and same file name! title: %s" % title_wo_html)
             assert False
-        with open(md_path, "w", encoding="utf-8") as f:
+        with metrics.timer("note_write_seconds"), open(md_path, "w", encoding="utf-8") as f:
             f.write("---\n")
             for line in lines:
                 f.write(line + "\n")
@@ -208,96 +2362,221 @@ class CitationGraph:
             print("[+] Paper \"%s\" Obsidian record created: \"%s\"" % (uom.scopus_id if uom.scopus_id else uom.doi,
                                                                         title_wo_html))
 
+        vault_index.add(md_path)
+        if own_index:
+            vault_index.save()
+
+    @staticmethod
+    def parse_frontmatter(fpath, max_bytes=FRONTMATTER_MAX_BYTES, max_lines=FRONTMATTER_MAX_LINES):
+        """
+        Parse the frontmatter block surrounded by "---" at the very beginning of a file. Only the first max_bytes are
+        read, and the parser gives up if the block is not closed within max_lines or max_bytes.
+        Scalar values are returned raw (quotes kept) as before; indented continuation lines and "|" / ">" block
+        scalars are joined, "- item" lists become lists of raw strings. Flow lists like [a, b] stay raw strings.
+        :param fpath:
+        :param max_bytes:
+        :param max_lines:
+        :return: dict of key: value, empty if there is no (complete) frontmatter
+        """
+        with open(fpath, "rb") as rec:
+            head = rec.read(max_bytes)
+        lines = head.decode("utf-8", errors="replace").lstrip("\ufeff").splitlines()
+        if not lines or lines[0].rstrip() != "---":
+            return dict()
+
+        ret = dict()
+        key, block, cont = None, None, []  # the key being continued, its block style ("|", ">") and the lines
+
+        def finish():
+            while cont and not cont[-1]:
+                cont.pop()
+            if key is None or not cont:
+                return
+            if block == "|":
+                ret[key] = "\n".join(cont)
+            elif block == ">":
+                ret[key] = " ".join(cont)
+            elif not ret[key] and all(x == "-" or x.startswith("- ") for x in cont):
+                ret[key] = [x[1:].strip() for x in cont]
+            else:
+                ret[key] = " ".join(([ret[key]] if ret[key] else []) + cont)
+
+        for line in lines[1: max_lines + 1]:
+            if line.rstrip() == "---":
+                finish()
+                return ret
+            if line[:1] in (" ", "\t") or (line.startswith("-") and key is not None and not ret[key]):
+                if key is not None:
+                    cont.append(line.strip())
+                continue
+            if not line.strip():
+                if block:
+                    cont.append("")
+                continue
+            if line.startswith("#"):
+                continue
+            finish()
+            key, block, cont = None, None, []
+            line_seg = line.split(":", 1)
+            if len(line_seg) > 1 and line_seg[0].strip() not in ret:  # for a repeated key, the first one wins
+                key = line_seg[0].strip()
+                val = line_seg[1].strip()
+                if val[:1] in ("|", ">") and not val.rstrip("+-0123456789")[1:]:
+                    block, val = val[0], ""
+                ret[key] = val
+        return dict()  # no closing "---" within the limits
+
+    @staticmethod
+    def frontmatter_scalar(val):
+        """
+        A parsed frontmatter value as a string: the first item of a "- item" list, "" for an empty one.
+        """
+        if isinstance(val, list):
+            return val[0] if val else ""
+        return val
+
+    @staticmethod
+    def read_vals_in_frontmatter(fpath, keys):
+        """
+        Read the values of several keys from the frontmatter, see parse_frontmatter.
+        :param fpath:
+        :param keys: iterable of key names
+        :return: dict of key: raw value as a string (see frontmatter_scalar), for the keys found
+        """
+        kv = CitationGraph.parse_frontmatter(fpath)
+        return {k: CitationGraph.frontmatter_scalar(kv[k]) for k in keys if k in kv}
+
     @staticmethod
     def read_val_by_key_in_frontmatter(fpath, key_name):
         """
         Explicitly parses the frontmatter surrounded by "---" in the beginning of a file
-        TODO: parse multiline entries, add early termination by line number
         :param fpath:
         :param key_name:
-        :return:
+        :return: the raw value, the first item of a "- item" list, "" if not found
         """
-        with open(fpath, "r", encoding="utf-8") as rec:
-            in_frontmatter = False
-            try:
-                while True:
-                    line = next(rec)
-                    if line.rstrip() == "---":
-                        if not in_frontmatter:
-                            in_frontmatter = True
-                        else:
-                            raise StopIteration
-                    if in_frontmatter:
-                        line_seg = line.split(":")
-                        if len(line_seg) > 1 and line_seg[0].strip() == key_name.strip():
-                            val = ":".join(line_seg[1:]).strip()
-                            return val
-
-            except StopIteration:
-                pass
-        return ""
+        return CitationGraph.frontmatter_scalar(CitationGraph.parse_frontmatter(fpath).get(key_name.strip(), ""))
+
+    @staticmethod
+    def read_list_by_key_in_frontmatter(fpath, key_name):
+        """
+        Read a "- item" list from the frontmatter, e.g. tags or aliases written one per line.
+        :param fpath:
+        :param key_name:
+        :return: list of raw strings, a one-item list for a non-empty scalar, [] if not found
+        """
+        val = CitationGraph.parse_frontmatter(fpath).get(key_name.strip(), "")
+        if isinstance(val, list):
+            return val
+        return [val] if val else []
 
     @staticmethod
-    def set_vals_by_keys_in_frontmatter(fpath, key_vals):
+    def set_vals_by_keys_in_frontmatter(fpath, key_vals, if_modified=None, log=None):
         """
         Explicitly parses the frontmatter surrounded by "---" in the beginning of a file. If a key is found, replace its value.
-        Else, append the key-value pair at the end of the frontmatter.
+        Else, append the key-value pair at the end of the frontmatter. The file is read once and, only if a value
+        changed, written once through a temp file and a rename.
         :param fpath:
         :param key_vals: dict of key-value pairs
-        :return:
+        :param if_modified: dict of key-value pairs applied in the same write, only if key_vals changed anything
+        :param log: list collecting the change messages instead of printing them, for calls from worker threads
+        :return: whether the file was modified
         """
 
         def quoted_equal(str1, str2):
             return str1.strip().strip("\"'") == str2.strip().strip("\"'")
 
-        modified = False
-        with open(fpath, "r+", encoding="utf-8") as rec:
+        def apply(lines, kv, changes):
+            out = []
             in_frontmatter = False
-            lines = []
-            un_used_keys = set(key_vals.keys())
+            un_used_keys = set(kv.keys())
+            for line in lines:
+                if line.rstrip() == "---":
+                    if not in_frontmatter:
+                        in_frontmatter = True
+                    else:
+                        in_frontmatter = False
+                        for kk in sorted(un_used_keys):
+                            out.append(kk + ": " + str(kv[kk]) + "\n")
+                            changes.append(" +  Appending key val: %s" % out[-1].strip())
+                        un_used_keys = set()
+
+                if in_frontmatter:
+                    line_seg = line.split(":")
+                    if len(line_seg) > 1:
+                        key = line_seg[0].strip()
+                        if key in un_used_keys:
+                            s_val = str(kv[key]).strip()
+                            old_val = ":".join(line_seg[1:]).strip()
+                            if not quoted_equal(old_val, s_val):
+                                line = key + ": " + s_val + "\n"
+                                changes.append(" +  Updating %s: %s --> %s" % (key, old_val, s_val))
+                            un_used_keys.remove(key)
+                out.append(line)
+            return out
+
+        with open(fpath, "r", encoding="utf-8") as rec:
+            lines = rec.readlines()
+
+        changes = []
+        lines = apply(lines, key_vals, changes)
+        if changes and if_modified:
+            lines = apply(lines, if_modified, changes)
+
+        if changes:
+            tmp_path = fpath + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as rec:
+                rec.writelines(lines)
+            os.replace(tmp_path, fpath)
+            metrics.inc("note_rewrites_total")
+
+        if log is None:
+            for msg in changes:
+                print(msg)
+        else:
+            log.extend(changes)
+        return bool(changes)
+
+    @staticmethod
+    def set_vals_in_frontmatter_batch(jobs, if_modified=None, num_workers=8):
+        """
+        set_vals_by_keys_in_frontmatter over many files in a thread pool, the messages are printed in input order.
+        :param jobs: list of (fpath, key_vals)
+        :param if_modified: dict of key-value pairs set in every file that changed, e.g. the update time
+        :param num_workers:
+        :return: list of the modified paths
+        """
+
+        def work(job):
+            log = []
             try:
-                while True:
-                    line = next(rec)
-                    if line.rstrip() == "---":
-                        if not in_frontmatter:
-                            in_frontmatter = True
-                        else:
-                            in_frontmatter = False
-                            for kk in un_used_keys:
-                                lines.append(kk + ": " + key_vals[kk] + "\n")
-                                print(" +  Appending key val: %s" % lines[-1].strip())
-                                modified = True
-
-                    if in_frontmatter:
-                        line_seg = line.split(":")
-                        if len(line_seg) > 1:
-                            key = line_seg[0].strip()
-                            if key in key_vals:
-                                s_val = str(key_vals[key]).strip()
-                                old_val = ":".join(line_seg[1:]).strip()
-                                if not quoted_equal(old_val, s_val):
-                                    line = key + ": " + s_val + "\n"
-                                    print(" +  Updating %s: %s --> %s" % (key, old_val, s_val))
-                                    modified = True
-                                un_used_keys.remove(key)
-                    lines.append(line)
-
-            except StopIteration:  # end of file
+                modified = CitationGraph.set_vals_by_keys_in_frontmatter(job[0], job[1], if_modified, log)
+            except OSError as e:
+                log.append("[-] Failed to update %s: %s" % (job[0], e))
+                modified = False
+            return modified, log
+
+        modified_paths = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for i, (job, (modified, log)) in enumerate(zip(jobs, executor.map(work, jobs))):
+                print("[+] Processing %d/%d: %s" % (i + 1, len(jobs), os.path.basename(job[0])))
+                for msg in log:
+                    print(msg)
                 if modified:
-                    rec.seek(0)
-                    rec.writelines(lines)
-                    rec.truncate()
-
-        return modified
+                    modified_paths.append(job[0])
+        return modified_paths
 
     @staticmethod
-    def create_obsidian_notes_from_dois(all_dois, md_dir, topic, skip_by_doi=True):
+    def create_obsidian_notes_from_dois(all_dois, md_dir, topic, skip_by_doi=True, num_workers=8, max_per_host=4,
+                                        doi_site="http://dx.doi.org/"):
         """
 
         :param all_dois:
         :param md_dir:
         :param topic:
         :param skip_by_doi: whether to skip requesting by looking up doi in files
+        :param num_workers: number of concurrent requests. The notes are still written in the input order.
+        :param max_per_host: max concurrent requests to the same host (doi.org)
+        :param doi_site: DOI resolver, e.g. a local server that serves canned BibTeX
         :return:
         """
 
@@ -312,83 +2591,83 @@ class CitationGraph:
             # print(res)
             return res
 
-        doi_site = "http://dx.doi.org/"
         headers = {
             "Accept": "application/x-bibtex"
         }
 
         assert md_dir
 
-        existing_dois = dict()
-        if skip_by_doi:
-            for root, dirs, files in os.walk(md_dir):
-                for fname in files:
-                    curr_doi = CitationGraph.read_val_by_key_in_frontmatter(os.path.join(root, fname), "doi")
-                    if curr_doi:
-                        existing_dois[curr_doi.upper().strip().strip("\"'")] = fname
+        vault_index = ObsidianVaultIndex.open(md_dir)
 
+        to_fetch = []
         for doi in all_dois:
             if skip_by_doi:
-                q_res = existing_dois.get(doi.strip().upper())
+                q_res = vault_index.find(doi=doi)
                 if q_res:
                     print("[-] record of doi %s exists! Skipping: %s" % (doi, str(q_res)))
                     continue
+            to_fetch.append(doi_site + doi.strip())
 
-            url = doi_site + doi
-
-            req = requests.get(url=url, headers=headers)  # essentially a bibtex file
-            if req.status_code != 200:
-                print("Error query doi.org: %d" % req.status_code, url)
-                continue
-            resp_txt = req.text.strip()
+        fetcher = PooledHttpFetcher(num_workers=num_workers, max_per_host=max_per_host)
+        try:
+            for url, status, resp_txt in fetcher.get_all(to_fetch, headers):  # essentially a bibtex file
+                if status != 200:
+                    print("Error query doi.org: %d" % status, url)
+                    continue
+                resp_txt = resp_txt.strip()
 
-            uom = CitationGraph.UnifiedObsMetadata()
+                uom = CitationGraph.UnifiedObsMetadata()
 
-            # TODO: use more robust bibtex parser
+                # TODO: use more robust bibtex parser
 
-            p1 = re.search("title={(.+?)}", resp_txt)
-            if p1:
-                uom.title = p1.groups()[0]
+                p1 = re.search("title={(.+?)}", resp_txt)
+                if p1:
+                    uom.title = p1.groups()[0]
 
-            p1 = re.search("DOI={(.+?)}", resp_txt)
-            if p1:
-                uom.doi = p1.groups()[0]
+                p1 = re.search("DOI={(.+?)}", resp_txt)
+                if p1:
+                    uom.doi = p1.groups()[0]
 
-            p1 = re.search("booktitle={(.+?)}", resp_txt)
-            if p1:
-                uom.sourcetitle_abbr = CitationGraph.simplify_source_title(p1.groups()[0])
+                p1 = re.search("booktitle={(.+?)}", resp_txt)
+                if p1:
+                    uom.sourcetitle_abbr = CitationGraph.simplify_source_title(p1.groups()[0])
 
-            p1 = re.search("journal={(.+?)}", resp_txt)
-            if p1:
-                uom.sourcetitle_abbr = CitationGraph.simplify_source_title(p1.groups()[0])
+                p1 = re.search("journal={(.+?)}", resp_txt)
+                if p1:
+                    uom.sourcetitle_abbr = CitationGraph.simplify_source_title(p1.groups()[0])
 
-            p1 = re.search("author={(.+?)}", resp_txt)
-            if p1:
-                uom.authors = "[%s]" % separate_authors(p1.groups()[0])
+                p1 = re.search("author={(.+?)}", resp_txt)
+                if p1:
+                    uom.authors = "[%s]" % separate_authors(p1.groups()[0])
 
-            p1 = re.search("year={(.+?)}", resp_txt)
-            if p1:
-                uom.year = p1.groups()[0]
+                p1 = re.search("year={(.+?)}", resp_txt)
+                if p1:
+                    uom.year = p1.groups()[0]
 
-            CitationGraph.create_obsidian_note_from_full(uom, md_dir, topic)
+                CitationGraph.create_obsidian_note_from_full(uom, md_dir, topic, vault_index)
+        finally:
+            fetcher.close()
+            vault_index.save()
 
     @staticmethod
-    def create_obsidian_notes_from_arxiv(all_aids, md_dir, topic, skip_by_aid=True):
+    def create_obsidian_notes_from_arxiv(all_aids, md_dir, topic, skip_by_aid=True, batch_size=100,
+                                         api_site="http://export.arxiv.org/api/query"):
         """
         http://export.arxiv.org/oai2?verb=GetRecord&identifier=oai:arXiv.org:2405.03413&metadataPrefix=arXiv
+        :param all_aids:
+        :param md_dir:
+        :param topic:
+        :param skip_by_aid: whether to skip requesting by looking up arxiv id in files
+        :param batch_size: number of ids per query of the arXiv API. If <= 1, one OAI-PMH GetRecord per id.
+        :param api_site: arXiv API endpoint of the batch mode, e.g. a local server that serves canned Atom feeds
+        :return:
         """
-        pat1 = re.compile("ar[Xx]iv:(\d{4}\.\d{4,5})")
-        pat2 = re.compile("arxiv.org/abs/(\d{4}\.\d{4,5})")
+        pat1 = re.compile(r"ar[Xx]iv:(\d{4}\.\d{4,5})")
+        pat2 = re.compile(r"arxiv.org/abs/(\d{4}\.\d{4,5})")
 
-        existing_aids = dict()
-        if skip_by_aid:
-            for root, dirs, files in os.walk(md_dir):
-                for fname in files:
-                    curr_arxiv_link = CitationGraph.read_val_by_key_in_frontmatter(os.path.join(root, fname), "link")
-                    match_aid = pat2.search(curr_arxiv_link)
-                    if match_aid:
-                        existing_aids[match_aid.groups()[0]] = fname
+        vault_index = ObsidianVaultIndex.open(md_dir)
 
+        to_fetch = []
         for aid in all_aids:
             match_aid1 = pat1.search(aid)
             match_aid2 = pat2.search(aid)
@@ -396,51 +2675,152 @@ class CitationGraph:
                 print("[-] Invalid arxiv id: %s" % aid)
                 continue
             aid = match_aid1.groups()[0] if match_aid1 else match_aid2.groups()[0]
-            print("[+] Processing arxiv %s" % aid)
 
             if skip_by_aid:
-                q_res = existing_aids.get(aid.strip())
+                q_res = vault_index.find(arxiv_id=aid.strip())
                 if q_res:
                     print("[-] record of arxiv %s exists! Skipping: %s" % (aid, str(q_res)))
                     continue
+            to_fetch.append(aid)
+
+        # usage guideline: https://info.arxiv.org/help/api/tou.html, no more than one request every three seconds
+        import requests
+
+        session = requests.Session()
+        try:
+            if batch_size > 1:
+                bucket = TokenBucket(rate=1 / 3.)
+                for b in range(0, len(to_fetch), batch_size):
+                    batch = to_fetch[b: b + batch_size]
+                    print("[+] Processing arxiv %d-%d/%d" % (b + 1, b + len(batch), len(to_fetch)))
+                    for uom in CitationGraph.harvest_arxiv_batch(batch, session, bucket, api_site):
+                        CitationGraph.create_obsidian_note_from_full(uom, md_dir, topic, vault_index)
+            else:
+                bucket = TokenBucket(rate=1.)
+                for aid in to_fetch:
+                    print("[+] Processing arxiv %s" % aid)
+                    uom = CitationGraph.get_arxiv_record(aid, session, bucket)
+                    if uom:
+                        CitationGraph.create_obsidian_note_from_full(uom, md_dir, topic, vault_index)
+        finally:
+            session.close()
+            vault_index.save()
 
-            url = "http://export.arxiv.org/oai2?verb=GetRecord&identifier=oai:arXiv.org:%s&metadataPrefix=arXiv" % aid
-            # usage guideline: https://info.arxiv.org/help/bulk_data.html#harvest
-            req = requests.get(url)
-            time.sleep(1)
+    @staticmethod
+    def get_arxiv_record(aid, session, bucket):
+        """
+        One OAI-PMH GetRecord request.
+        :param aid: arxiv id without version
+        :param session:
+        :param bucket: TokenBucket
+        :return: UnifiedObsMetadata, or None
+        """
+        url = "http://export.arxiv.org/oai2?verb=GetRecord&identifier=oai:arXiv.org:%s&metadataPrefix=arXiv" % aid
+        # usage guideline: https://info.arxiv.org/help/bulk_data.html#harvest
+        bucket.acquire()
+        with session.get(url, timeout=60) as req:
             if req.status_code != 200:
                 print("Error query arxiv: %d" % req.status_code, url)
-                continue
+                return None
             resp_txt = req.text.strip()
-            soup = BeautifulSoup(resp_txt, "lxml-xml")
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(resp_txt, "lxml-xml")
+
+        arx_tag = soup.find("arXiv")
+        if not arx_tag:
+            return None
+
+        uom = CitationGraph.UnifiedObsMetadata()
+        uom.title = re.sub(r"\s+", " ", arx_tag.find("title").text).strip()
+        id_ret = arx_tag.find("id").text
+        assert id_ret == aid
+        uom.link = "http://arxiv.org/abs/" + aid  # keep arxiv id in links
+        time_tag = arx_tag.find("updated")
+        if not time_tag:
+            time_tag = arx_tag.find("created")
+        uom.updated = time_tag.text[:10]
+        uom.year = arx_tag.find("created").text[:4]
+
+        uom.authors = []
+        authors = arx_tag.find_all("author")
+        for au in authors:
+            name1 = au.find("forenames").text.strip()
+            name2 = au.find("keyname").text.strip()
+            uom.authors.append("%s, %s" % (name2, name1))
+        return uom
+
+    @staticmethod
+    def harvest_arxiv_batch(aids, session, bucket, api_site="http://export.arxiv.org/api/query"):
+        """
+        Query many ids in one request of the arXiv API (id_list), and stream-parse the Atom response entry by entry.
+        Atom only has the full name of the authors, so the key name is guessed (see split_author_name); OAI-PMH
+        (batch_size=1 in create_obsidian_notes_from_arxiv) gives the exact key names, one request per id.
+        :param aids: arxiv ids without version
+        :param session:
+        :param bucket: TokenBucket
+        :param api_site:
+        :return: generator of UnifiedObsMetadata, in the order of the response
+        """
+        atom = "{http://www.w3.org/2005/Atom}"
+        wanted = set(aids)
+
+        bucket.acquire()
+        with session.get(api_site, params={"id_list": ",".join(aids), "max_results": len(aids)}, stream=True,
+                         timeout=60) as req:
+            if req.status_code != 200:
+                print("Error query arxiv: %d" % req.status_code, req.url)
+                return
+            req.raw.decode_content = True
 
-            uom = CitationGraph.UnifiedObsMetadata()
+            for event, elem in ET.iterparse(req.raw, events=("end",)):
+                if elem.tag != atom + "entry":
+                    continue
+                # e.g. http://arxiv.org/abs/2312.01616v2
+                match_aid = re.search(r"arxiv.org/abs/(\d{4}\.\d{4,5})", elem.findtext(atom + "id", ""))
+                if not match_aid or match_aid.groups()[0] not in wanted:  # invalid ids come back as error entries
+                    elem.clear()
+                    continue
 
-            arx_tag = soup.find("arXiv")
-            if arx_tag:
-                uom.title = re.sub("\s+", " ", arx_tag.find("title").text).strip()
-                id_ret = arx_tag.find("id").text
-                assert id_ret == aid
+                aid = match_aid.groups()[0]
+                uom = CitationGraph.UnifiedObsMetadata()
+                uom.title = re.sub(r"\s+", " ", elem.findtext(atom + "title", "")).strip()
                 uom.link = "http://arxiv.org/abs/" + aid  # keep arxiv id in links
-                time_tag = arx_tag.find("updated")
-                if not time_tag:
-                    time_tag = arx_tag.find("created")
-                uom.updated = time_tag.text[:10]
-                uom.year = arx_tag.find("created").text[:4]
+                uom.updated = elem.findtext(atom + "updated", "")[:10]
+                uom.year = elem.findtext(atom + "published", "")[:4]
 
                 uom.authors = []
-                authors = arx_tag.find_all("author")
-                for au in authors:
-                    name1 = au.find("forenames").text.strip()
-                    name2 = au.find("keyname").text.strip()
-                    uom.authors.append("%s, %s" % (name2, name1))
+                for au in elem.iter(atom + "author"):
+                    forenames, keyname = CitationGraph.split_author_name(au.findtext(atom + "name", ""))
+                    uom.authors.append("%s, %s" % (keyname, forenames) if forenames else keyname)
 
-                CitationGraph.create_obsidian_note_from_full(uom, md_dir, topic)
+                elem.clear()
+                yield uom
 
-    def update_md_metadata(self, md_paths: list):
+    NAME_PARTICLES = {"da", "das", "de", "del", "della", "der", "des", "di", "do", "dos", "du", "la", "le", "ten",
+                      "ter", "van", "von", "y", "bin", "ibn", "al", "el", "st", "st."}
+
+    @staticmethod
+    def split_author_name(name):
+        """
+        Guess (forenames, key name) of a full name: the last word, with the particles before it, e.g.
+        "Luc Van Gool" -> ("Luc", "Van Gool"), "Fernando De la Torre" -> ("Fernando", "De la Torre"). Compound
+        surnames without particles (e.g. "Gabriel Garcia Marquez") still lose their first part.
+        """
+        words = name.split()
+        if len(words) < 2:
+            return "", " ".join(words)
+        k = len(words) - 1
+        while k > 1 and words[k - 1].lower() in CitationGraph.NAME_PARTICLES:
+            k -= 1
+        return " ".join(words[:k]), " ".join(words[k:])
+
+    def update_md_metadata(self, md_paths: list, vault_index=None, num_workers=8):
         """
         With the cache of the files to update already fetched, update the metadata of the files.
         :param md_paths: the cache of the files to update should already be fetched into the cache
+        :param vault_index: ObsidianVaultIndex covering md_paths, to look up doi/scopus_id without reading the files
+        :param num_workers: threads rewriting the files
         :return:
         """
 
@@ -455,43 +2835,45 @@ class CitationGraph:
                 uom.year = full.coverDate[:4] if full.coverDate else ""
                 uom.sourcetitle_abbr = full.sourcetitle_abbreviation
 
-                doi_dict[uom.doi.upper()] = uom
-                sco_dict[uom.scopus_id] = uom
-
-        for i, md_path in enumerate(md_paths):
-            print("[+] Processing %d/%d: %s" % (i + 1, len(md_paths), os.path.basename(md_path)))
-
-            doi = CitationGraph.read_val_by_key_in_frontmatter(md_path, "doi").upper()
-            scopus_id = CitationGraph.read_val_by_key_in_frontmatter(md_path, "scopus_id").upper()
+                if uom.doi:  # never key on "", which every DOI-less note would match
+                    doi_dict[uom.doi.upper()] = uom
+                if uom.scopus_id:
+                    sco_dict[uom.scopus_id] = uom
 
-            update_time = datetime.datetime.now().strftime('\"%Y-%m-%d %H:%M:%S\"')
+        jobs = []
+        for md_path in md_paths:
+            rec = vault_index.get(md_path) if vault_index else None
+            if rec:
+                doi, scopus_id = rec.doi, rec.scopus_id.upper()
+            else:
+                vals = CitationGraph.read_vals_in_frontmatter(md_path, ("doi", "scopus_id"))
+                doi, scopus_id = vals.get("doi", "").upper(), vals.get("scopus_id", "").upper()
 
-            if doi in doi_dict:
-                update_dict = dict()
+            if doi and doi in doi_dict:
                 updated_uom = doi_dict[doi]
-                update_dict["citedby"] = updated_uom.citedby_count
-                update_dict["year"] = updated_uom.year
-                update_dict["venue"] = updated_uom.sourcetitle_abbr
-                update_dict["scopus_id"] = updated_uom.scopus_id
-
-                modified = CitationGraph.set_vals_by_keys_in_frontmatter(md_path, update_dict)
-                if modified:
-                    CitationGraph.set_vals_by_keys_in_frontmatter(md_path, {"updated": update_time})
-
-            elif scopus_id in sco_dict:
-                update_dict = dict()
+                update_dict = {"citedby": updated_uom.citedby_count,
+                               "year": updated_uom.year,
+                               "venue": updated_uom.sourcetitle_abbr,
+                               "scopus_id": updated_uom.scopus_id}
+            elif scopus_id and scopus_id in sco_dict:
                 updated_uom = sco_dict[scopus_id]
-                update_dict["citedby"] = updated_uom.citedby_count
-                update_dict["year"] = updated_uom.year
-                update_dict["venue"] = updated_uom.sourcetitle_abbr
-                update_dict["doi"] = updated_uom.doi
-
-                modified = CitationGraph.set_vals_by_keys_in_frontmatter(md_path, update_dict)
-                if modified:
-                    CitationGraph.set_vals_by_keys_in_frontmatter(md_path, {"updated": update_time})
-
+                update_dict = {"citedby": updated_uom.citedby_count,
+                               "year": updated_uom.year,
+                               "venue": updated_uom.sourcetitle_abbr,
+                               "doi": updated_uom.doi}
             else:
                 print("[-] No match found for doi/scopus_id in the database: %s" % md_path)
+                continue
+            jobs.append((md_path, update_dict))
+
+        update_time = datetime.datetime.now().strftime('\"%Y-%m-%d %H:%M:%S\"')
+        modified_paths = CitationGraph.set_vals_in_frontmatter_batch(jobs, {"updated": update_time}, num_workers)
+
+        if vault_index:
+            for md_path in modified_paths:
+                vault_index.add(md_path)
+            vault_index.save()
+        print("[+] Updated %d of %d files." % (len(modified_paths), len(md_paths)))
 
     def print_curr_papers(self, md_dir="", topic=""):
         """
@@ -513,6 +2895,7 @@ class CitationGraph:
 
         if md_dir:  # if create obsidian note templ at the same time.
             os.makedirs(md_dir, exist_ok=True)
+            vault_index = ObsidianVaultIndex.open(md_dir)
             for qp in qpapers:
                 uom = CitationGraph.UnifiedObsMetadata()
                 uom.title = qp[1].title
@@ -532,7 +2915,8 @@ class CitationGraph:
 
                 uom.scopus_id = qp[1].eid[7:] if qp[1].eid else ""
 
-                CitationGraph.create_obsidian_note_from_full(uom, md_dir, topic)
+                CitationGraph.create_obsidian_note_from_full(uom, md_dir, topic, vault_index)
+            vault_index.save()
 
         for case in range(2):
             if case == 0:
@@ -570,28 +2954,10 @@ class CitationGraph:
 
     @staticmethod
     def simplify_source_title(src):
-        src += " "
-        abbr_list = [
-            ("Transactions", "Trans."),
-            ("International", "Int."),
-            ("Journal", "J."),
-            (r"Robot[ics]*?\s", "Robot. "),
-            ("Research", "Res."),
-            ("Proceedings?", "Proc."),
-            ("Conferences?", "Conf."),
-            ("Intelligen(t|ce)", "Intell."),
-            (r"Systems?", "Syst."),
-            ("Science", "Sci."),
-            ("Automation", "Autom."),
-            ("Letters?", "Lett."),
-            (r" \- ", " "),
-            (r"Comput\w+?\s", "Comput. "),
-            (r"Europ\w+?\s", "Eur. ")
-        ]
-
-        for div in abbr_list:
-            src = re.sub(div[0], div[1], src)
-        return src.strip()
+        """
+        Abbreviated venue name, see VenueAbbreviator. The rules are set with venue_abbreviator.configure().
+        """
+        return venue_abbreviator(src)
 
     @staticmethod
     def parse_ref_two_authors(aunms, auids):
@@ -618,70 +2984,387 @@ class CitationGraph:
                 au1 = authors[0]
         return au1, au2
 
-    def print_refs(self, show_ref_pos=False, min_refs=1):
-        assert min_refs > 0
-        num_ignored = 0
+    RANK_KEYS = ("count", "pagerank", "authority", "hub", "per_year")
 
+    def ranked_refs(self, min_refs=1, limit=None, offset=0, sort_by="count", forward=False):
+        """
+        Cited references ranked by local citations (or a centrality score, see ref_scores), then global citations.
+        References in ignored_refs are pinned to the bottom regardless of min_refs. Only the rows in
+        [offset, offset + limit) are materialized, with a heap selection when a limit is given.
+        :param min_refs: minimum number of input papers citing a reference
+        :param limit: maximum number of rows, None for all
+        :param offset: number of rows to skip
+        :param sort_by: one of RANK_KEYS, only "count" if forward
+        :param forward: rank the papers citing the input papers instead (see get_cited_by), by the number of input
+            papers they cite
+        :return: generator of RankedRef
+        """
+        assert min_refs > 0 and offset >= 0
+        assert not forward or sort_by == "count"
+        store = self.citers if forward else self.refs
+        cited_indptr, cited_rows, cited_pos = store.cited_by()
+        ignored_ids = {store.ids.find(x) for x in self.ignored_refs} - {-1}
+        scores = None if sort_by == "count" else self.ref_scores(sort_by).tolist()
+
+        # sort keys: (score if any, local citations, global citations, node)
+        keys, pinned = [], []
+        node_id, node_citedby = store.node_id, store.node_citedby
+        for node in range(store.num_nodes):
+            cnt = cited_indptr[node + 1] - cited_indptr[node]
+            if not cnt:
+                continue
+            key = (cnt, max(node_citedby[node], 0), node) if scores is None else \
+                (scores[node], cnt, max(node_citedby[node], 0), node)
+            if node_id[node] in ignored_ids:
+                pinned.append(key)
+            elif cnt >= min_refs:
+                keys.append(key)
+
+        stop = None if limit is None else offset + limit
+        if stop is None or stop >= len(keys):
+            keys.sort(reverse=True)
+        else:
+            keys = heapq.nlargest(stop, keys)
+        num_kept = len(keys)
+        if stop is None or stop > len(keys):
+            pinned.sort(key=lambda k: (-k[-3], k[-2], k[-1]), reverse=True)  # the least cited first, as before
+            keys.extend(pinned)
+
+        for rank in range(offset, len(keys) if stop is None else min(stop, len(keys))):
+            node = keys[rank][-1]
+            lo, hi = cited_indptr[node], cited_indptr[node + 1]
+            yield RankedRef(rank + 1, node, hi - lo, rank >= num_kept, store.node_row(node),
+                            sorted(zip(cited_rows[lo: hi], cited_pos[lo: hi])),
+                            None if scores is None else scores[node])
+
+    def print_refs(self, show_ref_pos=False, min_refs=1, limit=None, offset=0, sort_by="count", forward=False):
         tab_head = ["#", "ref L", "ref G", "title", "year",
                     "first author", "last author",
                     "source title", "scopus_id"]
 
         col_widths = [6, 6, 6, 60, 4, 20, 20, 44, 12]
+        if sort_by != "count":  # show the score ranked by
+            tab_head.insert(1, sort_by)
+            col_widths.insert(1, 9)
         assert len(col_widths) == len(tab_head)
 
         fmt = "".join([" %%%d.%ds |" % (cw, cw) for cw in col_widths])
 
-        print("\n" + "#" * 32, "Cited papers by the group of %d:" % len(self.v_ref))
+        print("\n" + "#" * 32, ("Papers citing the group of %d:" if forward else "Cited papers by the group of %d:")
+              % len(self.v_ref))
         print(fmt % tuple(tab_head))
 
-        dat = []
-        for pair in self.curr_refs.items():
-            if pair[1]:
-                dat.append(pair[1])  # pair = (ref.id, [Reference, local_id_refpos_set])
-                if pair[1][0].id and pair[1][0].id in self.ignored_refs:
-                    num_ignored += 1
-
-        dat.sort(key=lambda x: (-len(x[1]) if x[0].id in self.ignored_refs else len(x[1]),
-                                int(x[0].citedbycount) if x[0].citedbycount and str(
-                                    x[0].citedbycount).isdigit() else 0,),
-                 reverse=True)
-
-        ref_cnt = min_refs
-        for i, itm in enumerate(dat):
-            if 0 < len(itm[1]) < ref_cnt:
-                continue
-
-            if i >= len(dat) - num_ignored and ref_cnt > 0:
+        in_pinned = False
+        for row in self.ranked_refs(min_refs, limit, offset, sort_by, forward):
+            if row.pinned and not in_pinned:
                 print("-" * 32, "References pinned to bottom:")
-                ref_cnt = -1
+                in_pinned = True
 
+            ref = row.ref
             local_sign = ""
-            if str(itm[0].id) in self.input_scopus_id:  # if the referred paper is an input query paper
+            if str(ref.id) in self.input_scopus_id:  # if the referred paper is an input query paper
                 local_sign = "*"
 
-            au1, au2 = self.parse_ref_two_authors(itm[0].authors, itm[0].authors_auid)
-
-            print(fmt % (str(i + 1),
-                         local_sign + str(len(itm[1])),
-                         str(itm[0].citedbycount) if str(itm[0].citedbycount).isdigit() else '-',
-                         str(itm[0].title),
-                         str(itm[0].coverDate[:4] if itm[0].coverDate else "-"),
-                         au1,
-                         au2,
-                         self.simplify_source_title(str(itm[0].sourcetitle)),
-                         str(itm[0].id),
-                         ), end='\t')
-            for j in sorted(list(itm[1])):
+            au1, au2 = self.parse_ref_two_authors(ref.authors, ref.authors_auid)
+
+            print(fmt % ((str(row.rank),) + (() if row.score is None else ("%.3e" % row.score,)) +
+                         (local_sign + str(row.count),
+                          str(ref.citedbycount) if ref.citedbycount is not None else '-',
+                          str(ref.title),
+                          str(ref.coverDate or "-"),
+                          au1,
+                          au2,
+                          self.simplify_source_title(str(ref.sourcetitle)),
+                          str(ref.id),
+                          )), end='\t')
+            for j in row.citing:
                 if show_ref_pos:
-                    print(" %2d:[%d]" % (j[0], int(j[1])), end=",")  # case 2: show ref position
+                    print(" %2d:[%d]" % (j[0], j[1]), end=",")  # case 2: show ref position
                 else:
                     print(" %2d:" % (j[0],), end=",")  # case 1: do not show reference position in each paper
             print()
 
+    def export_refs_csv(self, path, min_refs=1, limit=None, offset=0, sort_by="count", forward=False):
+        """
+        Write the ranked references, as printed by print_refs, to a csv file.
+        :param path:
+        :param min_refs:
+        :param limit:
+        :param offset:
+        :param sort_by: one of RANK_KEYS
+        :param forward: the papers citing the input papers instead, see get_cited_by
+        :return: number of rows written
+        """
+        n = 0
+        with open(path, 'w', newline='', encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["rank", "score", "ref_local", "pinned", "citing"] + list(RefRow._fields))
+            for row in self.ranked_refs(min_refs, limit, offset, sort_by, forward):
+                writer.writerow([row.rank, "" if row.score is None else row.score, row.count, int(row.pinned),
+                                 " ".join("%d:%d" % x for x in row.citing)] + list(row.ref))
+                n += 1
+        return n
+
+    def dedup_refs(self, **kwargs):
+        """
+        Merge the references that are the same work cited with slightly different titles, see ReferenceDeduplicator.
+        :param kwargs: passed to ReferenceDeduplicator
+        :return: number of merged references
+        """
+        canon = ReferenceDeduplicator(**kwargs).find_duplicates(self.refs)
+        merged = sum(1 for node, c in enumerate(canon) if c != node and self.refs.in_degree(node))
+        num, dropped = self.refs.merge_nodes(canon)
+        print("[+] Dedup: %d references merged, %d citations redirected, %d of them repeated within a paper." % (
+            merged, num, dropped))
+        return merged
+
+    def input_nodes(self):
+        """
+        Node of each input paper in the graph over the references and the input papers: the reference node if the
+        paper is also cited, else num_nodes + its index.
+        :return: numpy int64 array
+        """
+        import numpy as np
+
+        store = self.refs
+        row_node = np.arange(store.num_nodes, store.num_nodes + store.num_rows, dtype=np.int64)
+        for i, full in enumerate(self.v_full[:store.num_rows]):
+            sid = store.ids.find(full.eid[7:]) if full is not None and full.eid else -1
+            if sid >= 0 and sid in store.node_of_id:
+                row_node[i] = store.node_of_id[sid]
+        return row_node
+
+    def export_graph(self, path_prefix, fmt="parquet", chunk_size=65536):
+        """
+        Write the node table (input papers and cited references) and the edge table (citing, cited, position),
+        streamed in chunks. See GraphExporter.
+        :param path_prefix: e.g. out/slam -> out/slam_nodes.parquet and out/slam_edges.parquet
+        :param fmt: parquet, arrow, csv or graphml
+        :param chunk_size: rows per chunk
+        :return: list of the written paths
+        """
+        return GraphExporter(self, chunk_size).export(path_prefix, fmt)
+
+    def citation_matrix(self):
+        """
+        Square binary citing->cited matrix over the references and the input papers. An input paper that is also a
+        reference is the same node, the others are appended after the references of the store.
+        :return: (scipy.sparse.csr_matrix, node of each input paper)
+        """
+        import scipy.sparse as sp
+
+        store = self.refs
+        row_node = self.input_nodes()
+        n = store.num_nodes + store.num_rows
+
+        mat = store.adjacency_matrix().tocoo()
+        mat = sp.csr_matrix((mat.data, (row_node[mat.row], mat.col)), shape=(n, n))
+        mat.sum_duplicates()
+        mat.data[:] = 1.
+        mat.setdiag(0)  # Scopus lists some papers among their own references
+        mat.eliminate_zeros()
+        return mat, row_node
+
+    def pagerank(self, damping=0.85, tol=1e-10, max_iter=200):
+        """
+        PageRank of the citation graph by sparse power iteration. Dangling nodes (references without retrieved
+        references of their own) spread their rank uniformly.
+        :return: numpy array over the nodes of citation_matrix()
+        """
+        import numpy as np
+
+        mat = self.citation_matrix()[0]
+        n = mat.shape[0]
+        if not n:
+            return np.zeros(0)
+        out_deg = np.asarray(mat.sum(axis=1)).ravel()
+        dangling = out_deg == 0
+        inv_deg = np.where(dangling, 0., 1. / np.maximum(out_deg, 1))
+        mat_t = mat.T.tocsr()
+        rank = np.full(n, 1. / n)
+        for _ in range(max_iter):
+            new = damping * (mat_t @ (rank * inv_deg)) + (damping * rank[dangling].sum() + 1. - damping) / n
+            err = np.abs(new - rank).sum()
+            rank = new
+            if err < tol * n:
+                break
+        return rank
+
+    def hits(self, tol=1e-10, max_iter=200):
+        """
+        HITS hub and authority scores of the citation graph by sparse power iteration.
+        :return: (hubs, authorities), numpy arrays over the nodes of citation_matrix()
+        """
+        import numpy as np
+
+        mat = self.citation_matrix()[0]
+        mat_t = mat.T.tocsr()
+        n = mat.shape[0]
+        hubs = np.full(n, 1. / max(n, 1))
+        auths = hubs
+        for _ in range(max_iter):
+            auths = mat_t @ hubs
+            auths /= auths.sum() or 1.
+            new = mat @ auths
+            new /= new.sum() or 1.
+            err = np.abs(new - hubs).sum()
+            hubs = new
+            if err < tol:
+                break
+        return hubs, auths
+
+    def age_normalized_in_degree(self, this_year=None):
+        """
+        Local citations per year since publication, so that recent works central to the group are not outranked by
+        old surveys. References without a year get the median year.
+        :param this_year: defaults to the current year
+        :return: numpy array over the references of the store
+        """
+        import numpy as np
+
+        store = self.refs
+        this_year = this_year or datetime.date.today().year
+        cited_indptr = np.frombuffer(store.cited_by()[0], dtype=store.indptr.typecode)
+        years = np.frombuffer(store.node_year, dtype=store.node_year.typecode).astype(np.float64) \
+            if store.num_nodes else np.zeros(0)
+        known = years > 0
+        years[~known] = np.median(years[known]) if known.any() else this_year
+        return np.diff(cited_indptr) / np.maximum(this_year - years + 1., 1.)
+
+    def ref_scores(self, sort_by):
+        """
+        :param sort_by: one of RANK_KEYS but count
+        :return: numpy array over the references of the store
+        """
+        num = self.refs.num_nodes
+        if sort_by == "pagerank":
+            return self.pagerank()[:num]
+        elif sort_by == "authority":
+            return self.hits()[1][:num]
+        elif sort_by == "hub":
+            return self.hits()[0][:num]
+        elif sort_by == "per_year":
+            return self.age_normalized_in_degree()
+        raise ValueError("Unknown ranking %s, use one of %s" % (sort_by, ", ".join(self.RANK_KEYS)))
+
+    def co_citation_matrix(self, min_strength=2):
+        """
+        Co-citation strength of pairs of references: the number of input papers citing both, A^T A of the binary
+        citing->cited matrix A. References cited less than min_strength times cannot reach it and are left out of
+        the product.
+        :param min_strength:
+        :return: (scipy.sparse.csr_matrix over the kept references, array of their node ids in self.refs)
+        """
+        import numpy as np
+
+        mat = self.refs.adjacency_matrix()
+        nodes = np.flatnonzero(np.asarray(mat.sum(axis=0)).ravel() >= min_strength)
+        mat = mat[:, nodes]
+        return (mat.T @ mat).tocsr(), nodes
+
+    def bibliographic_coupling_matrix(self):
+        """
+        Bibliographic coupling of pairs of input papers: the number of references they share, A A^T of the binary
+        citing->cited matrix A.
+        :return: scipy.sparse.csr_matrix, input papers x input papers
+        """
+        mat = self.refs.adjacency_matrix()
+        return (mat @ mat.T).tocsr()
+
+    def print_co_citations(self, top_k=5, min_strength=2, max_refs=30):
+        """
+        For the most cited references, print the references most often cited together with them.
+        :param top_k: co-cited references shown per reference
+        :param min_strength: min number of input papers citing both
+        :param max_refs: number of references to show, by decreasing local citations
+        :return:
+        """
+        store = self.refs
+        co_mat, nodes = self.co_citation_matrix(min_strength)
+        top = ReferenceStore.top_k_per_row(co_mat, top_k, min_strength)
+
+        tab_head = ["#", "ref L", "co-cit", "title", "year", "source title", "scopus_id"]
+        col_widths = [6, 6, 6, 60, 4, 44, 12]
+        assert len(col_widths) == len(tab_head)
+
+        fmt = "".join([" %%%d.%ds |" % (cw, cw) for cw in col_widths])
+
+        print("\n" + "#" * 32, "Co-cited papers by the group of %d:" % len(self.v_ref))
+        print(fmt % tuple(tab_head))
+
+        ranked = sorted(top, key=lambda r: (-store.in_degree(int(nodes[r])), r))[:max_refs]
+        for i, r in enumerate(ranked):
+            for j, (c, strength) in enumerate([(r, None)] + top[r]):
+                ref = store.node_row(int(nodes[c]))
+                print(fmt % (str(i + 1) if strength is None else "",
+                             str(store.in_degree(int(nodes[c]))),
+                             "-" if strength is None else str(strength),
+                             str(ref.title) if strength is None else "  > " + str(ref.title),
+                             str(ref.coverDate or "-"),
+                             self.simplify_source_title(str(ref.sourcetitle)),
+                             str(ref.id)))
+
+    def print_bibliographic_coupling(self, top_k=3, min_shared=1):
+        """
+        For each input paper, print the input papers sharing the most references with it.
+        :param top_k: coupled papers shown per paper
+        :param min_shared: min number of shared references
+        :return:
+        """
+        top = ReferenceStore.top_k_per_row(self.bibliographic_coupling_matrix(), top_k, min_shared)
+
+        tab_head = ["#", "shared", "title", "cover date", "source title abbr", "doi"]
+        col_widths = [6, 6, 60, 12, 44, 32]
+        assert len(col_widths) == len(tab_head)
+
+        fmt = "".join([" %%%d.%ds |" % (cw, cw) for cw in col_widths])
+
+        print("\n" + "#" * 32, "Bibliographic coupling of the group of %d:" % len(self.v_ref))
+        print(fmt % tuple(tab_head))
+
+        for i, full in enumerate(self.v_full):
+            if not full or i not in top:
+                continue
+            for j, strength in [(i, None)] + top[i]:
+                print(fmt % (str(" %2d:" % j),
+                             "-" if strength is None else str(strength),
+                             str(self.v_full[j].title) if strength is None else "  > " + str(self.v_full[j].title),
+                             str(self.v_full[j].coverDate),
+                             str(self.v_full[j].sourcetitle_abbreviation),
+                             self.v_full[j].doi or ""))
+
     # Only supports doi as qid
     def load_bibliography_from_file(self, q_id):
+        return self.load_bibliographies_from_file([q_id]).get(q_id, [])
+
+    def load_bibliographies_from_file(self, q_ids):
+        """
+        Bulk load the parsed reference lists of many papers from the cache file. Papers only found in the legacy
+        per-paper csv files are migrated into it.
+        :param q_ids:
+        :return: dict of q_id: list of OldRefTup
+        """
+        ret = self.bib_cache.load_many(q_ids)
+
+        migrated = dict()
+        for q_id in q_ids:
+            if q_id not in ret:
+                ref_lst = self.load_bibliography_from_csv(q_id)
+                if ref_lst:
+                    migrated[q_id] = ret[q_id] = ref_lst
+        if migrated:
+            self.bib_cache.save_many(migrated)
+            print("[+] Migrated %d csv bibliographies into %s" % (len(migrated), self.bib_cache.path))
+        return ret
+
+    def load_bibliography_from_csv(self, q_id):
+        """
+        Legacy per-paper csv cache.
+        """
         cache_name = q_id.replace('/', '_') + ".csv"
         cache_path = os.path.join(self.cache_ref_dir, cache_name)
+        if not os.path.isfile(cache_path):
+            return []
 
         ret = []
         with open(cache_path, 'r', encoding="utf-8") as csvfile:
@@ -716,30 +3399,27 @@ class CitationGraph:
         if not ref_lst:
             return
 
-        cache_name = q_id.replace('/', '_') + ".csv"
-        cache_path = os.path.join(self.cache_ref_dir, cache_name)
-        os.makedirs(self.cache_ref_dir, exist_ok=True)
+        self.bib_cache.save_many({q_id: ref_lst})
+        print("[+] Saved parsed refs for: ", q_id)
 
-        with open(cache_path, 'w', newline='', encoding="utf-8") as csvfile:
-            csvw = csv.writer(csvfile, delimiter=';', quotechar='\"', quoting=csv.QUOTE_MINIMAL)
-            csvw.writerow(list(ref_lst[0]._fields))
-            for ref in ref_lst:
-                csvw.writerow(list(ref))
+    BIB_COL_WIDTHS = [6, 12, 60, 4, 20, 20, 44, 12]
 
-            print("[+] Saved parsed refs for: ", q_id)
-
-    def print_one_bib_entry(self, fmt, ref):
-        au1, au2 = self.parse_ref_two_authors(ref.authors, ref.authors_auid)
-        print(fmt % (
+    @staticmethod
+    def bib_entry_columns(ref):
+        au1, au2 = CitationGraph.parse_ref_two_authors(ref.authors, ref.authors_auid)
+        return (
             "[%s]" % str(ref.position),
             str(ref.citedbycount or '-'),
             str(ref.title),
             str(ref.coverDate[:4] if ref.coverDate else "-"),
             au1,
             au2,
-            self.simplify_source_title(str(ref.sourcetitle)),
+            CitationGraph.simplify_source_title(str(ref.sourcetitle)),
             str(ref.id)
-        ))
+        )
+
+    def print_one_bib_entry(self, fmt, ref):
+        print(fmt % self.bib_entry_columns(ref))
 
     def print_paper_bibliography(self, ii):
         """
@@ -756,7 +3436,7 @@ class CitationGraph:
         tab_head = ["[#]", "total cites", "title", "year",
                     "first author", "last author",
                     "source title", "scopus_id"]
-        col_widths = [6, 12, 60, 4, 20, 20, 44, 12]
+        col_widths = self.BIB_COL_WIDTHS
         assert len(col_widths) == len(tab_head)
 
         fmt = "".join([" %%%d.%ds |" % (cw, cw) for cw in col_widths])
@@ -765,25 +3445,49 @@ class CitationGraph:
         for ref in self.v_ref[ii]:
             self.print_one_bib_entry(fmt, ref)
 
-    def live_bib_lookup(self, ii):
+    def lookup_service(self):
+        """
+        :return: ReferenceLookupService over the current graph, to be rebuilt after the graph changes
+        """
+        return ReferenceLookupService(self)
+
+    def serve_lookups(self, host="127.0.0.1", port=ReferenceLookupService.DEFAULT_PORT):
+        """
+        Serve reference lookups over HTTP on localhost until interrupted, see ReferenceLookupService.serve.
+        """
+        self.lookup_service().serve(host, port)
+
+    def live_bib_lookup(self, ii, service_url=None):
+        """
+        Watch the clipboard and print the reference of paper ii at the position number found in it, or the
+        reference with the DOI found in it.
+        :param ii: index of the input paper
+        :param service_url: query a running lookup service (see serve_session) instead of building one here
+        :return:
+        """
+        import pyperclip
+
         def cbk(clipboard_content):
+            res = re.search(r"\b10\.\d{4,9}/\S+", clipboard_content)
+            if res:
+                print("Found DOI %s in: `%s`" % (res.group(), str(clipboard_content)))
+                return {"doi": res.group().rstrip(".,;")}
             res = re.search(r"\d+", clipboard_content)
             if res:
                 num = int(res.group())
                 if 0 < num < 1000:
                     print("Found number %d in: `%s`" % (num, str(clipboard_content)))
-                    return num
-            return -1
-
-        assert len(self.input_doi) == len(self.v_ref)
-        assert len(self.input_doi) == len(self.v_full)
-        assert 0 <= ii < len(self.v_ref)
-        assert self.v_ref[ii]  # not none
-
-        max_ref = len(self.v_ref[ii])
-
-        col_widths = [6, 12, 60, 4, 20, 20, 44, 12]
-        fmt = "".join([" %%%d.%ds |" % (cw, cw) for cw in col_widths])
+                    return {"paper": ii, "pos": num}
+            return None
+
+        if service_url:
+            lookup = functools.partial(ReferenceLookupService.query, service_url)
+        else:
+            assert len(self.input_doi) == len(self.v_ref)
+            assert len(self.input_doi) == len(self.v_full)
+            assert 0 <= ii < len(self.v_ref)
+            assert self.v_ref[ii]  # not none
+            lookup = self.lookup_service().lookup
 
         recent_value = ""
         while True:
@@ -791,217 +3495,619 @@ class CitationGraph:
             if tmp_value != recent_value:
                 print(recent_value, tmp_value)
                 recent_value = tmp_value
-                pos = cbk(recent_value)
-                if 0 < pos <= max_ref:
-                    self.print_one_bib_entry(fmt, self.v_ref[ii][pos - 1])
+                query = cbk(recent_value)
+                if query:
+                    for entry in lookup(**query):
+                        print(entry["text"])
             time.sleep(0.5)
 
     @staticmethod
-    def get_bib_entry_worker(q_id, q_fail, sig, refresh_days=99, proc_id=0):
+    def scopus_cache_path(iid, view):
         """
-        Query using items from the queue of ids, and save the result to the queue of results
-        :param q_id: (item_id)
-        :param q_fail: (item_id), or None if success.
-        :param sig:
-        :param refresh_days:
-        :param proc_id:
+        Where pybliometrics caches the AbstractRetrieval of an identifier
+        :param iid:
+        :param view:
         :return:
         """
+        load_scopus()
+        parent = get_config().get('Directories', 'AbstractRetrieval')
+        return os.path.join(parent, view, str(iid).replace('/', '_'))
 
-        cnt_total = 0
-        cnt_quota = 0
-        while True:
-            res = [None] * 3  # temp result holder, will be appended to q_res as tuple (scopus_id, v_full, v_ref)
-            try:
-                itm_rem = q_id.qsize()
-                iid = q_id.get(block=True, timeout=1)
-                print("[+] Remaining: %d" % itm_rem)
-            except queue.Empty:
-                if q_id.empty():  # failure to get() does not mean the queue is empty, weird
-                    print("[!] Queue is empty!")
-                    break
-                else:
-                    continue
+    @staticmethod
+    def is_scopus_cached(iid, view, refresh_days):
+        """
+        Whether an AbstractRetrieval with `refresh=refresh_days` will read the cache instead of querying Scopus.
+        Mirrors the file age check of pybliometrics.
+        """
+        try:
+            mod_ts = os.stat(CitationGraph.scopus_cache_path(iid, view)).st_mtime
+        except (FileNotFoundError, ScopusOfflineError):
+            return False
+        return int((time.time() - mod_ts) / 86400) + 1 <= refresh_days
 
-            try:
-                print("[+] Querying FULL %s" % iid)
-                ab = AbstractRetrieval(iid, view='FULL', refresh=refresh_days)
-                quota_rem = ab.get_key_remaining_quota()
-                if quota_rem:
-                    cnt_quota += 1
-                    print("[+] Remaining quota: %s " % quota_rem)
-                res[0] = ab.eid[7:]
-                res[1] = ab
-            except Scopus404Error as e1:
-                print(" !  FULL view of DOI: ", iid, "cannot be found!")
-            except Exception as e:
-                print(" !  Unhandled exception:", e)
+    @staticmethod
+    def init_bib_entry_worker(bucket, metrics_enabled=False):
+        """
+        Initializer of the worker processes.
+        :param bucket: TokenBucket(shared=True) limiting the Scopus requests of all the workers
+        :param metrics_enabled: collect metrics, drained into each RetrievalResult
+        :return:
+        """
+        global _worker_bucket
+        _worker_bucket = bucket
+        metrics.enable(metrics_enabled)
+        metrics.reset()  # a forked worker starts with a copy of the metrics of the main process
 
+    @staticmethod
+    def record_retrieval(iid, view, outcome, t0):
+        """
+        :param iid:
+        :param view: FULL or REF
+        :param outcome: cache_hit, fetched, not_found, empty, offline_miss or error
+        :param t0: time.perf_counter() at the start of the retrieval
+        :return:
+        """
+        if not metrics.enabled:
+            return
+        metrics.inc("scopus_retrievals_total", view=view, outcome=outcome)
+        metrics.observe("scopus_retrieval_seconds", time.perf_counter() - t0, view=view, outcome=outcome)
+        if outcome == "cache_hit":
             try:
-                if res[1] is None:
-                    raise ValueError("FULL view already failed.")
-                print("[+] Query REF %s" % iid)
-                ab = AbstractRetrieval(iid, view='REF', refresh=refresh_days)
-                quota_rem = ab.get_key_remaining_quota()
-                if quota_rem:
-                    cnt_quota += 1
-                    print("[+] Remaining quota: %s " % quota_rem)
-                if not ab.references:
-                    raise ValueError(" !  Empty references!")
-                assert len(ab.references) == ab.refcount
-                res[2] = ab.references
-            except Scopus404Error as e1:
-                print(" !  REF view of DOI: ", iid, "cannot be found!")
-            except ValueError as e2:
-                print(" !  REF view of DOI: ", iid, e2)
-            finally:
-                if res[1] is None or res[2] is None:
-                    q_fail.put(iid)
-                else:
-                    q_fail.put(None)  # placeholder for success
-                cnt_total += 1
+                metrics.inc("scopus_cache_read_bytes_total", os.path.getsize(
+                    CitationGraph.scopus_cache_path(iid, view)), view=view)
+            except OSError:
+                pass
 
-        print("[+] Process #%d finished. %d items processed, %d quota used." % (proc_id, cnt_total, cnt_quota))
-        with sig.get_lock():
-            sig.value += 1
+    @staticmethod
+    def project_full(ab):
+        """
+        Compact, picklable projection of a FULL view, with the attribute names of AbstractRetrieval used here.
+        """
+        return FullRecord(ab.title, ab.doi, ab.eid, ab.citedby_count, ab.coverDate, ab.sourcetitle_abbreviation,
+                          ab.refcount,
+                          [AuthorRecord(au.auid, au.indexed_name, au.surname, au.given_name)
+                           for au in ab.authors or []],
+                          [AffiliationRecord(af.id, af.name) for af in ab.affiliation or []])
 
-    def get_bibliography_info_parallel(self):
+    @staticmethod
+    def project_refs(references):
         """
-        A brilliant way to bypass the limitation of the inability of pickling pybliometrics objects during
-        multiprocessing, using the caching system of pybliometrics.
-        :return:
+        Compact, picklable projection of the references of a REF view.
         """
-        q_id = mp.Queue()
-        q_fail = mp.Queue()
-        fin_sig = mp.Value('i', 0)
-        procs = []
+        return [RefRow(ref.position, ref.id, ref.doi, ref.title, ref.authors, ref.authors_auid, ref.sourcetitle,
+                       ref.coverDate, ref.citedbycount) for ref in references]
 
-        for iid in self.input_doi:
-            q_id.put(iid)
+    @staticmethod
+    def get_bib_entry_worker(iid, refresh_days=99, bucket=None, offline=False):
+        """
+        Query both views of one id. Runs in the worker processes of get_bibliography_info_parallel, or in the main
+        process for get_bibliography_info. Only compact records go back, the pybliometrics objects cannot be pickled.
+        :param iid: item id
+        :param refresh_days:
+        :param bucket: TokenBucket limiting the Scopus requests. Defaults to the one shared by the worker processes.
+        :param offline: only read the pybliometrics cache, whatever its age. Ids not in it fail.
+        :return: RetrievalResult, with full or refs None if failed
+        """
+        bucket = bucket or _worker_bucket
+        full = refs = None
+        failure = None
+        cnt_quota = 0
+        quota_info = [None, None]  # last seen (remaining quota, reset time)
+        refresh = False if offline else refresh_days
+
+        def check_offline(view):
+            load_scopus(offline)
+            if offline and not os.path.isfile(CitationGraph.scopus_cache_path(iid, view)):
+                raise ScopusOfflineError("%s view of %s not in the cache" % (view, iid))
+
+        t0 = time.perf_counter()
+        try:
+            check_offline('FULL')
+            if bucket and not CitationGraph.is_scopus_cached(iid, 'FULL', refresh_days):
+                bucket.acquire()
+            print("[+] Querying FULL %s" % iid)
+            ab = AbstractRetrieval(iid, view='FULL', refresh=refresh)
+            quota_rem = ab.get_key_remaining_quota()
+            if quota_rem:  # really queried Scopus instead of reading cache
+                cnt_quota += 1
+                quota_info = [quota_rem, ab.get_key_reset_time()]
+                print("[+] Remaining quota: %s " % quota_rem)
+            full = CitationGraph.project_full(ab)
+            CitationGraph.record_retrieval(iid, 'FULL', "fetched" if quota_rem else "cache_hit", t0)
+        except ScopusOfflineError as e0:
+            print(" !  Offline:", e0)
+            failure = "offline_miss"
+        except Scopus404Error as e1:
+            print(" !  FULL view of DOI: ", iid, "cannot be found!")
+            failure = "not_found"
+        except Exception as e:
+            print(" !  Unhandled exception:", e)
+            failure = "error"
+        if failure:
+            CitationGraph.record_retrieval(iid, 'FULL', failure, t0)
+
+        t0 = time.perf_counter()
+        outcome = "error"
+        try:
+            if full is None:
+                raise ValueError("FULL view already failed.")
+            check_offline('REF')
+            if bucket and not CitationGraph.is_scopus_cached(iid, 'REF', refresh_days):
+                bucket.acquire(max(1, math.ceil((full.refcount or 0) / SCOPUS_REFS_PER_PAGE)))
+            print("[+] Query REF %s" % iid)
+            # Outdated as of pybliometrics v4.1
+            # start_ref = 1  # start at 1, but give a 0 is ok (still fetches first 40 references)
+            ab = AbstractRetrieval(iid, view='REF', refresh=refresh)
+            quota_rem = ab.get_key_remaining_quota()
+            outcome = "fetched" if quota_rem else "cache_hit"
+            if quota_rem:
+                cnt_quota += max(1, math.ceil(len(ab.references or []) / SCOPUS_REFS_PER_PAGE))
+                quota_info = [quota_rem, ab.get_key_reset_time()]
+                print("[+] Remaining quota: %s " % quota_rem)
+            if not ab.references:
+                outcome = "empty"
+                raise ValueError(" !  Empty references!")
+            assert len(ab.references) == ab.refcount
+            refs = CitationGraph.project_refs(ab.references)
+        except ScopusOfflineError as e0:
+            print(" !  Offline:", e0)
+            outcome = "offline_miss"
+        except Scopus404Error as e1:
+            print(" !  REF view of DOI: ", iid, "cannot be found!")
+            outcome = "not_found"
+        except ValueError as e2:
+            print(" !  REF view of DOI: ", iid, e2)
+        except Exception as e:
+            print(" !  Unhandled exception:", e)
+            outcome = "error"
+        if full is not None:
+            CitationGraph.record_retrieval(iid, 'REF', outcome, t0)
+            if refs is None:
+                failure = outcome
+
+        # in a worker process, hand the metrics over to the main process
+        worker_metrics = metrics.drain() if metrics.enabled and _worker_bucket is not None else None
+        return RetrievalResult(iid, full, refs, cnt_quota, quota_info[0], quota_info[1], worker_metrics, failure)
+
+    PERMANENT_FAILURES = ("not_found", "empty")
+
+    def add_retrieval(self, res):
+        """
+        Append the retrieval result of the next input paper to v_full, v_ref and the reference store. Only the papers
+        Scopus does not have (or has without references) go to fail_set; the ones deferred by the quota budget, missing
+        from the cache offline or hit by an error can be retried, see retry_failed.
+        :param res: RetrievalResult
+        :return:
+        """
+        self.v_full.append(res.full)
+        if res.full is not None:
+            self.input_scopus_id.add(res.full.eid[7:])
+        if res.full is None or res.refs is None:
+            if res.failure in self.PERMANENT_FAILURES:
+                self.fail_set.add(res.iid)
+            self.v_ref.append(None)
+            self.refs.add_paper([])  # keep the rows aligned with the input papers
+        else:
+            # row i of the adjacency, parent id is not available in REF view
+            self.v_ref.append(self.refs.add_paper(res.refs))
+            self._corpus_pending.append((res.iid, res.full, res.refs))
+
+    def index_references(self, start=0):
+        """
+        Add the reference lists retrieved from input paper `start` on to the search index, see search_references.
+        Unchanged reference lists are skipped.
+        :param start:
+        :return:
+        """
+        papers = [(self.input_doi[i], self.v_full[i].title, list(self.v_ref[i]))
+                  for i in range(start, len(self.v_ref)) if self.v_ref[i] is not None]
+        try:
+            num = self.search_index.add_many(papers)
+        except sqlite3.Error as e:
+            print(" !  Failed to update the reference index %s: %s" % (self.search_index.path, e))
+            return
+        if num:
+            print("[+] Indexed the references of %d papers in %s" % (num, self.search_index.path))
 
-        for i in range(self.num_proc):
-            rolled_refresh_days = random.randint(self.min_refresh, self.max_age)
-            p = mp.Process(target=self.get_bib_entry_worker, args=(q_id, q_fail, fin_sig, rolled_refresh_days, i,))
-            procs.append(p)
+    def index_bibliography_cache(self, chunk=500):
+        """
+        Add the reference lists in the parsed bibliography cache (see BibliographyCache) to the search index.
+        :param chunk: papers per transaction
+        :return:
+        """
+        q_ids = self.bib_cache.cached_ids()
+        num = 0
+        for c in range(0, len(q_ids), chunk):
+            bibs = self.bib_cache.load_many(q_ids[c: c + chunk])
+            num += self.search_index.add_many((q_id, None, ref_lst) for q_id, ref_lst in bibs.items())
+        print("[+] Indexed the references of %d out of %d cached papers" % (num, len(q_ids)))
+
+    def search_references(self, query, limit=20, offset=0, verbose=True):
+        """
+        Full-text search of the references of every paper indexed so far, in this or earlier runs.
+        :param query: keywords, "quoted phrases", prefix*, column filters (title, authors, venue, year), AND/OR/NOT
+        :param limit:
+        :param offset:
+        :param verbose: print the hits as a table
+        :return: list of SearchHit, best first
+        """
+        hits = self.search_index.search(query, limit, offset)
+        if verbose:
+            print("\n" + "#" * 32, "References matching `%s`:" % query)
+            col_widths = [8, 24, 6, 60, 4, 20, 44]
+            fmt = "".join([" %%%d.%ds |" % (cw, cw) for cw in col_widths])
+            print(fmt % ("score", "cited by", "[#]", "title", "year", "first author", "source title"))
+            for hit in hits:
+                au1, _ = self.parse_ref_two_authors(hit.authors, None)
+                print(fmt % ("%.2f" % -hit.score, hit.q_id, "[%s]" % hit.position, str(hit.title),
+                             hit.year or "-", au1, self.simplify_source_title(str(hit.venue))))
+        return hits
+
+    def get_cited_by(self, since_last_run=False, num_workers=4, subscriber=True):
+        """
+        Forward citations: the papers citing the input papers, from the Scopus Search API (see CitedBySearch), into
+        self.citers, so that print_refs(forward=True) and export_refs_csv(forward=True) rank them like the
+        references. The requests count against the quota budget.
+        :param since_last_run: only ask for the citing papers loaded into Scopus since the last search of each paper
+        :param num_workers: result pages fetched at a time, within the API rate limit
+        :param subscriber: whether the API key comes with a Scopus subscription (200 instead of 25 results per page),
+            as for pybliometrics' ScopusSearch
+        :return: number of distinct citing papers
+        """
+        max_requests = None
+        if not self.offline:
+            load_scopus()
+            max_requests = self.budget.allowance()
+        search = CitedBySearch(os.path.join(BASE_PATH, CitedBySearch.DIR_NAME), self.max_age, self.offline,
+                               num_workers, max_requests, subscriber=subscriber)
+        eids = [full.eid for full in self.v_full if full is not None and full.eid]
+        try:
+            found = search.cited_by(eids, since_last_run)
+        finally:
+            search.close()
+        if search.n_requests:
+            self.budget.charge(search.n_requests)
+            self.budget.save()
+
+        self.citers = ReferenceStore()
+        for i in range(len(self.input_doi)):
+            full = self.v_full[i] if i < len(self.v_full) else None
+            self.citers.add_paper(found.get(full.eid, []) if full is not None else [])
+        print("[+] %d papers cite the %d input papers searched (%d requests)." % (
+            self.citers.num_nodes, len(found), search.n_requests))
+        return self.citers.num_nodes
+
+    def record_corpus(self):
+        """
+        Record the papers retrieved since the last call in the corpus (see PaperCorpus), in one transaction.
+        :return:
+        """
+        try:
+            num = self.corpus.add_many(self._corpus_pending, self.group)
+        except sqlite3.Error as e:
+            print(" !  Failed to update the corpus %s: %s" % (self.corpus.path, e))
+            return
+        self._corpus_pending = []
+        if num:
+            print("[+] Recorded %d new or changed papers in %s" % (num, self.corpus.path))
 
-        for p in procs:
-            p.start()
+    @classmethod
+    def from_corpus(cls, identifiers=(), citing=(), groups=(), corpus_path=None, **kwargs):
+        """
+        Graph of papers recorded in the corpus by earlier runs, without any API call. The input papers are the union
+        of the given identifiers, the papers citing any of `citing` and the papers of any of `groups`; the ones not
+        in the corpus are marked as failed.
+        :param identifiers: DOIs or other identifiers, as given to the constructor
+        :param citing: scopus ids or DOIs
+        :param groups: group names, see the group argument of the constructor
+        :param corpus_path: the corpus of the pybliometrics directory by default
+        :param kwargs: passed to the constructor
+        :return: CitationGraph
+        """
+        corpus = PaperCorpus(corpus_path or os.path.join(BASE_PATH, PaperCorpus.FILE_NAME))
+        ids = list(identifiers)
+        if groups:
+            ids += corpus.group_ids(*([groups] if isinstance(groups, str) else groups))
+        for identifier in [citing] if isinstance(citing, str) else citing:
+            ids += corpus.citing(identifier)
+
+        cg = cls(corpus.resolve(ids), **kwargs)  # union, in order, each paper once
+        cg.corpus = corpus
+        records = corpus.load_many(cg.input_doi)
+        for iid in cg.input_doi:
+            full, refs = records.get(iid, (None, None))
+            cg.add_retrieval(RetrievalResult(iid, full, refs, 0, None, None))
+        cg._corpus_pending = []
+        print("[+] Loaded %d out of %d papers from %s" % (len(records), len(cg.input_doi), corpus.path))
+        return cg
+
+    def print_retrieval_summary(self):
+        print("#" * 32 + " Failed: %d out of %d" % (self.v_ref.count(None), len(self.v_ref)))
+        for i, ref in enumerate(self.v_ref):
+            if not ref:
+                print("%4d | %32s |" % (i, self.input_doi[i]))
+        print()
 
-        # wait till finished, then we start to harvest the results
-        while fin_sig.value < self.num_proc:
-            time.sleep(0.1)
-        assert q_fail.qsize() == len(self.input_doi)  # this is certain and reliable since all the processes are done
+        # failed ids stay in the backlog, unless they will never be found
+        done = [iid for iid, ref in zip(self.input_doi, self.v_ref) if ref is not None or iid in self.fail_set]
+        self.budget.save(self.backlog, done, self.group)
+        if self.backlog:
+            print("[!] %d ids deferred to the backlog (%s), resume with ScopusQuotaBudget().load_backlog(%r)" % (
+                len(self.backlog), self.budget.path, self.group))
 
-        # empty the queue otherwise the main process will be blocked
-        lst_res = []
-        while len(lst_res) < len(self.input_doi):
-            # time.sleep(0.01)  # q_res.qsize() and q_res.empty() are not reliable. Is q_res.get() reliable?
-            # print(q_fail.qsize(), q_fail.empty())
-            lst_res.append(q_fail.get())
+    def get_bibliography_info_parallel(self):
+        """
+        The workers return compact records instead of the pybliometrics objects, which cannot be pickled, and the
+        main process builds the graph from them directly.
+        The Scopus requests of all the workers share one token bucket, so any number of processes stays within the
+        API rate limit. Only the ids added since the last retrieval are retrieved.
+        :return:
+        """
+        bucket = TokenBucket(rate=SCOPUS_REQ_PER_SEC, capacity=SCOPUS_REQ_PER_SEC, shared=True)
+
+        start = len(self.v_full)
+        refresh_days = {iid: random.randint(self.min_refresh, self.max_age) for iid in self.input_doi[start:]
+                        if iid not in self.fail_set}
+        if self.offline:
+            to_run, self.backlog = list(refresh_days), []
+        else:
+            load_scopus()
+            to_run, self.backlog = self.budget.plan(refresh_days)
+
+        results = dict()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.num_proc,
+                                                    initializer=CitationGraph.init_bib_entry_worker,
+                                                    initargs=(bucket, metrics.enabled)) as executor:
+            # submitted in the order of value, so that the ones cancelled when the budget runs out are the least useful
+            futures = {executor.submit(CitationGraph.get_bib_entry_worker, iid, refresh_days[iid], None,
+                                       self.offline): iid
+                       for iid in to_run}
+            for fut in concurrent.futures.as_completed(futures):
+                if fut.cancelled():
+                    continue
+                res = fut.result()
+                metrics.merge(res.metrics)
+                results[res.iid] = res
+                print("[+] Finished %d/%d" % (len(results), len(futures)))
+                if self.offline:
+                    continue
 
-        # print(q_fail.qsize(), q_fail.empty())
+                self.budget.charge(res.n_requests, res.quota_rem, res.reset_time)
+                allowance = self.budget.allowance()
+                if allowance is not None and allowance <= 0:
+                    for other, iid in futures.items():
+                        if other.cancel():
+                            self.backlog.append(iid)
 
-        print(len(lst_res))
         print("[+] All processes finished...")
-        for p in procs:
-            p.join()
-        print("[+] All processes joined.")
 
         print("#" * 32 + " Funnel into the main process")
+        for iid in self.input_doi[start:]:
+            self.add_retrieval(results.get(iid) or RetrievalResult(
+                iid, None, None, 0, None, None, failure=None if iid in self.fail_set else "deferred"))
 
-        # find the failed ones and add to the fail set
-        for res in lst_res:
-            if res:
-                self.fail_set.add(res)
+        self.index_references(start)
+        self.record_corpus()
+        self.print_retrieval_summary()
+
+    def get_bibliography_info(self):
+        """
+        Only the ids added since the last call are retrieved, so that the graph can grow incrementally.
+        :return:
+        """
+        start = len(self.v_full)
+        refresh_days = {doi: random.randint(self.min_refresh, self.max_age) for doi in self.input_doi[start:]
+                        if doi not in self.fail_set}
+        if self.offline:
+            self.backlog = []
+        else:
+            load_scopus()
+            _, self.backlog = self.budget.plan(refresh_days)
+        deferred = set(self.backlog)
+
+        for i in range(start, len(self.input_doi)):
+            doi = self.input_doi[i]
+            print("[+] Query %d/%d" % (i + 1, len(self.input_doi)))
+
+            if doi in self.fail_set:
+                print(" !  %s in fail set, skipped." % doi)
+                self.add_retrieval(RetrievalResult(doi, None, None, 0, None, None))
+                continue
 
-        # use the single process method to get the references by reading the cache
-        CitationGraph.get_bibliography_info(self, refresh_offset=999)
+            if doi not in deferred and not self.offline:
+                allowance = self.budget.allowance()
+                if allowance is not None and allowance < ScopusQuotaBudget.estimate_cost(doi, refresh_days[doi]):
+                    self.backlog.append(doi)
+                    deferred.add(doi)
+            if doi in deferred:
+                print(" !  %s deferred to the backlog, over the quota budget." % doi)
+                self.add_retrieval(RetrievalResult(doi, None, None, 0, None, None, failure="deferred"))
+                continue
 
-    def get_bibliography_info(self, refresh_offset=0):
-        for i, doi in enumerate(self.input_doi):
-            rolled_refresh_days = random.randint(self.min_refresh, self.max_age) + refresh_offset
+            res = self.get_bib_entry_worker(doi, refresh_days[doi], bucket=None, offline=self.offline)
+            if not self.offline:
+                self.budget.charge(res.n_requests, res.quota_rem, res.reset_time)
+            self.add_retrieval(res)
 
-            # query FULL data
-            try:
-                print("[+] Query FULL %d/%d" % (i + 1, len(self.input_doi)))
-
-                if doi in self.fail_set:
-                    raise ValueError("In fail set, skipped.")
-
-                ab = AbstractRetrieval(doi, view='FULL', refresh=rolled_refresh_days)
-                quota_rem = ab.get_key_remaining_quota()
-
-                if quota_rem:  # really queried Scopus instead of reading cache
-                    print("[+] Remaining quota: %s " % quota_rem)
-
-                self.v_full.append(ab)
-                self.input_scopus_id.add(ab.eid[7:])
-
-            except Scopus404Error as e1:
-                print(" !  FULL view of DOI: ", doi, "cannot be found!")
-                self.fail_set.add(doi)
-                self.v_full.append(None)
-            except ValueError as e2:
-                print(" !  FULL view of DOI: ", doi, e2)
-                self.fail_set.add(doi)
-                self.v_full.append(None)
-            except Exception as e:
-                print(" !  Unhandled exception:", e)
-                self.fail_set.add(doi)
-                self.v_full.append(None)
-
-            # query REF data
-            try:
-                all_curr_refs = []
-                # Outdated as of pybliometrics v4.1
-                # start_ref = 1  # start at 1, but give a 0 is ok (still fetches first 40 references)
+        self.index_references(start)
+        self.record_corpus()
+        self.print_retrieval_summary()
+
+    def retrieve_new(self):
+        """
+        Retrieve the input papers added since the last retrieval, in parallel if num_proc > 1.
+        :return:
+        """
+        if self.num_proc > 1:
+            self.get_bibliography_info_parallel()
+        else:
+            self.get_bibliography_info()
 
-                # test if corresponding FULL is successful
-                if doi in self.fail_set:
-                    raise ValueError("FULL view already failed.")
+    SESSION_VERSION = 1
 
-                print("[+] Query REF %d/%d" % (i + 1, len(self.input_doi)))
-                ab = AbstractRetrieval(doi, view='REF', refresh=rolled_refresh_days)
+    def save_session(self, path):
+        """
+        Save the whole graph state, so that a later run can add or remove papers without retrieving everything again.
+        :param path:
+        :return:
+        """
+        state = {
+            "version": self.SESSION_VERSION,
+            "input_doi": self.input_doi,
+            "input_hop": self.input_hop,
+            "input_scopus_id": self.input_scopus_id,
+            "v_full": self.v_full,
+            "ref_ok": [x is not None for x in self.v_ref],
+            "refs": self.refs,
+            "citers": self.citers,
+            "fail_set": self.fail_set,
+            "ignored_refs": self.ignored_refs,
+            "backlog": self.backlog,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        print("[+] Session saved: %s (%d papers, %d references)" % (path, len(self.input_doi), self.refs.num_nodes))
+
+    @classmethod
+    def load_session(cls, path, **kwargs):
+        """
+        :param path:
+        :param kwargs: passed to the constructor, e.g. num_proc. An ignore_lst adds to the saved ignored references.
+        :return: CitationGraph
+        """
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state.get("version") != cls.SESSION_VERSION:
+            raise ValueError("Unknown session version %s: %s" % (state.get("version"), path))
+
+        cg = cls([], **kwargs)
+        cg.input_doi = state["input_doi"]
+        cg.input_hop = state["input_hop"]
+        cg.input_scopus_id = state["input_scopus_id"]
+        cg.v_full = state["v_full"]
+        cg.refs = state["refs"]
+        cg.citers = state.get("citers") or ReferenceStore()
+        cg.v_ref = [PaperRefs(cg.refs, i) if ok else None for i, ok in enumerate(state["ref_ok"])]
+        cg.fail_set = state["fail_set"]
+        cg.ignored_refs = state["ignored_refs"] | cg.ignored_refs  # plus the ignore_lst given now, if any
+        cg.backlog = state["backlog"]
+        print("[+] Session loaded: %s (%d papers, %d references)" % (path, len(cg.input_doi), cg.refs.num_nodes))
+        return cg
+
+    def add_identifiers(self, doi_lst):
+        """
+        Add input papers to a loaded graph, only the new ones are retrieved.
+        :param doi_lst: DOIs or other identifiers
+        :return: number of papers added
+        """
+        known = set(self.input_doi)
+        added = 0
+        for doi in doi_lst:
+            doi_san = doi.strip().upper()
+            if doi_san in known:
+                print("[!] Duplicate doi: %s" % doi_san)
+                continue
+            known.add(doi_san)
+            self.input_doi.append(doi_san)
+            self.input_hop.append(0)
+            added += 1
 
-                quota_rem = ab.get_key_remaining_quota()
-                if quota_rem:  # really queried Scopus instead of reading cache
-                    print("[+] Remaining quota: %s " % quota_rem)
+        if added:
+            self.retrieve_new()
+        return added
 
-                if not ab.references:
-                    raise ValueError(" !  Empty references!")
+    def retry_failed(self):
+        """
+        Retrieve again the input papers that failed for a reason that may not last: deferred by the quota budget,
+        missing from the cache offline, or an error. They move to the end of the input list.
+        :return: number of papers retried
+        """
+        failed = [doi for i, doi in enumerate(self.input_doi) if self.v_ref[i] is None and doi not in self.fail_set]
+        if not failed:
+            return 0
+        hops = {doi: self.input_hop[i] for i, doi in enumerate(self.input_doi)}
+        self.remove_identifiers(failed)
+        self.input_doi.extend(failed)
+        self.input_hop.extend(hops[doi] for doi in failed)
+        self.retrieve_new()
+        return len(failed)
+
+    def remove_identifiers(self, doi_lst):
+        """
+        Remove input papers and their references from the graph, without retrieving anything. Indices of the later
+        input papers move up.
+        :param doi_lst: DOIs or other identifiers, as given to the constructor
+        :return: number of papers removed
+        """
+        to_remove = {doi.strip().upper() for doi in doi_lst}
+        rows = [i for i, doi in enumerate(self.input_doi) if doi in to_remove]
+        if not rows:
+            return 0
+
+        self.refs.remove_rows(rows)
+        self.citers.remove_rows(rows)
+        removed = set(rows)
+        keep = [i for i in range(len(self.input_doi)) if i not in removed]
+        self.input_doi = [self.input_doi[i] for i in keep]
+        self.input_hop = [self.input_hop[i] for i in keep]
+        self.v_full = [self.v_full[i] for i in keep]
+        self.v_ref = [PaperRefs(self.refs, k) if self.v_ref[i] is not None else None for k, i in enumerate(keep)]
+        self.input_scopus_id = {full.eid[7:] for full in self.v_full if full is not None}
+        self.fail_set -= to_remove
+        print("[+] Removed %d papers, %d left." % (len(rows), len(self.input_doi)))
+        return len(rows)
+
+    def crawl(self, depth=2, min_refs=2, max_nodes=500):
+        """
+        Expand the graph hop by hop: at each level, the references cited by at least `min_refs` papers of the graph
+        become input papers themselves, and their references are retrieved. Only the rows added at the previous
+        level are scanned for new candidates, and nothing already in the graph is fetched again.
+        :param depth: number of hops from the initial input papers, 1 for the initial papers only
+        :param min_refs: min local citations of a reference to be promoted to the next frontier
+        :param max_nodes: max total number of input papers
+        :return:
+        """
+        assert depth >= 1 and min_refs >= 1
+        if len(self.v_full) < len(self.input_doi):
+            self.retrieve_new()
+
+        known = {x.upper() for x in self.input_doi} | self.input_scopus_id | self.fail_set | self.ignored_refs
+        pending = set()  # promotable nodes left out by max_nodes, they stay candidates of the next level
+        scanned_rows = 0
+        for level in range(1, depth):
+            store = self.refs
+            candidates = set(store.indices[store.indptr[scanned_rows]:]) | pending
+            scanned_rows = store.num_rows
+
+            scored = []
+            for node in candidates:
+                sid = store.node_sid(node)
+                if sid is None or sid in known:
+                    continue
+                cnt = store.in_degree(node)
+                if cnt >= min_refs:
+                    scored.append((cnt, max(store.node_citedby[node], 0), node))
 
-                all_curr_refs += ab.references
-                assert len(ab.references) == ab.refcount
+            capacity = max_nodes - len(self.input_doi)
+            frontier = heapq.nlargest(capacity, scored) if capacity > 0 else []
+            pending = {x[2] for x in scored} - {x[2] for x in frontier}
+            if not frontier:
+                print("[+] Crawl stopped at level %d: %s" % (level, "no more candidates" if capacity > 0 else
+                                                             "max number of nodes reached"))
+                break
 
-                for ref in all_curr_refs:  # build a dict of the works referred.
-                    dict_ent = self.curr_refs.get(ref.id)
-                    if dict_ent:
-                        # parent id is not available in REF view:
-                        dict_ent[1].add((i, ref.position,))  # TODO: should we enforce length?
-                    else:
-                        self.curr_refs[ref.id] = [ref, {(i, ref.position,), }]
-
-                self.v_ref.append(all_curr_refs)
-
-            except Scopus404Error as e1:
-                print(" !  REF view of DOI: ", doi, "cannot be found!", e1)
-                self.fail_set.add(doi)
-                self.v_ref.append(None)
-            except ValueError as e2:
-                print(" !  REF view of DOI: ", doi, e2)
-                self.fail_set.add(doi)
-                self.v_ref.append(None)
-            except Exception as e:
-                print(" !  Unhandled exception:", e)
-                self.fail_set.add(doi)
-                self.v_ref.append(None)
-                raise e
+            print("#" * 32 + " Crawl level %d: %d new papers, %d left over" % (level, len(frontier), len(pending)))
+            for _, _, node in frontier:
+                sid = store.node_sid(node)
+                known.add(sid)
+                self.input_doi.append(sid)
+                self.input_hop.append(level)
 
-        print("#" * 32 + " Failed: %d out of %d" % (self.v_ref.count(None), len(self.v_ref)))
-        for i, ref in enumerate(self.v_ref):
-            if not ref:
-                print("%4d | %32s |" % (i, self.input_doi[i]))
-        print()
+            self.retrieve_new()
+            known |= self.input_scopus_id | self.fail_set
 
 
 def update_md_metadata(md_dir):
@@ -1014,18 +4120,11 @@ def update_md_metadata(md_dir):
 
     md_dois = []
     md_paths = []
-    for root, dirs, files in os.walk(md_dir):
-        for fname in files:
-            fpa = os.path.join(root, fname)
-            fdoi = CitationGraph.read_val_by_key_in_frontmatter(fpa, "doi")
-            if fdoi.strip().strip("\"'"):
-                md_dois.append(fdoi.strip().strip("\"'"))
-                md_paths.append(fpa)
-            else:
-                f_scopus_id = CitationGraph.read_val_by_key_in_frontmatter(fpa, "scopus_id")
-                if f_scopus_id.strip().strip("\"'"):
-                    md_dois.append(f_scopus_id.strip().strip("\"'"))
-                    md_paths.append(fpa)
+    vault_index = ObsidianVaultIndex.open(md_dir)
+    for rel_path, rec in sorted(vault_index.records.items()):
+        if rec.doi or rec.scopus_id:
+            md_dois.append(rec.doi or rec.scopus_id)
+            md_paths.append(os.path.join(md_dir, rel_path))
 
     print("[+] Found %d files that can be possibly updated." % len(md_paths))
 
@@ -1033,7 +4132,20 @@ def update_md_metadata(md_dir):
     # cg1.get_bibliography_info()
     cg1.get_bibliography_info_parallel()  # query in advance to fill the cache
 
-    cg1.update_md_metadata(md_paths)
+    cg1.update_md_metadata(md_paths, vault_index)
+
+
+def serve_session(session_path, host="127.0.0.1", port=ReferenceLookupService.DEFAULT_PORT):
+    """
+    Load a saved session (see CitationGraph.save_session) without touching Scopus, and serve lookups of its
+    references on localhost until interrupted. Query it with ReferenceLookupService.query or
+    live_bib_lookup(ii, service_url="http://127.0.0.1:8765").
+    :param session_path:
+    :param host:
+    :param port:
+    :return:
+    """
+    CitationGraph.load_session(session_path, offline=True).serve_lookups(host, port)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-from citation_graph import CitationGraph, update_md_metadata
+from citation_graph import CitationGraph, update_md_metadata, venue_abbreviator
 import os
 import yaml
 
@@ -12,17 +12,25 @@ if __name__ == '__main__':
         cfg = yaml.load(f, Loader=yaml.FullLoader)
         print(cfg)
 
+    venue_abbreviator.configure(cfg.get("venue_abbreviations") or [])
+
     ################################
     # use case a. Normal query
-    cg = CitationGraph(cfg["default_pub_identifiers"], cfg["default_pub_identifiers_ignored"], num_proc=4)
+    cg = CitationGraph(cfg["default_pub_identifiers"], cfg["default_pub_identifiers_ignored"], num_proc=4,
+                       group=cfg["group_topic"]["default_pub_identifiers"] or None)
     # cg.get_bibliography_info()
     cg.get_bibliography_info_parallel()
 
     cg.print_curr_papers(md_dir=obsidian_tmp_dir, topic=cfg["group_topic"]["default_pub_identifiers"])
     # cg.print_curr_papers(topic=cfg["group_topic"]["default_pub_identifiers"])
 
+    cg.dedup_refs()  # merge the references Scopus could not resolve into the matching ones
     cg.print_refs(show_ref_pos=True, min_refs=1)
 
+    # # the newer papers citing the group, only asking Scopus for the ones added since the last run
+    # cg.get_cited_by(since_last_run=True)
+    # cg.print_refs(forward=True, min_refs=2)
+
     # # show the bib of one paper
     # cg.print_paper_bibliography(31)
 
@@ -0,0 +1,41 @@
+import http.server
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import bench_citation_graph as bench  # noqa: E402
+import citation_graph as cg  # noqa: E402
+
+
+@pytest.fixture
+def fake_scopus(tmp_path, monkeypatch):
+    """
+    citation_graph routed to the synthetic Scopus of bench_citation_graph, with its caches under tmp_path. The module
+    globals are restored afterwards.
+    """
+    for name in ("AbstractRetrieval", "scopus_init", "get_config", "get_keys", "BASE_PATH", "OFFLINE"):
+        monkeypatch.setattr(cg, name, getattr(cg, name))
+    monkeypatch.setattr(bench.FakeAbstractRetrieval, "fail_rate", 0.0)
+    monkeypatch.setattr(bench.FakeAbstractRetrieval, "latency", 0.0)
+    bench.install_fake_scopus(str(tmp_path))
+    cg.OFFLINE = False
+    cg.ObsidianVaultIndex._opened.clear()
+    yield str(tmp_path)
+    cg.ObsidianVaultIndex._opened.clear()
+
+
+@pytest.fixture
+def metadata_server():
+    """
+    Local stand-in for doi.org and the arXiv API, serving canned BibTeX and Atom feeds, see FakeMetadataHandler.
+    :return: base url
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), bench.FakeMetadataHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:%d" % server.server_port
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,67 @@
+import json
+import os
+
+import bench_citation_graph as bench
+import citation_graph as cg
+from citation_graph import CitationGraph, ScopusQuotaBudget
+
+
+def retrieve(dois, **kwargs):
+    graph = CitationGraph(dois, **kwargs)
+    graph.get_bibliography_info()
+    return graph
+
+
+def test_estimate_cost(fake_scopus):
+    doi = bench.bench_dois(1)[0]
+    assert ScopusQuotaBudget.estimate_cost(doi, 30) == 1 + cg.SCOPUS_REF_PAGES_UNKNOWN
+    path = CitationGraph.scopus_cache_path(doi, "FULL")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "a").close()
+    refcount = bench.FakeAbstractRetrieval(doi).refcount
+    assert ScopusQuotaBudget.estimate_cost(doi, 30) == -(-refcount // cg.SCOPUS_REFS_PER_PAGE)
+    bench.warm_scopus_cache([doi])
+    assert ScopusQuotaBudget.estimate_cost(doi, 30) == 0
+
+
+def test_backlog_survives_other_runs(fake_scopus):
+    cost = 1 + cg.SCOPUS_REF_PAGES_UNKNOWN
+    dois = bench.bench_dois(6)
+    graph = retrieve(dois, max_spend=2 * cost, group="a")
+    assert len(graph.backlog) == 4 and graph.v_ref.count(None) == 4
+    path = graph.budget.path
+    assert ScopusQuotaBudget().load_backlog("a") == graph.backlog
+
+    with open(path, "rb") as f:
+        saved = f.read()
+    bench.warm_scopus_cache(bench.bench_dois(3, start=100))
+    retrieve(bench.bench_dois(3, start=100))  # nothing deferred, all cached: the file is not touched
+    retrieve(bench.bench_dois(2, start=200), offline=True)
+    with open(path, "rb") as f:
+        assert f.read() == saved
+
+    retrieve(bench.bench_dois(2, start=300), max_spend=0, group="b")
+    assert ScopusQuotaBudget().load_backlog("b") == bench.bench_dois(2, start=300)
+    assert ScopusQuotaBudget().load_backlog("a") == graph.backlog
+
+    resumed = retrieve(ScopusQuotaBudget().load_backlog("a")[:1], max_spend=cost, group="a")
+    assert resumed.backlog == []
+    assert ScopusQuotaBudget().load_backlog("a") == graph.backlog[1:]
+    assert ScopusQuotaBudget().load_backlog() == []
+
+
+def test_legacy_single_backlog(fake_scopus):
+    path = os.path.join(fake_scopus, ScopusQuotaBudget.FILE_NAME)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"keys": {}, "backlog": ["10.1/A", "10.1/B"]}, f)
+    budget = ScopusQuotaBudget()
+    assert budget.load_backlog() == ["10.1/A", "10.1/B"]
+    budget.save([], ["10.1/A"])
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f) == {"keys": {}, "backlogs": {"": ["10.1/B"]}}
+
+
+def test_unreadable_budget_file_is_ignored(fake_scopus):
+    with open(os.path.join(fake_scopus, ScopusQuotaBudget.FILE_NAME), "w", encoding="utf-8") as f:
+        f.write('{"keys": {')
+    assert ScopusQuotaBudget().load_backlog() == []
@@ -0,0 +1,110 @@
+import collections
+import http.server
+import json
+import re
+import threading
+import urllib.parse
+
+import pytest
+
+import bench_citation_graph as bench
+import citation_graph as cg
+
+
+class FakeSearchHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Scopus Search API stand-in for REFEID queries. The paper 2-s2.0-<n> is cited by n % 1000 papers, one in ten
+    without a scopus id; an ORIG-LOAD-DATE query returns two new papers, the second one without a scopus id.
+    """
+
+    def do_GET(self):
+        q = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        query, start, count = q["query"][0], int(q["start"][0]), int(q["count"][0])
+        self.server.hits[query] += 1
+        num = int(re.search(r"REFEID\(2-s2.0-(\d+)\)", query).group(1))
+        if "ORIG-LOAD-DATE" in query:
+            ids = [9000000001 + num % 1000 * 10, 5]
+        else:
+            ids = [80000000000 + num % 1000 * 1000 + k for k in range(num % 1000)]
+        entries = [{"dc:identifier": "SCOPUS_ID:%d" % i if i % 10 != 5 else "",
+                    "dc:title": "Citing paper %d of %d" % (i, num), "dc:creator": "Smith A.",
+                    "prism:publicationName": "IEEE Robotics and Automation Letters", "prism:coverDate": "2024-05-01",
+                    "citedby-count": str(i % 50)}
+                   for i in ids[start:start + count]] or [{"error": "Result set was empty"}]
+        body = json.dumps({"search-results": {"opensearch:totalResults": str(len(ids)), "entry": entries}})
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def search_server(fake_scopus, monkeypatch):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeSearchHandler)
+    server.hits = collections.Counter()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(cg.CitedBySearch, "API_URL", "http://127.0.0.1:%d/content/search/scopus" % server.server_port)
+    monkeypatch.setattr(cg, "TokenBucket", bench.UnthrottledTokenBucket)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def search(tmp_path, **kwargs):
+    return cg.CitedBySearch(str(tmp_path / "cited_by"), **kwargs)
+
+
+@pytest.mark.parametrize("subscriber, num_requests", [(True, 3 + 1), (False, 18 + 1)])
+def test_pages_follow_subscriber_page_size(search_server, tmp_path, subscriber, num_requests):
+    eids = ["2-s2.0-84000000450", "2-s2.0-84000000003"]
+    s = search(tmp_path, subscriber=subscriber)
+    try:
+        found = s.cited_by(eids)
+    finally:
+        s.close()
+    assert sum(search_server.hits.values()) == num_requests == s.n_requests
+    assert [len(found[eid]) for eid in eids] == [450, 3]
+    assert [row.position for row in found[eids[0]]] == [str(k + 1) for k in range(450)]
+    assert found[eids[0]][5].id is None and found[eids[0]][5].title == "Citing paper 80000450005 of 84000000450"
+
+
+def test_cached_incremental_and_offline_runs(search_server, tmp_path):
+    eids = ["2-s2.0-84000000030", "2-s2.0-84000000012"]
+    first = search(tmp_path).cited_by(eids)
+
+    search_server.hits.clear()
+    s = search(tmp_path)
+    assert s.cited_by(eids) == first
+    assert s.n_requests == 0 and not search_server.hits
+
+    s = search(tmp_path)
+    incremental = s.cited_by(eids, since_last_run=True)
+    assert s.n_requests == 2  # one per paper
+    for eid in eids:
+        new = incremental[eid][len(first[eid]):]
+        assert incremental[eid][:len(first[eid])] == first[eid]
+        assert [row.id for row in new] == [str(9000000001 + int(eid[-3:]) * 10), None]  # id-less ones are kept
+        assert [row.position for row in new] == [str(len(first[eid]) + 1), str(len(first[eid]) + 2)]
+
+    search_server.hits.clear()
+    s = search(tmp_path, offline=True)
+    assert s.cited_by(eids, since_last_run=True) == incremental
+    assert s.n_requests == 0 and not search_server.hits
+
+
+def test_get_cited_by_fills_citers(search_server):
+    dois = bench.bench_dois(4)
+    bench.warm_scopus_cache(dois)
+    graph = cg.CitationGraph(dois)
+    graph.get_bibliography_info()
+    num = graph.get_cited_by()
+
+    counts = [int(full.eid[7:]) % 1000 for full in graph.v_full]
+    assert graph.citers.num_rows == len(dois)
+    assert num == sum(counts)  # citing papers of different inputs do not overlap on the fake
+    indptr = graph.citers.indptr
+    assert [indptr[i + 1] - indptr[i] for i in range(len(dois))] == counts
@@ -0,0 +1,70 @@
+import os
+
+import bench_citation_graph as bench
+import citation_graph as cg
+from citation_graph import CitationGraph, PaperCorpus
+
+
+def ref_ids(graph):
+    return [[ref.id for ref in refs] if refs is not None else None for refs in graph.v_ref]
+
+
+def retrieve(dois, **kwargs):
+    bench.warm_scopus_cache(dois)
+    graph = CitationGraph(dois, **kwargs)
+    graph.get_bibliography_info()
+    return graph
+
+
+def full_record(title, doi, scopus_id):
+    return cg.FullRecord(title, doi, "2-s2.0-" + scopus_id, 1, "2020-01-01", "IEEE Trans. Robot.", 1, [], [])
+
+
+def ref_row(scopus_id, doi=None):
+    return cg.RefRow("1", scopus_id, doi, "Reference %s" % scopus_id, "Doe J.", None, "IEEE Trans. Robot.",
+                     "2019-01-01", "3")
+
+
+def test_union_of_groups_matches_direct_retrieval(fake_scopus):
+    dois = bench.bench_dois(30)
+    retrieve(dois[:20], group="a")
+    retrieve(dois[10:], group="b")
+    corpus = PaperCorpus(os.path.join(fake_scopus, PaperCorpus.FILE_NAME))
+    assert corpus.groups() == {"a": 20, "b": 20}
+
+    union = CitationGraph.from_corpus(groups=("a", "b"))
+    assert sorted(union.input_doi) == sorted(dois)
+    direct = retrieve(union.input_doi)
+    assert ref_ids(union) == ref_ids(direct)
+    assert [full.eid for full in union.v_full] == [full.eid for full in direct.v_full]
+
+    some = CitationGraph.from_corpus(identifiers=dois[:2] + ["10.5555/UNKNOWN"], groups="a")
+    assert some.input_doi[:3] == dois[:2] + ["10.5555/UNKNOWN"] and len(some.input_doi) == 21
+    assert some.v_ref[2] is None
+
+
+def test_paper_stored_once_whatever_identifier_reached_it(tmp_path):
+    corpus = PaperCorpus(str(tmp_path / "corpus.sqlite"))
+    paper = full_record("Paper", "10.1109/LRA.2020.1", "85000000001")
+    refs = [ref_row("85000000100"), ref_row("85000000101", "10.1/REF")]
+    assert corpus.add_many([("10.1109/LRA.2020.1", paper, refs)], group="seed") == 1
+    assert corpus.add_many([("85000000001", paper, refs)], group="crawl") == 0  # same paper, same record
+    assert corpus.add_many([("85000000001", paper._replace(citedby_count=2), refs)]) == 1
+    assert corpus.paper_ids() == ["10.1109/LRA.2020.1"]
+    assert corpus.groups() == {"crawl": 1, "seed": 1}
+    assert corpus.load_many(["10.1109/LRA.2020.1"])["10.1109/LRA.2020.1"][0].citedby_count == 2
+
+    assert corpus.resolve(["85000000001", "10.1109/lra.2020.1", "10.1109/LRA.2020.1", "10.5555/X"]) == [
+        "10.1109/LRA.2020.1", "10.5555/X"]
+
+
+def test_citing_by_scopus_id_and_doi(tmp_path):
+    corpus = PaperCorpus(str(tmp_path / "corpus.sqlite"))
+    corpus.add_many([("A", full_record("A", "10.1/A", "1"), [ref_row("3"), ref_row(None, "10.1/D")]),
+                     ("B", full_record("B", "10.1/B", "2"), [ref_row("3"), ref_row("1")]),
+                     ("C", full_record("C", "10.1/C", "3"), [])])
+    assert corpus.citing("3") == ["A", "B"]
+    assert corpus.citing("10.1/C") == ["A", "B"]  # through the scopus id of the paper with that DOI
+    assert corpus.citing("10.1/D") == ["A"]
+    assert corpus.citing("1") == ["B"]
+    assert corpus.citing("4") == []
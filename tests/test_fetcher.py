@@ -0,0 +1,134 @@
+import http.server
+import threading
+
+import pytest
+
+import citation_graph as cg
+
+
+class ScriptedHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers the statuses queued for a path in server.script first, then 200 with the path as body, after
+    server.delay[path] seconds. server.peak is the max number of requests served at a time.
+    """
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.hits.append(self.path)
+            statuses = server.script.get(self.path)
+            status = statuses.pop(0) if statuses else 200
+            location = server.redirects.get(self.path)
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        try:
+            threading.Event().wait(server.delay.get(self.path, 0.))
+            body = self.path.encode("utf-8")
+            self.send_response(302 if location else status)
+            if location:
+                self.send_header("Location", location)
+                body = b""
+            if status == 429:
+                self.send_header("Retry-After", "2")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ScriptedHandler)
+    server.lock = threading.Lock()
+    server.hits, server.script, server.delay, server.redirects = [], dict(), dict(), dict()
+    server.active = server.peak = 0
+    server.url = "http://127.0.0.1:%d" % server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def servers():
+    started = [start_server(), start_server()]
+    yield started
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """
+    The backoff waits of PooledHttpFetcher, recorded instead of slept.
+    """
+    waits = []
+    monkeypatch.setattr(cg.time, "sleep", waits.append)
+    return waits
+
+
+def test_get_all_keeps_input_order(servers):
+    server = servers[0]
+    paths = ["/doi/%d" % i for i in range(12)]
+    for i, path in enumerate(paths):
+        server.delay[path] = 0.02 * ((i * 7) % 5)  # later urls often finish first
+    fetcher = cg.PooledHttpFetcher(num_workers=6, max_per_host=6)
+    try:
+        res = list(fetcher.get_all([server.url + path for path in paths]))
+    finally:
+        fetcher.close()
+    assert [url for url, _, _ in res] == [server.url + path for path in paths]
+    assert [text for _, _, text in res] == paths
+    assert {status for _, status, _ in res} == {200}
+
+
+def test_retries_with_backoff_and_retry_after(servers, sleeps):
+    server = servers[0]
+    server.script["/busy"] = [429, 503]
+    server.script["/down"] = [502] * 10
+    server.script["/missing"] = [404]
+    fetcher = cg.PooledHttpFetcher(num_workers=1, max_retries=3, backoff=0.1)
+    try:
+        assert fetcher.get(server.url + "/busy") == (200, "/busy")
+        assert sleeps[0] == 2.  # Retry-After of the 429
+        assert 0.1 <= sleeps[1] < 0.3  # backoff * 2 ** 1 * [0.5, 1.5)
+
+        del sleeps[:]
+        assert fetcher.get(server.url + "/down")[0] == 502
+        assert len(sleeps) == 3
+        assert [0.05 * 2 ** i <= w < 0.15 * 2 ** i for i, w in enumerate(sleeps)] == [True] * 3
+
+        del sleeps[:]
+        assert fetcher.get(server.url + "/missing") == (404, "/missing")  # not retried
+        assert sleeps == []
+    finally:
+        fetcher.close()
+    assert server.hits.count("/busy") == 3 and server.hits.count("/down") == 4 and server.hits.count("/missing") == 1
+
+
+def test_connection_errors_give_status_minus_one(sleeps):
+    fetcher = cg.PooledHttpFetcher(num_workers=1, max_retries=2, timeout=1)
+    try:
+        assert fetcher.get("http://127.0.0.1:9/unreachable") == (-1, "")
+    finally:
+        fetcher.close()
+    assert len(sleeps) == 2
+
+
+def test_per_host_cap_covers_redirect_targets(servers):
+    resolver, publisher = servers
+    paths = ["/doi/%d" % i for i in range(16)]
+    for path in paths:
+        resolver.redirects[path] = publisher.url + "/bib" + path
+        publisher.delay["/bib" + path] = 0.05
+    fetcher = cg.PooledHttpFetcher(num_workers=8, max_per_host=2)
+    try:
+        res = list(fetcher.get_all([resolver.url + path for path in paths]))
+    finally:
+        fetcher.close()
+    assert [text for _, _, text in res] == ["/bib" + path for path in paths]
+    assert publisher.peak == 2
+    assert resolver.peak <= 2
@@ -0,0 +1,102 @@
+import os
+
+import pytest
+import requests
+
+import bench_citation_graph as bench
+import citation_graph as cg
+from citation_graph import CitationGraph, ObsidianVaultIndex
+
+
+@pytest.fixture
+def unthrottled(monkeypatch):
+    monkeypatch.setattr(cg, "TokenBucket", bench.UnthrottledTokenBucket)
+
+
+@pytest.fixture
+def closed_sessions(monkeypatch):
+    closed = []
+    close = requests.Session.close
+
+    def record_close(session):
+        closed.append(session)
+        close(session)
+
+    monkeypatch.setattr(requests.Session, "close", record_close)
+    return closed
+
+
+def note_ids(md_dir, field):
+    ObsidianVaultIndex._opened.clear()
+    return sorted(getattr(rec, field) for rec in ObsidianVaultIndex.open(md_dir, refresh=False).records.values())
+
+
+def test_arxiv_batches(tmp_path, metadata_server, unthrottled):
+    md_dir = str(tmp_path)
+    aids = ["arXiv:2101.%05d" % i for i in range(5)]
+    CitationGraph.create_obsidian_notes_from_arxiv(aids, md_dir, "test", batch_size=2,
+                                                   api_site=metadata_server + "/api/query")
+    assert note_ids(md_dir, "arxiv_id") == ["2101.%05d" % i for i in range(5)]
+
+
+def test_arxiv_closes_session_on_error(tmp_path, metadata_server, unthrottled, closed_sessions, monkeypatch):
+    md_dir = str(tmp_path)
+    get = requests.Session.get
+    calls = []
+
+    def failing_get(session, url, **kwargs):
+        calls.append(url)
+        if len(calls) > 1:
+            raise requests.ConnectionError("connection reset")
+        return get(session, url, **kwargs)
+
+    monkeypatch.setattr(requests.Session, "get", failing_get)
+    aids = ["arXiv:2101.%05d" % i for i in range(4)]
+    with pytest.raises(requests.ConnectionError):
+        CitationGraph.create_obsidian_notes_from_arxiv(aids, md_dir, "test", batch_size=2,
+                                                       api_site=metadata_server + "/api/query")
+
+    assert len(closed_sessions) == 1
+    assert os.path.isfile(os.path.join(md_dir, ObsidianVaultIndex.INDEX_NAME))  # the first batch is not lost
+    assert note_ids(md_dir, "arxiv_id") == ["2101.00000", "2101.00001"]
+
+
+def test_doi_notes_in_input_order(tmp_path, metadata_server, monkeypatch):
+    written = []
+    create_note = CitationGraph.create_obsidian_note_from_full
+
+    def record_note(uom, md_dir, topic, vault_index=None):
+        written.append(uom.doi)
+        create_note(uom, md_dir, topic, vault_index)
+
+    monkeypatch.setattr(CitationGraph, "create_obsidian_note_from_full", staticmethod(record_note))
+    md_dir = str(tmp_path)
+    dois = bench.bench_dois(30)
+    CitationGraph.create_obsidian_notes_from_dois(dois, md_dir, "test", num_workers=8, max_per_host=4,
+                                                  doi_site=metadata_server + "/doi/")
+    assert written == dois
+    assert note_ids(md_dir, "doi") == sorted(dois)
+
+    del written[:]
+    CitationGraph.create_obsidian_notes_from_dois(dois, md_dir, "test", doi_site=metadata_server + "/doi/")
+    assert written == []  # skipped by DOI
+
+
+def test_doi_closes_session_on_error(tmp_path, metadata_server, closed_sessions, monkeypatch):
+    written = []
+    create_note = CitationGraph.create_obsidian_note_from_full
+
+    def failing_note(uom, md_dir, topic, vault_index=None):
+        if written:
+            raise OSError("disk full")
+        written.append(uom.doi)
+        create_note(uom, md_dir, topic, vault_index)
+
+    monkeypatch.setattr(CitationGraph, "create_obsidian_note_from_full", staticmethod(failing_note))
+    md_dir = str(tmp_path)
+    dois = bench.bench_dois(5)
+    with pytest.raises(OSError):
+        CitationGraph.create_obsidian_notes_from_dois(dois, md_dir, "test", doi_site=metadata_server + "/doi/")
+
+    assert len(closed_sessions) == 1
+    assert note_ids(md_dir, "doi") == dois[:1]  # the vault index was saved
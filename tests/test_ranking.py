@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+import bench_citation_graph as bench
+from citation_graph import CitationGraph
+
+
+@pytest.fixture
+def graph(fake_scopus, monkeypatch):
+    monkeypatch.setattr(bench.FakeAbstractRetrieval, "pool_size", 300)  # references shared by many papers
+    dois = bench.bench_dois(40)
+    bench.warm_scopus_cache(dois)
+    g = CitationGraph(dois)
+    g.get_bibliography_info()
+    return g
+
+
+def principal_eigenvector(mat):
+    vals, vecs = np.linalg.eig(mat)
+    vec = np.real(vecs[:, np.argmax(np.real(vals))])
+    return vec / vec.sum()
+
+
+def test_citation_matrix(graph):
+    mat, row_node = graph.citation_matrix()
+    store = graph.refs
+    n = store.num_nodes + store.num_rows
+    assert mat.shape == (n, n)
+    assert set(mat.data) == {1.} and not mat.diagonal().any()
+    assert len(row_node) == store.num_rows
+    adj = store.adjacency_matrix().tocsr()
+    for row in range(store.num_rows):
+        assert set(mat[row_node[row]].indices) == set(adj[row].indices) - {row_node[row]}
+
+
+def test_pagerank_matches_dense_eigenvector(graph):
+    damping = 0.85
+    dense = graph.citation_matrix()[0].toarray()
+    n = dense.shape[0]
+    out_deg = dense.sum(axis=1)
+    trans = np.where(out_deg[:, None] > 0, dense / np.maximum(out_deg, 1)[:, None], 1. / n)
+    google = damping * trans + (1. - damping) / n
+
+    rank = graph.pagerank(damping=damping)
+    assert rank.sum() == pytest.approx(1.)
+    np.testing.assert_allclose(rank, principal_eigenvector(google.T), rtol=1e-6, atol=1e-12)
+
+
+def test_hits_matches_dense_eigenvectors(graph):
+    dense = graph.citation_matrix()[0].toarray()
+    hubs, auths = graph.hits()
+    np.testing.assert_allclose(auths, principal_eigenvector(dense.T @ dense), atol=1e-8)
+    np.testing.assert_allclose(hubs, principal_eigenvector(dense @ dense.T), atol=1e-8)
+
+
+def test_age_normalized_in_degree(graph):
+    store = graph.refs
+    cited = np.bincount(np.array(store.indices), minlength=store.num_nodes)  # local citations, as in ranked_refs
+    years = np.array(store.node_year, dtype=float)
+    assert (years > 0).all()  # every synthetic reference has a year
+    np.testing.assert_allclose(graph.age_normalized_in_degree(this_year=2025), cited / (2025 - years + 1.))
+
+
+@pytest.mark.parametrize("sort_by", CitationGraph.RANK_KEYS[1:])
+def test_ranked_refs_by_score(graph, sort_by):
+    scores = graph.ref_scores(sort_by)
+    rows = list(graph.ranked_refs(sort_by=sort_by, limit=50))
+    assert len(rows) == 50
+    assert [row.score for row in rows] == [scores[row.node] for row in rows]
+    assert all(a.score >= b.score for a, b in zip(rows, rows[1:]))
@@ -0,0 +1,64 @@
+import bench_citation_graph as bench
+from bench_citation_graph import FakeReference
+from citation_graph import CitationGraph, ReferenceSearchIndex
+
+
+def ref(pos, title, authors="Doe J.; Roe R.", venue="IEEE Transactions on Robotics", year=2016):
+    return FakeReference(str(pos), str(85000000000 + pos), None, title, authors, None, None, venue, str(year),
+                         "%d-01-01" % year, None, None, None, None, "0", None, None, None)
+
+
+REFS = [ref(1, "Past, present, and future of simultaneous localization and mapping", "Cadena C.; Carlone L."),
+        ref(2, "Scan context: egocentric spatial descriptor for place recognition", "Kim G.; Kim A.", year=2018),
+        ref(3, "LOAM: lidar odometry and mapping in real-time", "Zhang J.; Singh S.", "Robotics: Science and Systems",
+            2014)]
+
+
+def test_search_ranks_and_filters(tmp_path):
+    index = ReferenceSearchIndex(str(tmp_path / "index.sqlite"))
+    assert index.add_many([("Q1", "Paper one", REFS), ("Q2", "Paper two", REFS[1:])]) == 2
+
+    hits = index.search("lidar")
+    assert sorted((hit.q_id, hit.position, hit.paper_title, hit.year) for hit in hits) == [
+        ("Q1", 3, "Paper one", "2014"), ("Q2", 3, "Paper two", "2014")]
+    assert {hit.q_id for hit in index.search('"place recognition"')} == {"Q1", "Q2"}
+    assert [hit.position for hit in index.search("authors:Cadena")] == [1]
+    assert [hit.position for hit in index.search("year:2018 AND scan*", limit=1)] == [2]
+    assert [hit.position for hit in index.search("LiDAR-based")] == []  # not FTS5 syntax, quoted and retried
+    assert index.indexed_ids() == ["Q1", "Q2"]
+
+    assert index.add_many([("Q3", "Paper three", [ref(4, "Probabilistic robotics", venue="MIT Press", year=2005)])])
+    hits = index.search("robotics")
+    assert len(hits) == 6 and (hits[0].q_id, hits[0].position) == ("Q3", 4)  # titles weigh more than venues
+    assert [hit.score for hit in hits] == sorted(hit.score for hit in hits)
+    index.close()
+
+
+def test_unchanged_lists_and_titles(tmp_path):
+    index = ReferenceSearchIndex(str(tmp_path / "index.sqlite"))
+    assert index.add_many([("Q1", "Paper one", REFS)]) == 1
+    assert index.add_many([("Q1", "Paper one", REFS)]) == 0
+    assert index.add_many([("Q1", None, REFS)]) == 0  # e.g. index_bibliography_cache, no citing title
+    assert index.search("loam")[0].paper_title == "Paper one"
+
+    assert index.add_many([("Q1", "Paper one, revised", REFS)]) == 0
+    assert index.search("loam")[0].paper_title == "Paper one, revised"
+
+    assert index.add_many([("Q1", None, REFS[:2])]) == 1
+    assert index.search("loam") == []
+    assert index.search("scan")[0].paper_title == "Paper one, revised"
+    index.close()
+
+
+def test_cache_reindex_after_retrieval_is_a_no_op(fake_scopus):
+    dois = bench.bench_dois(10)
+    bench.warm_scopus_cache(dois)
+    graph = CitationGraph(dois)
+    graph.get_bibliography_info()
+    titles = dict(graph.search_index.conn.execute("SELECT q_id, title FROM papers"))
+    assert titles == {doi.upper(): full.title for doi, full in zip(graph.input_doi, graph.v_full)}
+
+    graph.index_bibliography_cache()
+    assert dict(graph.search_index.conn.execute("SELECT q_id, title FROM papers")) == titles
+    assert graph.search_index.add_many((q_id, None, refs) for q_id, refs in
+                                       graph.bib_cache.load_many(graph.bib_cache.cached_ids()).items()) == 0
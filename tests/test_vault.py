@@ -0,0 +1,78 @@
+import os
+
+import citation_graph as cg
+from citation_graph import CitationGraph, ObsidianVaultIndex
+
+
+def write_note(md_dir, name, doi, scopus_id, citedby=0):
+    path = os.path.join(md_dir, name + ".md")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("---\ntitle: \"%s\"\ndoi: %s\nscopus_id: %s\ncitedby: %d\n---\n\nbody\n"
+                % (name, doi, scopus_id, citedby))
+    return path
+
+
+def full_record(title, doi, scopus_id, citedby_count):
+    return cg.FullRecord(title, doi, "2-s2.0-" + scopus_id, citedby_count, "2020-01-01", "IEEE Trans. Robot.", 0,
+                         [], [])
+
+
+def test_na_doi_notes_match_by_scopus_id(fake_scopus, tmp_path):
+    md_dir = str(tmp_path / "vault")
+    os.makedirs(md_dir)
+    path_a = write_note(md_dir, "Paper A", "\"N/A\"", "85000000111")
+    path_b = write_note(md_dir, "Paper B", "", "85000000222")
+
+    graph = CitationGraph([])
+    graph.v_full = [full_record("Paper A", None, "85000000111", 111),
+                    full_record("Paper B", None, "85000000222", 222)]
+
+    for vault_index in (None, ObsidianVaultIndex.open(md_dir)):
+        graph.update_md_metadata([path_a, path_b], vault_index, num_workers=1)
+        for path, scopus_id, citedby in ((path_a, "85000000111", "111"), (path_b, "85000000222", "222")):
+            vals = CitationGraph.read_vals_in_frontmatter(path, ("scopus_id", "citedby"))
+            assert vals == {"scopus_id": scopus_id, "citedby": citedby}
+
+
+def test_unmatched_doi_less_note_is_left_alone(fake_scopus, tmp_path):
+    md_dir = str(tmp_path / "vault")
+    os.makedirs(md_dir)
+    path = write_note(md_dir, "Paper C", "\"N/A\"", "", citedby=7)
+    with open(path, encoding="utf-8") as f:
+        before = f.read()
+
+    graph = CitationGraph([])
+    graph.v_full = [full_record("Paper B", None, "85000000222", 222)]
+    graph.update_md_metadata([path], ObsidianVaultIndex.open(md_dir), num_workers=1)
+
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == before
+
+
+def test_frontmatter_lists_read_as_first_item(tmp_path):
+    path = str(tmp_path / "note.md")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("---\ndoi:\n  - 10.1109/TRO.2021.1\n  - 10.48550/arXiv.2101.00001\ntags:\n  - paper\n  - slam\n"
+                "aliases:\nscopus_id: 85000000111\n---\n")
+
+    assert CitationGraph.read_val_by_key_in_frontmatter(path, "doi") == "10.1109/TRO.2021.1"
+    assert CitationGraph.read_val_by_key_in_frontmatter(path, "aliases") == ""
+    assert CitationGraph.read_vals_in_frontmatter(path, ("doi", "scopus_id", "missing")) == {
+        "doi": "10.1109/TRO.2021.1", "scopus_id": "85000000111"}
+    assert CitationGraph.read_list_by_key_in_frontmatter(path, "tags") == ["paper", "slam"]
+    assert CitationGraph.read_list_by_key_in_frontmatter(path, "scopus_id") == ["85000000111"]
+    assert CitationGraph.read_list_by_key_in_frontmatter(path, "aliases") == []
+    assert CitationGraph.read_list_by_key_in_frontmatter(path, "missing") == []
+
+
+def test_list_valued_doi_note_is_updated(fake_scopus, tmp_path):
+    md_dir = str(tmp_path / "vault")
+    os.makedirs(md_dir)
+    path = write_note(md_dir, "Paper D", "\n  - 10.1109/TRO.2021.4", "")
+
+    graph = CitationGraph([])
+    graph.v_full = [full_record("Paper D", "10.1109/tro.2021.4", "85000000444", 444)]
+    for vault_index in (None, ObsidianVaultIndex.open(md_dir)):
+        graph.update_md_metadata([path], vault_index, num_workers=1)
+        assert CitationGraph.read_vals_in_frontmatter(path, ("scopus_id", "citedby")) == {
+            "scopus_id": "85000000444", "citedby": "444"}
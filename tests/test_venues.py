@@ -0,0 +1,59 @@
+import random
+import re
+
+import pytest
+
+from citation_graph import CitationGraph, VenueAbbreviator
+
+# simplify_source_title before VenueAbbreviator: one re.sub per rule, in order
+SEQUENTIAL_RULES = [("Transactions", "Trans."), ("International", "Int."), ("Journal", "J."),
+                    (r"Robot[ics]*?\s", "Robot. "), ("Research", "Res."), ("Proceedings?", "Proc."),
+                    ("Conferences?", "Conf."), ("Intelligen(t|ce)", "Intell."), (r"Systems?", "Syst."),
+                    ("Science", "Sci."), ("Automation", "Autom."), ("Letters?", "Lett."), (r" \- ", " "),
+                    (r"Comput\w+?\s", "Comput. "), (r"Europ\w+?\s", "Eur. ")]
+
+
+def sequential(src):
+    src += " "
+    for pattern, repl in SEQUENTIAL_RULES:
+        src = re.sub(pattern, repl, src)
+    return src.strip()
+
+
+@pytest.mark.parametrize("src, abbr", [
+    ("IEEE Transactions on Robotics", "IEEE Trans. on Robot."),
+    ("Proceedings - IEEE International Conference on Robotics and Automation",
+     "Proc. IEEE Int. Conf. on Robot. and Autom."),
+    ("Robotics\t- Science and Systems", "Robot. Sci. and Syst."),
+    ("European Conference on Computer\xa0Vision", "Eur. Conf. on Comput. Vision"),
+    ("Lecture Notes in Computer\nScience", "Lecture Notes in Comput. Sci."),
+])
+def test_default_rules(src, abbr):
+    assert VenueAbbreviator(memo_size=0)(src) == abbr == sequential(src)
+
+
+def test_same_as_sequential_rules_with_any_separator():
+    words = ("IEEE Transactions on Robotics International Journal of Robot Research Proceedings Conference Intelligent "
+             "Intelligence Systems Science Automation Letters Computer Computing Computational European Europe "
+             "Robots Robotic Comput Europ - ACM Lecture Notes").split()
+    seps = [" ", "\t", "\n", "\xa0", " - ", "\t- ", " -\t"]
+    rnd = random.Random(0)
+    abbreviate = VenueAbbreviator(memo_size=0)
+    for _ in range(20000):
+        src = "".join(rnd.choice(words) + rnd.choice(seps) for _ in range(rnd.randint(1, 8)))
+        if rnd.random() < .5:
+            src = src.strip(" ")
+        assert abbreviate(src) == sequential(src), repr(src)
+
+
+def test_configured_rules_take_precedence_and_reset_the_memo():
+    abbreviate = VenueAbbreviator(memo_size=8)
+    assert abbreviate("Journal of Field Robotics") == "J. of Field Robot."
+    abbreviate.configure([("Field", "Fld."), ("Journal", "Jour.")])
+    assert abbreviate("Journal of Field Robotics") == "Jour. of Fld. Robot."
+    abbreviate.configure([], replace=True)
+    assert abbreviate("Journal of Field Robotics") == "Journal of Field Robotics"
+
+
+def test_simplify_source_title_uses_the_module_abbreviator():
+    assert CitationGraph.simplify_source_title("IEEE Robotics and Automation Letters") == "IEEE Robot. and Autom. Lett."